@@ -2,8 +2,6 @@ import sys
 from os import path
 import glob
 
-import numpy
-
 import soundfile as sf
 
 # ------------------------------------------------------------------------------
@@ -20,6 +18,9 @@ INTERNAL_SAMPLE_FORMAT = 'float64'
 # 波形ファイルセーブ時のフォーマット
 EXPORT_SAMPLE_FORMAT = 'FLOAT'
 
+# 結合時に一度に読み書きするサンプル数
+BLOCK_SIZE = 2 ** 16
+
 # ------------------------------------------------------------------------------
 # internal methods
 # ------------------------------------------------------------------------------
@@ -57,29 +58,31 @@ if __name__=='__main__':
         exit(1)
 
     # 指定ディレクトリ下の wav ファイルを全て列挙
-    FILES = glob.glob(path.join(INPUT_PATH, '*.wav'))
+    # 書き込み中の出力ファイルは読み込まないように除外する
+    output_path = compose_path(INPUT_PATH, OUTPUT_FILE_STEM, OUTPUT_FILE_EXTENSION)
+    FILES = [p for p in glob.glob(path.join(INPUT_PATH, '*.wav')) if path.abspath(p) != path.abspath(output_path)]
 
-    # 全ての wav ファイルを１つに結合
-    result = numpy.empty((0, 2), INTERNAL_SAMPLE_FORMAT)
+    # サンプルレートを先にヘッダだけでチェック
     SAMPLE_RATE = 0
+    CHANNELS = 0
     for p in FILES:
-        # ロード & 結合
-        TEMP_INPUT, TEMP_SAMPLE_RATE = sf.read(file=p, dtype=INTERNAL_SAMPLE_FORMAT)
-        # サンプルレートをチェック
+        TEMP_INFO = sf.info(p)
         if SAMPLE_RATE == 0:
-            SAMPLE_RATE = TEMP_SAMPLE_RATE
-        elif SAMPLE_RATE != TEMP_SAMPLE_RATE:
+            SAMPLE_RATE = TEMP_INFO.samplerate
+            CHANNELS = TEMP_INFO.channels
+        elif SAMPLE_RATE != TEMP_INFO.samplerate:
             print('Wrong sample rate is detected in input files.')
             print('File = ' + p)
-            print('Expected sample rate = ' + SAMPLE_RATE)
-            print('Actual sample rate = ' + TEMP_SAMPLE_RATE)
+            print('Expected sample rate = %d' % SAMPLE_RATE)
+            print('Actual sample rate = %d' % TEMP_INFO.samplerate)
             exit(1)
-        # 結合
-        result = numpy.r_[result, TEMP_INPUT]
 
-    # 結合したファイルを出力
-    output_path = compose_path(INPUT_PATH, OUTPUT_FILE_STEM, OUTPUT_FILE_EXTENSION)
-    sf.write(file=output_path, data=result, samplerate=SAMPLE_RATE, subtype=EXPORT_SAMPLE_FORMAT)
+    # 全ての wav ファイルを１つに結合
+    # 結合結果を配列上で伸長せずに、ブロック単位で直接ファイルに書き出す
+    with sf.SoundFile(output_path, 'w', samplerate=SAMPLE_RATE, channels=CHANNELS, subtype=EXPORT_SAMPLE_FORMAT) as output_file:
+        for p in FILES:
+            for block in sf.blocks(p, blocksize=BLOCK_SIZE, dtype=INTERNAL_SAMPLE_FORMAT):
+                output_file.write(block)
 
     # 正常終了
     exit(0)
@@ -0,0 +1,673 @@
+import os
+import sys
+import time
+import subprocess
+import tempfile
+import tracemalloc
+
+import numpy
+from scipy import ndimage
+from scipy import signal
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from details import *
+from details.samples_functions import _filter_extrema_zerocross, _filter_extrema_velocity, _filter_zerocross_period
+from details.samples_functions import _moving_max as samples_moving_max
+
+# ------------------------------------------------------------------------------
+# constants
+# ------------------------------------------------------------------------------
+
+# ベンチマークに使うサンプルレート
+SAMPLE_RATE = 48000
+
+# 乱数シード
+RANDOM_SEED = 0
+
+# 起動時間を計測するツールのエントリポイント（このファイルの親ディレクトリからの相対パス）
+TOOL_ENTRY_POINTS = [
+    'compose_wav_files/compose_wav_files.py',
+    'correct_bass/correct_bass.py',
+    'correct_kick/correct_kick.py',
+    'cutoff_extreme_band/cutoff_extreme_band.py',
+    'estimate_cutoff_frequency/estimate_cutoff_frequency.py',
+    'multiband_tool/multiband_tool.py',
+]
+
+# 起動時間の目標（秒）
+STARTUP_TIME_TARGET = 0.3
+
+# 起動時に読み込まれていないことを確認する重いモジュール
+STARTUP_HEAVY_MODULES = ['matplotlib', 'scipy.signal', 'scipy.optimize', 'scipy.fft']
+
+# ------------------------------------------------------------------------------
+# helpers
+# ------------------------------------------------------------------------------
+
+def measure(function, *args):
+    '''
+    function(*args) を実行して (結果, 経過秒数, ピークメモリ量[byte]) を返却する。\n
+    ピークメモリ量は tracemalloc で追跡された numpy 配列を含む確保量。
+    '''
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak
+
+def create_noise_samples(length_in_sec, channels=2):
+    '再現性のあるホワイトノイズのサンプル列を生成'
+    random = numpy.random.default_rng(RANDOM_SEED)
+    return random.uniform(-0.5, 0.5, (time2sample(length_in_sec, SAMPLE_RATE), channels))
+
+def create_noise_file(path, length_in_sec, channels=2):
+    'create_noise_samples() 相当の wav ファイルをブロック単位で書き出す'
+    random = numpy.random.default_rng(RANDOM_SEED)
+    remain = time2sample(length_in_sec, SAMPLE_RATE)
+    with wav_stream_writer(path, SAMPLE_RATE, channels, 'float32') as writer:
+        while 0 < remain:
+            length = min(remain, STREAM_BLOCK_SIZE)
+            writer.write(random.uniform(-0.5, 0.5, (length, channels)))
+            remain -= length
+
+def create_saw_bass_samples(length_in_sec, frequency=55.0, channels=2):
+    '''
+    ノコギリ波ベースのサンプル列を生成する。\n
+    レンダリング済みのステムを模して先頭と末尾に 10 ms のフェードをかける。
+    '''
+    length = time2sample(length_in_sec, SAMPLE_RATE)
+    phase = numpy.arange(length) * frequency / SAMPLE_RATE
+    samples = 0.5 * (2.0 * (phase - numpy.floor(phase)) - 1.0)
+    fade = numpy.minimum(1.0, numpy.minimum(numpy.arange(length), numpy.arange(length)[::-1]) / time2sample(0.01, SAMPLE_RATE))
+    return numpy.repeat((samples * fade)[:, numpy.newaxis], channels, 1)
+
+def create_dropout_bass_samples(length_in_sec, frequency=55.0, dropout_rate=0.05):
+    '''
+    200Hz ローパス済みのモノラルのノコギリ波ベースにノイズと欠落を加えたサンプル列を生成する。\n
+    欠落させた周期はクリックが検出されず、周期情報による補完の対象になる。
+    '''
+    random = numpy.random.default_rng(RANDOM_SEED)
+    samples = create_saw_bass_samples(length_in_sec, frequency, 1)[:, 0]
+    period = SAMPLE_RATE / frequency
+    cycle = (numpy.arange(samples.shape[0]) / period).astype(int)
+    samples[random.random(cycle[-1] + 1)[cycle] < dropout_rate] *= 0.1
+    samples += random.normal(0.0, 1e-3, samples.shape[0])
+    return apply_zplr(samples, 'low', 200, SAMPLE_RATE, STREAM_BLOCK_SIZE)
+
+def to_dbfs(value):
+    '誤差の最大値を dBFS で表す'
+    return to_decibel(max(value, 1e-300))
+
+# ------------------------------------------------------------------------------
+# benchmarks
+# ------------------------------------------------------------------------------
+
+def benchmark_streaming_filter(length_in_sec=3600):
+    '''
+    streaming_filter によるブロック単位の因果的フィルタリングを計測する。\n
+    一括の lfilter との一致は先頭 60 秒で確認する。
+    '''
+    # 一括処理との一致を確認
+    samples = create_noise_samples(min(length_in_sec, 60))
+    b, a = signal.butter(2, normalize_frequency(200, SAMPLE_RATE), 'low')
+    expected = signal.lfilter(b, a, samples, 0)
+    causal_filter = streaming_filter('butter', 'low', 2, 200, SAMPLE_RATE)
+    actual = numpy.concatenate([causal_filter.process(samples[i:i+STREAM_BLOCK_SIZE]) for i in range(0, samples.shape[0], STREAM_BLOCK_SIZE)])
+    print('max error against lfilter = %.1f dBFS' % to_dbfs(numpy.max(numpy.abs(expected - actual))))
+    # ファイルからのストリーミング処理を計測
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'input.wav')
+        create_noise_file(path, length_in_sec)
+        def run():
+            causal_filter.reset()
+            blocks, _ = load_samples_blocks(path, INTERNAL_SAMPLE_FORMAT)
+            for block in blocks:
+                causal_filter.process(block)
+        _, elapsed, peak = measure(run)
+    print('%d sec stereo : %.2f sec, peak memory = %.1f MiB' % (length_in_sec, elapsed, peak / 2**20))
+
+# zero_phase_streaming_filter と filtfilt の端点を含めた許容誤差（dBFS）
+ZERO_PHASE_TOLERANCE = -200.0
+
+def benchmark_zero_phase_filter(length_in_sec=600):
+    '''
+    zero_phase_streaming_filter と filtfilt を 200Hz クロスオーバーで比較する。\n
+    区間中央と、インパルス応答長の範囲の先頭・末尾の誤差を別々に表示し、どちらも ZERO_PHASE_TOLERANCE 以内である事を確認する。
+    '''
+    samples = create_saw_bass_samples(length_in_sec)
+    for mode in ['low', 'high']:
+        expected, filtfilt_elapsed, filtfilt_peak = measure(apply_zplr, samples, mode, 200, SAMPLE_RATE)
+        actual, block_elapsed, block_peak = measure(apply_zplr, samples, mode, 200, SAMPLE_RATE, STREAM_BLOCK_SIZE)
+        edge = zero_phase_streaming_filter('butter', mode, 2, 200, SAMPLE_RATE).impulse.shape[0]
+        error = numpy.abs(expected - actual)
+        interior_error = to_dbfs(numpy.max(error[edge:-edge]))
+        edge_error = to_dbfs(max(numpy.max(error[:edge]), numpy.max(error[-edge:])))
+        assert interior_error < ZERO_PHASE_TOLERANCE and edge_error < ZERO_PHASE_TOLERANCE
+        print('%s : max error = %.1f dBFS in interior, %.1f dBFS in %d edge samples' % (mode, interior_error, edge_error, edge))
+        print('%s : filtfilt %.2f sec / %.1f MiB, block %.2f sec / %.1f MiB' % (mode, filtfilt_elapsed, filtfilt_peak / 2**20, block_elapsed, block_peak / 2**20))
+
+def benchmark_compose(piece_length_in_sec=0.01):
+    '''
+    numpy.r_ による逐次結合と compose_samples_list() 、 compose_wav_files() を 10 ～ 1000 ファイルで比較する。\n
+    ファイル数に対して線形にスケールする事を確認する。
+    '''
+    piece = create_noise_samples(piece_length_in_sec)
+    for count in [10, 100, 1000]:
+        pieces = [piece] * count
+        def compose_by_r_():
+            result = numpy.empty((0, 2), INTERNAL_SAMPLE_FORMAT)
+            for p in pieces:
+                result = numpy.r_[result, p]
+            return result
+        expected, r_elapsed, _ = measure(compose_by_r_)
+        actual, list_elapsed, _ = measure(compose_samples_list, pieces)
+        assert numpy.array_equal(expected, actual)
+        with tempfile.TemporaryDirectory() as temp_dir:
+            paths = []
+            for i in range(count):
+                paths.append(os.path.join(temp_dir, 'input%d.wav' % i))
+                save_samples(paths[-1], piece, SAMPLE_RATE, 'float32')
+            _, file_elapsed, file_peak = measure(compose_wav_files, paths, os.path.join(temp_dir, 'output.wav'), INTERNAL_SAMPLE_FORMAT, 'float32')
+        print('%4d files : numpy.r_ %.3f sec, compose_samples_list %.3f sec, compose_wav_files %.3f sec / %.1f MiB' % (count, r_elapsed, list_elapsed, file_elapsed, file_peak / 2**20))
+
+def _reference_complete_zerocross_period(source_zerocross_offset, candidate_zerocross_offset, period, torelence_period_error_rate):
+    '書き換え前の _complete_zerocross_period() 、回帰確認用'
+    result_offset = source_zerocross_offset
+    while True:
+        tolerance_max_distance = period * (1.0 + torelence_period_error_rate)
+        corrupt_zerocross_offset = result_offset[numpy.where(tolerance_max_distance < numpy.diff(result_offset))]
+        if corrupt_zerocross_offset.shape[0] == 0:
+            break
+        augumented_offset = numpy.empty(corrupt_zerocross_offset.shape[0], int)
+        for i in range(0, corrupt_zerocross_offset.shape[0]):
+            expected_offset = corrupt_zerocross_offset[i] + period
+            torelance_error = period * torelence_period_error_rate
+            query_result = candidate_zerocross_offset[candidate_zerocross_offset <= expected_offset + torelance_error]
+            query_result = query_result[expected_offset - torelance_error <= query_result]
+            if query_result.size == 0:
+                augumented_offset[i] = expected_offset
+            else:
+                augumented_offset[i] = query_result[int(query_result.size/2)]
+        result_offset = numpy.unique(numpy.sort(numpy.append(result_offset, augumented_offset)))
+    return result_offset
+
+def _reference_detect_click(samples, peak_amplitude_threshold, torelence_period_error_rate):
+    '書き換え前の detect_click() 、回帰確認用'
+    samples_zerocross_offset = numpy.where(samples[1:] * samples[:-1] <= 0)[0]
+    extrema_offset = argextrema(samples)
+    extrema_offset, extrema_amplitude = _filter_extrema_zerocross(extrema_offset, samples[extrema_offset])
+    extrema_offset, extrema_amplitude = _filter_extrema_velocity(extrema_offset, extrema_amplitude, peak_amplitude_threshold)
+    click_zerocross_offset = numpy.empty(extrema_offset.shape[0], int)
+    for arg in range(0, extrema_offset.size):
+        click_zerocross_offset[arg] = samples_zerocross_offset[extrema_offset[arg] < samples_zerocross_offset][0]
+    estimated_period = numpy.median(click_zerocross_offset[1:]-click_zerocross_offset[0:-1])
+    click_zerocross_offset = _filter_zerocross_period(click_zerocross_offset, estimated_period, torelence_period_error_rate)
+    return _reference_complete_zerocross_period(click_zerocross_offset, samples_zerocross_offset, estimated_period, torelence_period_error_rate)
+
+def benchmark_detect_click(max_length_in_sec=600):
+    '''
+    detect_click() を書き換え前の実装と 10 秒 ～ 10 分の欠落入りノコギリ波ベースで比較する。\n
+    結果が完全に一致する事を確認してから所要時間を表示する。
+    '''
+    # note ゼロに触れるだけのものは含めず、ゼロを挟んだ負→正は最後のゼロの位置を返す
+    for samples, expected in ZERO_CROSS_CASES:
+        assert numpy.array_equal(detect_negative_to_positive_zero_cross(numpy.array(samples)), expected)
+    for length_in_sec in [10, 60, 600]:
+        if max_length_in_sec < length_in_sec:
+            break
+        samples = create_dropout_bass_samples(length_in_sec)
+        expected, reference_elapsed, _ = measure(_reference_detect_click, samples, 0.9, 0.1)
+        actual, elapsed, _ = measure(detect_click, samples, 0.9, 0.1)
+        assert numpy.array_equal(expected, actual)
+        print('%3d sec : %d clicks, reference %.3f sec, vectorized %.3f sec' % (length_in_sec, actual.size, reference_elapsed, elapsed))
+
+def _reference_detect_positive_extrema(samples):
+    '書き換え前の detect_positive_extrema() 、回帰確認用'
+    extremas = argextrema(samples)
+    selected_extremas = numpy.empty((0,), numpy.int64)
+    for i in range(1, extremas.shape[0]):
+        if samples[extremas[i-1]] < 0 and 0 < samples[extremas[i]]:
+            selected_extremas = numpy.append(selected_extremas, extremas[i])
+    return selected_extremas
+
+# detect_negative_to_positive_zero_cross() のゼロを含む場合の (入力, 期待するインデックス)
+ZERO_CROSS_CASES = [
+    ([1.0, 0.0, 1.0], []),
+    ([-1.0, 0.0, 1.0], [1]),
+    ([-1.0, 0.0, 0.0, 1.0], [2]),
+    ([-1.0, 0.0, -1.0, 1.0], [2]),
+    ([0.0, 1.0], []),
+    ([-1.0, 1.0, 0.0, 1.0], [0]),
+]
+
+def benchmark_detect_positive(max_length_in_sec=600):
+    '''
+    detect_positive_extrema() を書き換え前の実装と比較し、 detect_negative_to_positive_zero_cross() を計測する。\n
+    correct_bass と同じくモノラルのローパス済みサンプル列を入力とする。
+    '''
+    # note ゼロに触れるだけのものは含めず、ゼロを挟んだ負→正は最後のゼロの位置を返す
+    for samples, expected in ZERO_CROSS_CASES:
+        assert numpy.array_equal(detect_negative_to_positive_zero_cross(numpy.array(samples)), expected)
+    for length_in_sec in [10, 60, 600]:
+        if max_length_in_sec < length_in_sec:
+            break
+        samples = create_dropout_bass_samples(length_in_sec)
+        expected, reference_elapsed, _ = measure(_reference_detect_positive_extrema, samples)
+        actual, elapsed, _ = measure(detect_positive_extrema, samples)
+        assert numpy.array_equal(expected, actual)
+        print('%3d sec : extrema %d points, reference %.3f sec, vectorized %.3f sec' % (length_in_sec, actual.size, reference_elapsed, elapsed))
+        all_zero_cross = detect_positive_zero_cross(samples)
+        actual, elapsed, _ = measure(detect_negative_to_positive_zero_cross, samples)
+        assert numpy.array_equal(actual, all_zero_cross[(samples[all_zero_cross] < 0) & (0 < samples[all_zero_cross + 1])])
+        print('%3d sec : zero cross %d of %d points, %.3f sec' % (length_in_sec, actual.size, all_zero_cross.size, elapsed))
+
+def _reference_convert_to_median_rms(samples, window_size):
+    '書き換え前の convert_to_median_rms() 、回帰確認用'
+    per_ch_rms = []
+    window = numpy.ones(window_size) / window_size
+    for i in range(0, samples.shape[1]):
+        samples_ms = numpy.convolve(samples[:,i] * samples[:,i], window, 'valid')
+        samples_ms.sort()
+        per_ch_rms.append(numpy.sqrt(samples_ms[int(len(samples_ms)/2)]))
+    return numpy.mean(per_ch_rms)
+
+def benchmark_median_rms(length_in_sec=600):
+    '''
+    convert_to_median_rms() を書き換え前の実装と 0.3 秒窓で比較する。\n
+    median_rms_estimator によるファイルからのストリーミング計算の誤差とメモリ使用量も計測する。
+    '''
+    window_size = time2sample(0.3, SAMPLE_RATE)
+    samples = create_saw_bass_samples(length_in_sec)
+    expected, reference_elapsed, reference_peak = measure(_reference_convert_to_median_rms, samples, window_size)
+    actual, elapsed, peak = measure(convert_to_median_rms, samples, window_size)
+    print('convert_to_median_rms : error %.1f dB, reference %.2f sec / %.1f MiB, cumsum %.2f sec / %.1f MiB' % (to_decibel(abs(actual - expected) / expected), reference_elapsed, reference_peak / 2**20, elapsed, peak / 2**20))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'input.wav')
+        with wav_stream_writer(path, SAMPLE_RATE, 2, 'float64') as writer:
+            writer.write(samples)
+        del samples
+        def run():
+            estimator = median_rms_estimator(window_size, 2)
+            blocks, _ = load_samples_blocks(path, INTERNAL_SAMPLE_FORMAT)
+            for block in blocks:
+                estimator.process(block)
+            return estimator.result()
+        actual, elapsed, peak = measure(run)
+    print('median_rms_estimator : error %.4f dB, %.2f sec / %.1f MiB' % (to_decibel(actual / expected), elapsed, peak / 2**20))
+
+def benchmark_median_peak(length_in_sec=600):
+    '''
+    convert_to_median_peak() の移動最大値を scipy.ndimage.maximum_filter1d と 0.3 秒窓で比較する。\n
+    median_peak_estimator によるファイルからのストリーミング計算の誤差とメモリ使用量も計測する。
+    '''
+    window_size = time2sample(0.3, SAMPLE_RATE)
+    samples = create_saw_bass_samples(length_in_sec) * create_noise_samples(length_in_sec)
+    samples_abs = numpy.abs(samples)
+    expected_peak = ndimage.maximum_filter1d(samples_abs, window_size, 0)[window_size//2:samples.shape[0]-window_size+1+window_size//2]
+    assert numpy.array_equal(expected_peak, samples_moving_max(samples_abs, window_size))
+    expected = numpy.mean(numpy.sort(expected_peak, 0)[int(expected_peak.shape[0]/2)])
+    del samples_abs, expected_peak
+    actual, elapsed, peak = measure(convert_to_median_peak, samples, window_size)
+    assert actual == expected
+    print('convert_to_median_peak : %.2f sec / %.1f MiB' % (elapsed, peak / 2**20))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        path = os.path.join(temp_dir, 'input.wav')
+        with wav_stream_writer(path, SAMPLE_RATE, 2, 'float64') as writer:
+            writer.write(samples)
+        del samples
+        def run():
+            estimator = median_peak_estimator(window_size, 2)
+            blocks, _ = load_samples_blocks(path, INTERNAL_SAMPLE_FORMAT)
+            for block in blocks:
+                estimator.process(block)
+            return estimator.result()
+        actual, elapsed, peak = measure(run)
+    print('median_peak_estimator : error %.4f dB, %.2f sec / %.1f MiB' % (to_decibel(actual / expected), elapsed, peak / 2**20))
+
+# バンド分離ベンチマークのバンド構成（5 バンド、ゼロ位相と因果的フィルタの混在）
+BAND_SPLIT_SPECS = [
+    [('butter', 'low', 2, 100, True)],
+    [('butter', 'high', 2, 100, True), ('butter', 'low', 2, 500, True)],
+    [('butter', 'high', 2, 500, False), ('butter', 'low', 4, 2000, False)],
+    [('butter', 'high', 2, 2000, True), ('butter', 'low', 2, 8000, True)],
+    [],
+]
+
+def _reference_split_bands(samples, band_filter_specs, sample_rate, is_serial, block_size=None):
+    '書き換え前の multiband_tool のバンド分離ループ、回帰確認用'
+    temp_samples = samples
+    bands = []
+    for specs in band_filter_specs:
+        band = create_same_empty(temp_samples)
+        band[:] = temp_samples
+        for filter_type, filter_mode, filter_order, cutoff_frequency, is_zero_phase in specs:
+            band = apply_filter(band, filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate, is_zero_phase, block_size)
+        if is_serial:
+            temp_samples = temp_samples - band
+        bands.append(band)
+    return bands
+
+def benchmark_band_split(length_in_sec=600):
+    '''
+    split_bands() を書き換え前のバンド分離ループと 5 バンドで比較する。\n
+    一括処理はビット単位で一致する事、ブロック処理は同じ block_size のバンドごとのブロック処理と数値誤差の範囲で一致する事を確認する。\n
+    estimate_split_bands_allocation() の概算も測定したピークと並べて表示する。
+    '''
+    samples = create_noise_samples(length_in_sec)
+    for is_serial in [True, False]:
+        connection = 'serial' if is_serial else 'parallel'
+        for block_size in [None, STREAM_BLOCK_SIZE]:
+            expected, reference_elapsed, reference_peak = measure(_reference_split_bands, samples, BAND_SPLIT_SPECS, SAMPLE_RATE, is_serial, block_size)
+            actual, elapsed, peak = measure(split_bands, samples, BAND_SPLIT_SPECS, SAMPLE_RATE, is_serial, block_size)
+            error = max([numpy.max(numpy.abs(e - a)) for e, a in zip(expected, actual)])
+            if block_size is None:
+                assert error == 0
+            estimated = estimate_split_bands_allocation(samples, BAND_SPLIT_SPECS, SAMPLE_RATE, is_serial, block_size)
+            print('%s, block_size=%s : max error %.1f dBFS, reference %.2f sec / %.1f MiB, split_bands %.2f sec / %.1f MiB (estimated %.1f MiB)' % (connection, block_size, to_dbfs(error), reference_elapsed, reference_peak / 2**20, elapsed, peak / 2**20, estimated / 2**20))
+            del expected, actual
+
+def _measure_stream_criteria(samples, band_filter_specs, is_serial):
+    'split_bands_blocks() のバンドごとのブロックを median_rms_estimator に通す、２パス処理の１パス目に相当'
+    window_size = time2sample(0.3, SAMPLE_RATE)
+    estimators = [median_rms_estimator(window_size, samples.shape[1]) for _ in band_filter_specs]
+    source_blocks = (samples[i:i+STREAM_BLOCK_SIZE] for i in range(0, samples.shape[0], STREAM_BLOCK_SIZE))
+    for band_blocks in split_bands_blocks(source_blocks, band_filter_specs, SAMPLE_RATE, is_serial):
+        for estimator, block in zip(estimators, band_blocks):
+            estimator.process(block)
+    return [estimator.result() for estimator in estimators]
+
+def benchmark_band_split_stream(length_in_sec=600):
+    '''
+    split_bands_blocks() でバンド波形を保持せずに基準量を求める場合と、 split_bands() のブロック処理でバンド波形を全て保持してから求める場合を比較する。\n
+    基準量が MEDIAN_SKETCH_RESOLUTION 以内で一致する事、ストリーミング版のピークメモリ量が入力長に依存しない事を確認する。
+    '''
+    window_size = time2sample(0.3, SAMPLE_RATE)
+    stream_peaks = []
+    for length in [length_in_sec / 10, length_in_sec]:
+        samples = create_noise_samples(length)
+        def measure_whole():
+            bands = split_bands(samples, BAND_SPLIT_SPECS, SAMPLE_RATE, True, STREAM_BLOCK_SIZE)
+            return [convert_to_median_rms(band, window_size) for band in bands]
+        expected, whole_elapsed, whole_peak = measure(measure_whole)
+        actual, stream_elapsed, stream_peak = measure(_measure_stream_criteria, samples, BAND_SPLIT_SPECS, True)
+        error = max([abs(to_decibel(a / e)) for e, a in zip(expected, actual)])
+        assert error <= MEDIAN_SKETCH_RESOLUTION
+        stream_peaks.append(stream_peak)
+        print('%d sec : max criteria error %.4f dB, whole bands %.2f sec / %.1f MiB, stream %.2f sec / %.1f MiB' % (length, error, whole_elapsed, whole_peak / 2**20, stream_elapsed, stream_peak / 2**20))
+        del samples
+    # note 入力長を 10 倍にしてもストリーミング版のピークはほぼ変わらない
+    assert stream_peaks[1] < stream_peaks[0] * 1.5
+
+def benchmark_band_store(length_in_sec=60, count=16, ram_ceiling=2**27):
+    '''
+    count 個のバンド波形を band_store に保持し、 ram_ceiling を超えた分がディスクに退避される事を確認する。\n
+    ピークメモリ量がほぼ ram_ceiling ＋ 1 個分に収まる事、退避したものを含めて全て元の値で読み出せる事を確認する。
+    '''
+    def fill(store):
+        for index in range(int(count)):
+            store.put(index, create_noise_samples(length_in_sec) * (index + 1))
+        return store
+    with band_store(ram_ceiling) as store:
+        _, elapsed, peak = measure(fill, store)
+        band_bytes = store.get(0).nbytes
+        assert peak <= ram_ceiling + 2 * band_bytes
+        expected = create_noise_samples(length_in_sec)
+        for index in range(int(count)):
+            assert numpy.array_equal(store.get(index), expected * (index + 1))
+        print('%d x %.1f MiB bands, ceiling %.1f MiB : %d spilled, resident %.1f MiB, peak %.1f MiB, %.2f sec' % (count, band_bytes / 2**20, ram_ceiling / 2**20, store.spill_count, store.resident_bytes / 2**20, peak / 2**20, elapsed))
+
+# FFT エンジンと filtfilt の区間中央での許容誤差（dBFS）
+FFT_ENGINE_TOLERANCE = -120.0
+
+def create_crossover_specs(band_count):
+    '50Hz ～ 16kHz を対数等間隔に分割するゼロ位相 LR クロスオーバーのバンド構成を生成'
+    frequencies = numpy.geomspace(50, 16000, band_count - 1)
+    specs = [[('butter', 'low', 2, frequencies[0], True)]]
+    for lower, upper in zip(frequencies[:-1], frequencies[1:]):
+        specs.append([('butter', 'high', 2, lower, True), ('butter', 'low', 2, upper, True)])
+    specs.append([('butter', 'high', 2, frequencies[-1], True)])
+    return specs
+
+def benchmark_fft_engine(length_in_sec=60):
+    '''
+    split_bands() の engine='fft' を filtfilt による一括処理、ブロック処理と 2 ～ 16 バンドで比較する。\n
+    端点は各方式の端点処理で異なるので、区間中央（前後 1 秒を除く）で FFT_ENGINE_TOLERANCE 以内に一致する事を確認する。
+    '''
+    samples = create_noise_samples(length_in_sec)
+    edge = time2sample(1.0, SAMPLE_RATE)
+    for band_count in [2, 4, 8, 16]:
+        specs = create_crossover_specs(band_count)
+        expected, filtfilt_elapsed, _ = measure(split_bands, samples, specs, SAMPLE_RATE, True)
+        _, block_elapsed, _ = measure(split_bands, samples, specs, SAMPLE_RATE, True, STREAM_BLOCK_SIZE)
+        actual, fft_elapsed, _ = measure(split_bands, samples, specs, SAMPLE_RATE, True, None, 'fft')
+        error = to_dbfs(max([numpy.max(numpy.abs(e - a)[edge:-edge]) for e, a in zip(expected, actual)]))
+        assert error < FFT_ENGINE_TOLERANCE
+        throughput = [samples.shape[0] / t / 1e6 for t in [filtfilt_elapsed, block_elapsed, fft_elapsed]]
+        print('%2d bands : max error %.1f dBFS, filtfilt %.1f / block %.1f / fft %.1f Msamples/sec' % tuple([band_count, error] + throughput))
+        del expected, actual
+
+def benchmark_cutoff_solver(count=4):
+    '''
+    solve_cutoff_frequency() の所要時間（キャッシュなし・あり）と目標ゲインとの誤差を計測する。\n
+    フィルタタイプ・モード・次数・ゼロ位相の全組み合わせについて、 count 個の目標周波数で -3dB 点を求める。
+    '''
+    clear_filter_cache()
+    conditions = []
+    for filter_type in ['butter', 'cheby']:
+        for filter_mode in ['low', 'high']:
+            for filter_order in [2, 4]:
+                for is_zero_phase in [True, False]:
+                    for target_frequency in numpy.geomspace(40, 10000, int(count)):
+                        conditions.append((filter_type, filter_mode, filter_order, -3.0, float(target_frequency), SAMPLE_RATE, is_zero_phase))
+    # note Python のループが主体なので tracemalloc の影響を避けて時間だけ計る
+    start = time.perf_counter()
+    cutoffs = [solve_cutoff_frequency(*c) for c in conditions]
+    cold_elapsed = time.perf_counter() - start
+    start = time.perf_counter()
+    cutoffs = [solve_cutoff_frequency(*c) for c in conditions]
+    warm_elapsed = time.perf_counter() - start
+    error = max([abs(query_filter_gain(c[0], c[1], c[2], cutoff, c[5], c[6], c[4]) - c[3]) for c, cutoff in zip(conditions, cutoffs)])
+    print('%d conditions : max gain error %.2e dB, %.1f ms/solve (cold), %.4f ms/solve (cached)' % (len(conditions), error, cold_elapsed / len(conditions) * 1e3, warm_elapsed / len(conditions) * 1e3))
+
+def benchmark_cutoff_table(frequency_count=100):
+    '''
+    compute_cutoff_table() の Butterworth の閉形式と solve_cutoff_frequency() による数値解を比較する。\n
+    数値解は表の一部（先頭の目標周波数 10 個分）だけで計算して１件あたりの時間を比べる。
+    '''
+    frequencies = numpy.geomspace(20, 20000, int(frequency_count)).tolist()
+    arguments = (['butter'], ['low', 'high'], [1, 2, 4, 8], [-1.0, -3.0, -6.0, -12.0], frequencies, [44100, 48000, 96000], [True, False])
+    start = time.perf_counter()
+    table = compute_cutoff_table(*arguments)
+    table_elapsed = time.perf_counter() - start
+    clear_filter_cache()
+    start = time.perf_counter()
+    index = numpy.where(table['target_frequency'] <= frequencies[min(9, len(frequencies) - 1)])[0]
+    expected = [solve_cutoff_frequency(*[table[name][i].item() for name in CUTOFF_TABLE_COLUMNS[:-1]]) for i in index]
+    solver_elapsed = time.perf_counter() - start
+    error = numpy.max(numpy.abs(numpy.array(expected) / table['cutoff_frequency'][index] - 1))
+    print('%d entries : max relative error %.1e, closed form %.4f ms/entry, solver %.1f ms/entry' % (table['cutoff_frequency'].size, error, table_elapsed / table['cutoff_frequency'].size * 1e3, solver_elapsed / index.size * 1e3))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for ext in ['csv', 'npz']:
+            path = os.path.join(temp_dir, 'table.' + ext)
+            save_cutoff_table(path, table)
+            loaded = load_cutoff_table(path)
+            assert numpy.array_equal(loaded['cutoff_frequency'], table['cutoff_frequency'])
+            start = time.perf_counter()
+            lookup_cutoff_frequency(loaded, 'butter', 'high', 4, -3.0, frequencies[-1], 48000, True)
+            print('%s : %d bytes, lookup %.3f ms' % (ext, os.path.getsize(path), (time.perf_counter() - start) * 1e3))
+
+def benchmark_startup(count=5):
+    '''
+    各ツールのエントリポイントを別プロセスで読み込み、最初のサンプルを読む直前までの時間を計測する。\n
+    __name__ を '__main__' 以外にして runpy で実行するので、 import と定数定義までが計測対象。\n
+    インタプリタ自体の起動時間を含み、 count 回のうち最小値を表示する。\n
+    起動時に読み込まれた STARTUP_HEAVY_MODULES も表示する。
+    '''
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+    environment = dict(os.environ, PYTHONPATH=os.pathsep.join([root, os.environ.get('PYTHONPATH', '')]))
+    code = 'import sys, runpy; runpy.run_path(sys.argv[1], run_name="startup_benchmark"); print(",".join(m for m in %r if m in sys.modules))' % (STARTUP_HEAVY_MODULES,)
+    commands = [('(interpreter)', [sys.executable, '-c', 'pass'])]
+    commands += [(path, [sys.executable, '-c', code, os.path.join(root, path)]) for path in TOOL_ENTRY_POINTS]
+    for name, command in commands:
+        elapsed = []
+        for _ in range(int(count)):
+            start = time.perf_counter()
+            completed = subprocess.run(command, env=environment, capture_output=True, text=True, check=True)
+            elapsed.append(time.perf_counter() - start)
+        loaded = completed.stdout.strip()
+        print('%-56s : %.3f sec%s%s' % (name, min(elapsed), '' if min(elapsed) < STARTUP_TIME_TARGET else ' (over target)', ', loaded ' + loaded if loaded else ''))
+
+# 単精度処理と倍精度処理の 200Hz クロスオーバーの許容誤差（dBFS）
+FLOAT32_TOLERANCE = -120.0
+
+# 200Hz クロスオーバー（ゼロ位相 LR のローと残差、因果的フィルタのローと残差）
+CROSSOVER_200_SPECS = {
+    'zero phase': [[('butter', 'low', 2, 200, True)], []],
+    'causal': [[('butter', 'low', 2, 200, False)], []],
+}
+
+def benchmark_float32(length_in_sec=60):
+    '''
+    200Hz クロスオーバーのバンド分離と 0.3 秒窓の median RMS を float32 と float64 の入力で比較する。\n
+    一括処理・ブロック処理・FFT エンジンのいずれでも、出力が入力と同じ dtype で、\n
+    誤差が FLOAT32_TOLERANCE 以内に収まる事を確認する。バンド分離のピークメモリ量も比較する。
+    '''
+    samples = create_noise_samples(length_in_sec).astype(numpy.float32)
+    window_size = time2sample(0.3, SAMPLE_RATE)
+    for name, specs in CROSSOVER_200_SPECS.items():
+        for block_size, engine in [(None, 'iir'), (STREAM_BLOCK_SIZE, 'iir'), (None, 'fft')]:
+            # note 入力は同じ値を倍精度にしたもの
+            expected, elapsed_64, peak_64 = measure(split_bands, samples.astype(numpy.float64), specs, SAMPLE_RATE, True, block_size, engine)
+            actual, elapsed_32, peak_32 = measure(split_bands, samples, specs, SAMPLE_RATE, True, block_size, engine)
+            assert all([a.dtype == numpy.float32 for a in actual])
+            error = to_dbfs(max([numpy.max(numpy.abs(e - a)) for e, a in zip(expected, actual)]))
+            criteria_error = max([abs(to_decibel(convert_to_median_rms(a, window_size) / convert_to_median_rms(e, window_size))) for e, a in zip(expected, actual)])
+            assert error < FLOAT32_TOLERANCE
+            print('%s, block_size=%s, %s : max error %.1f dBFS, criteria error %.2e dB, float64 %.2f sec / %.1f MiB, float32 %.2f sec / %.1f MiB' % (name, block_size, engine, error, criteria_error, elapsed_64, peak_64 / 2**20, elapsed_32, peak_32 / 2**20))
+            del expected, actual
+
+# 書き出し・内部フォーマットの分解能（フルスケール 1.0 に対する 1 LSB 、浮動小数点は 1.0 でのマシンイプシロン）
+SAMPLE_FORMAT_RESOLUTIONS = {
+    'int16': 2.0 ** -15,
+    'int32': 2.0 ** -31,
+    'float32': float(numpy.finfo(numpy.float32).eps),
+    'float64': float(numpy.finfo(numpy.float64).eps),
+}
+
+def benchmark_sample_format(length_in_sec=60):
+    '''
+    save_samples() と load_samples() で全ての書き出しフォーマットを往復させる。\n
+    読み込んだサンプル列が要求した内部フォーマットの dtype で、誤差が書き出し・内部フォーマットの分解能以内である事と、\n
+    書き出しのピークメモリ量が入力のサンプル列の大きさより十分小さい（全体を変換したコピーを作らない）事を確認する。
+    '''
+    samples = create_noise_samples(length_in_sec) * 0.5
+    with tempfile.TemporaryDirectory() as temp_dir:
+        for sample_format in ['int16', 'int32', 'float32', 'float64']:
+            path = os.path.join(temp_dir, sample_format + '.wav')
+            _, save_elapsed, save_peak = measure(save_samples, path, samples, SAMPLE_RATE, sample_format)
+            assert save_peak < samples.nbytes / 4
+            for internal_format in SUPPORTED_INTERNAL_SAMPLE_FORMATS:
+                (loaded, _), load_elapsed, _ = measure(load_samples, path, internal_format)
+                assert loaded.dtype == numpy.dtype(internal_format)
+                error = numpy.max(numpy.abs(loaded - samples))
+                assert error <= max(SAMPLE_FORMAT_RESOLUTIONS[sample_format], SAMPLE_FORMAT_RESOLUTIONS[internal_format])
+                print('%-7s -> %-7s : max error %.1f dBFS, save %.2f sec / %.1f MiB, load %.2f sec' % (sample_format, internal_format, to_dbfs(error), save_elapsed, save_peak / 2**20, load_elapsed))
+                del loaded
+
+def _next_prime(n):
+    'n 以上の最小の素数'
+    while n < 2 or any(n % d == 0 for d in range(2, int(n ** 0.5) + 1)):
+        n += 1
+    return n
+
+def benchmark_resample(length_in_sec=3, stretch=0.9999):
+    '''
+    resample_samples() の engine='fft' と 'poly' （全品質）を入出力長の素因数が異なる条件で比較する。\n
+    入力は周期的でない帯域制限信号（ 10kHz 以下の正弦波の和）で、理想的な伸縮結果との誤差を区間中央で計算する。\n
+    出力長は入力長の stretch 倍付近で、２冪・奇数・素数の組み合わせを試す。\n
+    所要時間は FIR の設計を含む１回目（ cold ）とキャッシュ済みの２回目を表示する。
+    '''
+    random = numpy.random.default_rng(RANDOM_SEED)
+    frequencies = random.uniform(30, 10000, 16)
+    phases = random.uniform(0, 2 * numpy.pi, 16)
+    def create(times):
+        return numpy.sin(2 * numpy.pi * frequencies * times[:, None] + phases).mean(axis=1)
+    base = 2 ** int(numpy.log2(time2sample(length_in_sec, SAMPLE_RATE)))
+    output_base = int(base * stretch)
+    conditions = [
+        ('pow2 -> even', base, output_base - output_base % 2),
+        ('pow2 -> odd', base, output_base | 1),
+        ('odd -> prime', base + 1, _next_prime(output_base)),
+        ('prime -> prime', _next_prime(base), _next_prime(output_base + 1000)),
+    ]
+    for name, input_length, output_length in conditions:
+        samples = create(numpy.arange(input_length) / SAMPLE_RATE)
+        expected = create(numpy.arange(output_length) * (input_length / output_length) / SAMPLE_RATE)
+        edge = output_length // 10
+        results = []
+        for engine, quality in [('fft', 'medium'), ('poly', 'low'), ('poly', 'medium'), ('poly', 'high')]:
+            # note １回目は FIR の設計込み、２回目はキャッシュ済みの FIR を使う
+            design_resample_kernel.cache_clear()
+            start = time.perf_counter()
+            resample_samples(samples, output_length, engine, quality)
+            cold_elapsed = time.perf_counter() - start
+            start = time.perf_counter()
+            actual = resample_samples(samples, output_length, engine, quality)
+            elapsed = time.perf_counter() - start
+            error = to_dbfs(numpy.max(numpy.abs(actual - expected)[edge:-edge]))
+            results.append('%s%s %.1f ms / %.1f ms cold (%.0f dBFS)' % (engine, '' if engine == 'fft' else '/' + quality, elapsed * 1e3, cold_elapsed * 1e3, error))
+        print('%-14s %7d -> %7d : %s' % (name, input_length, output_length, ', '.join(results)))
+
+# ベンチマーク名と実装の対応
+BENCHMARKS = {
+    'streaming_filter': benchmark_streaming_filter,
+    'zero_phase_filter': benchmark_zero_phase_filter,
+    'compose': benchmark_compose,
+    'detect_click': benchmark_detect_click,
+    'detect_positive': benchmark_detect_positive,
+    'median_rms': benchmark_median_rms,
+    'median_peak': benchmark_median_peak,
+    'band_split': benchmark_band_split,
+    'band_split_stream': benchmark_band_split_stream,
+    'band_store': benchmark_band_store,
+    'fft_engine': benchmark_fft_engine,
+    'cutoff_solver': benchmark_cutoff_solver,
+    'cutoff_table': benchmark_cutoff_table,
+    'resample': benchmark_resample,
+    'float32': benchmark_float32,
+    'sample_format': benchmark_sample_format,
+    'startup': benchmark_startup,
+}
+
+# ------------------------------------------------------------------------------
+# main
+# ------------------------------------------------------------------------------
+
+def print_usage():
+    'このプログラムの使い方を表示'
+    print('Usage : python benchmark_details.py [<benchmark name> [<arguments> ...]]')
+    print('<benchmark name> is one of : ' + ', '.join(BENCHMARKS.keys()))
+    print('All benchmarks run with default arguments if no name is specified.')
+
+if __name__ == '__main__':
+    # 引数のエイリアスを作る
+    INPUT_ARGS = sys.argv[1:]
+
+    # 指定がなければ全て実行
+    if len(INPUT_ARGS) == 0:
+        for name, benchmark in BENCHMARKS.items():
+            print('*** %s ***' % name)
+            benchmark()
+        exit(0)
+
+    # 指定されたベンチマークを実行
+    if INPUT_ARGS[0] not in BENCHMARKS:
+        print_usage()
+        exit(1)
+    BENCHMARKS[INPUT_ARGS[0]](*[float(a) for a in INPUT_ARGS[1:]])
+
+    # 正常終了
+    exit(0)
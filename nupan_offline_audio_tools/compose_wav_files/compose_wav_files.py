@@ -2,10 +2,6 @@ import sys
 from os import path
 import glob
 
-import numpy
-
-import soundfile as sf
-
 from details import *
 
 # ------------------------------------------------------------------------------
@@ -39,29 +35,16 @@ if __name__=='__main__':
         exit(1)
 
     # 指定ディレクトリ下の wav ファイルを全て列挙
-    FILES = glob.glob(path.join(INPUT_PATH, '*.wav'))
+    # 書き込み中の出力ファイルは読み込まないように除外する
+    output_path = compose_path(INPUT_PATH, OUTPUT_FILE_STEM, OUTPUT_FILE_EXTENSION)
+    FILES = [p for p in glob.glob(path.join(INPUT_PATH, '*.wav')) if path.abspath(p) != path.abspath(output_path)]
 
     # 全ての wav ファイルを１つに結合
-    result = numpy.empty((0, 2), INTERNAL_SAMPLE_FORMAT)
-    SAMPLE_RATE = 0
-    for p in FILES:
-        # ロード & 結合
-        TEMP_INPUT, TEMP_SAMPLE_RATE = sf.read(file=p, dtype=INTERNAL_SAMPLE_FORMAT)
-        # サンプルレートをチェック
-        if SAMPLE_RATE == 0:
-            SAMPLE_RATE = TEMP_SAMPLE_RATE
-        elif SAMPLE_RATE != TEMP_SAMPLE_RATE:
-            print('Wrong sample rate is detected in input files.')
-            print('File = ' + p)
-            print('Expected sample rate = ' + SAMPLE_RATE)
-            print('Actual sample rate = ' + TEMP_SAMPLE_RATE)
-            exit(1)
-        # 結合
-        result = numpy.r_[result, TEMP_INPUT]
-
-    # 結合したファイルを出力
-    output_path = compose_path(INPUT_PATH, OUTPUT_FILE_STEM, OUTPUT_FILE_EXTENSION)    
-    sf.write(file=output_path, data=result, samplerate=SAMPLE_RATE, subtype=EXPORT_SAMPLE_FORMAT)
+    try:
+        compose_wav_files(FILES, output_path, INTERNAL_SAMPLE_FORMAT, EXPORT_SAMPLE_FORMAT)
+    except RuntimeError as err:
+        print(err)
+        exit(1)
 
     # 正常終了
     exit(0)
@@ -1,7 +1,10 @@
 import os
 import sys
 import glob
+import time
+import contextlib
 from fractions import Fraction
+from functools import partial
 import configparser
 
 import numpy
@@ -37,163 +40,301 @@ class correct_bass_parameters:
         self.mode = 'zero-cross'
         self.detection_offset_iden_samples = 2**13
         self.is_verbose = False
+        self.zero_phase_block_size = None
+        self.jobs = 1
 
 # ------------------------------------------------------------------------------
 # correct_bass メイン実装
 # ------------------------------------------------------------------------------
 
-def correct_bass(inputs, parameters):
+# 処理段階の名前（所要時間の表示順）
+STAGE_NAMES = ['monoral & lowpass', 'correct offsets', 'split low / high']
+
+# 結合に使うファイル単位の補正結果（キャッシュや band_store に保持される）
+RESULT_NAMES = ['total_corrected_low', 'total_corrected_high', 'total_corrected_full']
+
+# 結合には使わない途中結果
+INTERMEDIATE_NAMES = ['monoral_sample', 'monoral_lowband_sample', 'click_corrected', 'click_corrected_low', 'click_corrected_high']
+
+def correct_bass_single(input, parameters):
     '''
-    inputs に含まれるキック波形とベース波形に補正をかける。\n
-    補正処理は in-place で行われる。\n
-    \n
-    inputs の形式については correct_bass.py の呼び出し箇所を参照。\n
-    inputs_samplerate には inputs に含まれるサンプル列のサンプルレートを渡す。\n
-    異なるサンプルレートのサンプル列を混ぜて渡すことはできない。\n
+    input １つ分のベース波形に補正をかける。\n
+    補正処理は in-place で行われ、処理段階ごとの所要時間を {段階名: 秒数} で返却する。\n
+    input と parameters については correct_bass() を参照。\n
     '''
-    # TODO verbose モードを実装
+    stage_times = {}
 
     # モノラル波形とそのローパス波形を事前に生成
+    stage_start = time.perf_counter()
     if parameters.is_verbose:
         print('*** create monoral & lowpass samples ***')
-    for i in inputs:
-        if parameters.is_verbose:
-            print('path=' + i['path'])
-        temp = i['stereo']
-        temp = (temp[:, 0] + temp[:, 1]) / 2.0
-        i['monoral_sample'] = temp
-        i['monoral_lowband_sample'] = apply_zplr(temp, 'low', 200, parameters.samplerate)
+        print('path=' + input['path'])
+    temp = input['stereo']
+    temp = (temp[:, 0] + temp[:, 1]) / 2.0
+    input['monoral_sample'] = temp
+    input['monoral_lowband_sample'] = apply_zplr(temp, 'low', 200, parameters.samplerate, parameters.zero_phase_block_size)
+    stage_times['monoral & lowpass'] = time.perf_counter() - stage_start
 
     # TODO パラメータチェック
 
-    if parameters.is_verbose:
-        print('*** convert parameters ***')
-
     # 渡された各パラメータをサンプル数に変換
     head_click_offset_in_samples = nl2sl(parameters.head_click_offset, parameters.bpm, parameters.samplerate)
-    if parameters.is_verbose:
-        print('head_click_offset_in_samples = %d' % head_click_offset_in_samples)
 
     # 検出クリックオフセット（サンプル数単位）を定義
     detection_head_click_offset_in_samples = head_click_offset_in_samples + parameters.detection_offset_in_samples
-    if parameters.is_verbose:
-        print('detection_head_click_offset_in_samples = %d' % detection_head_click_offset_in_samples)
-    
+
     # 波形のクリック位置が最適になるように処理する
+    stage_start = time.perf_counter()
     if parameters.is_verbose:
         print('*** correct offsets ***')
-    for i in inputs:
-        if parameters.is_verbose:
-            print('path=' + i['path'])
-        # 波形から「クリック」位置を検出
-        if parameters.mode == 'zero-cross':
-            detected_click = detect_positive_zero_cross(i['monoral_lowband_sample'])
-        elif parameters.mode == 'extrema':
-            detected_click = detect_positive_extrema(i['monoral_lowband_sample'])
-        else:
-            raise RuntimeError('Unknown mode string : ' + parameters.mode)
-        if parameters.is_verbose:
-            print('detected_click.size=%d' % detected_click.size)
-            print(detected_click)
-        # 波形中の最適クリックオフセットに最も近いクリックを選択
-        actual_head_click_offset = get_nearest_value(detected_click, detection_head_click_offset_in_samples)
-        if parameters.is_verbose:
-            print('detection_head_click_offset_in_samples=%d' % detection_head_click_offset_in_samples)        
-            print('actual_head_click_offset=%d' % actual_head_click_offset)        
-        # オフセットを実行
-        i['click_corrected'] = shift_forward_and_padding(i['stereo'], actual_head_click_offset - head_click_offset_in_samples)
+        print('path=' + input['path'])
+    # 波形から「クリック」位置を検出
+    if parameters.mode == 'zero-cross':
+        detected_click = detect_positive_zero_cross(input['monoral_lowband_sample'])
+    elif parameters.mode == 'extrema':
+        detected_click = detect_positive_extrema(input['monoral_lowband_sample'])
+    else:
+        raise RuntimeError('Unknown mode string : ' + parameters.mode)
+    if parameters.is_verbose:
+        print('detected_click.size=%d' % detected_click.size)
+        print(detected_click)
+    # 波形中の最適クリックオフセットに最も近いクリックを選択
+    actual_head_click_offset = get_nearest_value(detected_click, detection_head_click_offset_in_samples)
+    if parameters.is_verbose:
+        print('detection_head_click_offset_in_samples=%d' % detection_head_click_offset_in_samples)
+        print('actual_head_click_offset=%d' % actual_head_click_offset)
+    # オフセットを実行
+    input['click_corrected'] = shift_forward_and_padding(input['stereo'], actual_head_click_offset - head_click_offset_in_samples)
+    stage_times['correct offsets'] = time.perf_counter() - stage_start
 
     # ローとハイに分離
+    stage_start = time.perf_counter()
     if parameters.is_verbose:
         print('*** split low / high ***')
-    for i in inputs:
-        i['click_corrected_low'] = apply_zplr(i['click_corrected'], 'low', 200, parameters.samplerate)
-        i['click_corrected_high'] = apply_zplr(i['click_corrected'], 'high', 200, parameters.samplerate)
+        print('path=' + input['path'])
+    input['click_corrected_low'] = apply_zplr(input['click_corrected'], 'low', 200, parameters.samplerate, parameters.zero_phase_block_size)
+    input['click_corrected_high'] = apply_zplr(input['click_corrected'], 'high', 200, parameters.samplerate, parameters.zero_phase_block_size)
 
     # 結果に名前をつける
+    input['total_corrected_low'] = input['click_corrected_low']
+    input['total_corrected_high'] = input['click_corrected_high']
+    input['total_corrected_full'] = input['click_corrected_low'] + input['click_corrected_high']
+    stage_times['split low / high'] = time.perf_counter() - stage_start
+
+    # 正常終了
+    return stage_times
+
+def correct_bass_worker(parameters, path):
+    '''
+    プロセスプールのワーカー用。\n
+    path の波形をメモリマップでロードして correct_bass_single() を実行し、結合に必要な結果と処理段階ごとの所要時間だけを返却する。\n
+    サンプルレートと無音のチェックは呼び出し側で済んでいる事。\n
+    '''
+    stereo, _ = load_samples(path, INTERNAL_SAMPLE_FORMAT, mmap=True)
+    input = {'path': path, 'stereo': stereo}
+    stage_times = correct_bass_single(input, parameters)
+    result = {}
+    for key in RESULT_NAMES:
+        result[key] = input[key]
+    return result, stage_times
+
+def store_results(input, store):
+    'input の RESULT_NAMES の補正結果を (path, 名前) をキーとして store （ band_store ）に移し、途中結果を破棄する'
+    for name in RESULT_NAMES:
+        store.put((input['path'], name), input.pop(name))
+    for name in INTERMEDIATE_NAMES:
+        input.pop(name, None)
+
+def correct_bass(inputs, parameters, store=None):
+    '''
+    inputs に含まれるキック波形とベース波形に補正をかける。\n
+    補正処理は in-place で行われる。\n
+    \n
+    inputs の形式については correct_bass.py の呼び出し箇所を参照。\n
+    inputs_samplerate には inputs に含まれるサンプル列のサンプルレートを渡す。\n
+    異なるサンプルレートのサンプル列を混ぜて渡すことはできない。\n
+    \n
+    parameters.jobs が 2 以上の時はファイル単位でプロセスプールに分配して並列に処理する。\n
+    この場合 inputs に書き戻されるのは total_corrected_low/high/full のみ。\n
+    ワーカーには path だけを渡し、波形はワーカー側でメモリマップとしてロードしなおす。\n
+    結果は完了した順に inputs の対応する要素に書き戻される。\n
+    \n
+    store （ band_store ）を指定した場合、 RESULT_NAMES の補正結果はファイルごとに補正した直後に store に移され、\n
+    途中結果は破棄される。\n
+    '''
+    # TODO verbose モードを実装
+
+    # ファイル単位で補正
+    per_file_stage_times = []
+    if parameters.jobs <= 1:
+        for i in inputs:
+            per_file_stage_times.append(correct_bass_single(i, parameters))
+            if store is not None:
+                store_results(i, store)
+    else:
+        # note 結果は完了した順に受け取ってすぐ store に移す（全ファイルの結果を同時に保持しない）
+        results = imap_unordered_in_process_pool(partial(correct_bass_worker, parameters), [i['path'] for i in inputs], parameters.jobs)
+        for index, (result, stage_times) in results:
+            i = inputs[index]
+            i.update(result)
+            if store is not None:
+                store_results(i, store)
+            per_file_stage_times.append(stage_times)
     if parameters.is_verbose:
-        print('*** save results ***')
-    for i in inputs:
-        i['total_corrected_low'] = i['click_corrected_low']
-        i['total_corrected_high'] = i['click_corrected_high']
-        i['total_corrected_full'] = i['click_corrected_low'] + i['click_corrected_high']
+        print_filter_cache_info()
+
+    # 処理段階ごとの所要時間（全ファイルの合計）を表示
+    for name in STAGE_NAMES:
+        print('stage "%s" : %.3f sec' % (name, sum([t[name] for t in per_file_stage_times])))
 
     # 正常終了
     return False
 
+def correct_bass_incremental(wav_files, parameters, cache, store):
+    '''
+    wav_files のうち波形データか補正パラメータが変わったファイルだけ correct_bass() で補正する。\n
+    ファイル単位の補正結果は cache （ result_cache ）に保存され、変わっていないファイルはそこから読み込まれる。\n
+    補正結果は全て cache のメモリマップとして store （ band_store ）に (path, 名前) をキーとして格納される。\n
+    戻り値は path を持つ dict の wav_files 順のリスト。無音ファイルは含まれない。
+    '''
+    parameter_hash = hash_parameters(parameters.samplerate, parameters.bpm, parameters.head_click_offset, parameters.mode, parameters.detection_offset_in_samples, parameters.zero_phase_block_size, INTERNAL_SAMPLE_FORMAT)
+    keys = [cache.key(hash_wav_file(p), parameter_hash) for p in wav_files]
+    entries = [cache.load(k) for k in keys]
+
+    # キャッシュにないファイルだけ補正
+    missed_files = [p for p, entry in zip(wav_files, entries) if entry is None]
+    if 0 < len(missed_files):
+        missed_inputs, samplerate = load_wav_files(missed_files, INTERNAL_SAMPLE_FORMAT, mmap=True)
+        if samplerate != 0 and samplerate != parameters.samplerate:
+            raise RuntimeError('Wrong sample rate is detected in input files.')
+        if correct_bass(missed_inputs, parameters, store):
+            raise RuntimeError('Some error has occured.')
+        corrected = set([i['path'] for i in missed_inputs])
+        for index, p in enumerate(wav_files):
+            if entries[index] is None:
+                # 無音ファイルは空のエントリとして記録
+                cache.save(keys[index], {name: store.get((p, name)) for name in RESULT_NAMES} if p in corrected else {})
+                entries[index] = cache.load(keys[index])
+    cache.prune(keys)
+    print('%d of %d files are reused from cache.' % (len(wav_files) - len(missed_files), len(wav_files)))
+
+    inputs = []
+    for p, entry in zip(wav_files, entries):
+        if 0 < len(entry):
+            for name in RESULT_NAMES:
+                store.put((p, name), entry[name])
+            inputs.append({'path': p})
+    return inputs
+
 # ------------------------------------------------------------------------------
 # main
 # ------------------------------------------------------------------------------
 
 def print_usage():
     'このプログラムの使い方を表示'
-    print('Usage : python correct_bass.py <direcyory path>')
+    print('Usage : python correct_bass.py [--jobs N] [--ram-ceiling MiB] [--incremental[=<cache dir>]] [--watch[=<interval>]] <direcyory path>')
     print('<directory path> must be directory that contain ".wav" file and config ".ini" file.')
     print('Directory allow to contain multiple ".wav" files.')
     print('Directory allow to contain single ".ini" file.')
+    print('--jobs N corrects N files in parallel.')
+    print('--ram-ceiling MiB spills corrected samples exceeding MiB in memory to scratch files (default %d MiB).' % (STORE_RAM_CEILING // 2 ** 20))
+    print('--incremental reuses cached results of unchanged files (default cache is "%s" in the directory).' % RESULT_CACHE_DIR_NAME)
+    print('--watch processes incrementally and then reprocesses whenever the directory is changed.')
 
-if __name__ == '__main__':
-    # 引数のエイリアスを作る
-    INPUT_PATHS = sys.argv[1:]
-    # 引数の数のチェック
-    if len(INPUT_PATHS)!=1:
-        print_usage()
-        exit(1)
-    # 非ディレクトリ指定は NG
-    if not os.path.isdir(INPUT_PATHS[0]):
-        print('(error) : In usage2, specified path is not directory. "%s".' % INPUT_PATHS[0])
-    # 更にエイリアス
-    INPUT_DIR = INPUT_PATHS[0]
-
+def correct_bass_directory(input_dir, jobs, cache, ram_ceiling=STORE_RAM_CEILING):
+    '''
+    input_dir のベース波形を補正して結合したものを保存し、終了コードを返却する。\n
+    cache （ result_cache ）を指定した場合は変更されたファイルだけ補正する。\n
+    ファイル単位の補正結果は band_store に保持され、メモリ上の合計が ram_ceiling バイトを超えた分はディスクに退避される。
+    '''
     # 指定ディレクトリ中の wav ファイルを列挙
-    WAV_FILES = find_wav_files(INPUT_DIR)
+    WAV_FILES = find_wav_files(input_dir)
     if WAV_FILES is None:
-        exit(1)
+        return 1
 
     # 指定ファイル全てメモリ上にロード
-    INPUTS, SAMPLERATE = load_wav_files(WAV_FILES, INTERNAL_SAMPLE_FORMAT)
+    if cache is None:
+        INPUTS, SAMPLERATE = load_wav_files(WAV_FILES, INTERNAL_SAMPLE_FORMAT, mmap=True)
+    else:
+        SAMPLERATE, _, _ = query_wav_info(WAV_FILES[0])
 
     # 指定ディレクトリ中の ini ファイルを列挙
-    INI_FILE = find_ini_file(INPUT_DIR)
+    INI_FILE = find_ini_file(input_dir)
     if INI_FILE is None:
-        exit(1)
+        return 1
 
     # 補正処理の挙動を設定ファイルから読み込み
     config = configparser.ConfigParser()
     config.read(INI_FILE)
     parameters = correct_bass_parameters()
     parameters.samplerate = SAMPLERATE
+    parameters.jobs = jobs
     parameters.bpm = int(config['specific']['bpm'])
     parameters.head_click_offset = Fraction(config['specific']['head_click_offset'])
     parameters.mode = config['specific']['mode']
     parameters.detection_offset_in_samples = int(config['empirical']['detection_offset_in_samples'])
     parameters.is_verbose = bool(config['empirical']['is_verbose'])
+    if 'zero_phase_block_size' in config['empirical']:
+        parameters.zero_phase_block_size = int(config['empirical']['zero_phase_block_size'])
 
     # 補正処理呼び出し
-    if correct_bass(INPUTS, parameters):
-        print('(error) : Some error has occured.')
-        exit(1)
-
-    # 補正結果を１つの波形に結合
-    composed_low = numpy.empty((0, 2), INTERNAL_SAMPLE_FORMAT)
-    composed_high = numpy.empty((0, 2), INTERNAL_SAMPLE_FORMAT)
-    composed_full = numpy.empty((0, 2), INTERNAL_SAMPLE_FORMAT)
-    for i in INPUTS:
-        composed_low = numpy.r_[composed_low, i['total_corrected_low']]
-        composed_high = numpy.r_[composed_high, i['total_corrected_high']]
-        composed_full = numpy.r_[composed_full, i['total_corrected_full']]
-
-    # 補正をかけたベース波形を出力
-    directory, _, extension = decompose_path(INPUTS[0]['path'])
-    output_path_low = compose_path(directory, OUTPUT_FILE_PREFIX + 'output_low', extension)
-    output_path_high = compose_path(directory, OUTPUT_FILE_PREFIX + 'output_high', extension)
-    output_path_full = compose_path(directory, OUTPUT_FILE_PREFIX + 'output_full', extension)
-    make_directory_exist(output_path_low)
-    make_directory_exist(output_path_high)
-    make_directory_exist(output_path_full)
-    save_samples(output_path_low, composed_low, SAMPLERATE, EXPORT_SAMPLE_FORMAT)
-    save_samples(output_path_high, composed_high, SAMPLERATE, EXPORT_SAMPLE_FORMAT)
-    save_samples(output_path_full, composed_full, SAMPLERATE, EXPORT_SAMPLE_FORMAT)
+    with band_store(ram_ceiling) as STORE:
+        if cache is None:
+            if correct_bass(INPUTS, parameters, STORE):
+                print('(error) : Some error has occured.')
+                return 1
+        else:
+            try:
+                INPUTS = correct_bass_incremental(WAV_FILES, parameters, cache, STORE)
+            except RuntimeError as err:
+                print('(error) : %s' % err)
+                return 1
+        if 0 < STORE.spill_count:
+            print('%d corrected samples are spilled to "%s".' % (STORE.spill_count, STORE.scratch_dir))
+
+        # 補正をかけたベース波形をファイルごとに順に追記して１つの波形に結合して出力
+        directory, _, extension = decompose_path(INPUTS[0]['path'])
+        channels = STORE.get((INPUTS[0]['path'], RESULT_NAMES[0])).shape[1]
+        with contextlib.ExitStack() as stack:
+            writers = {}
+            for name, output_name in zip(RESULT_NAMES, ['output_low', 'output_high', 'output_full']):
+                writers[name] = stack.enter_context(wav_stream_writer(compose_path(directory, OUTPUT_FILE_PREFIX + output_name, extension), SAMPLERATE, channels, EXPORT_SAMPLE_FORMAT))
+            for i in INPUTS:
+                for name in RESULT_NAMES:
+                    writers[name].write(STORE.get((i['path'], name)))
 
     # 正常終了
-    exit(0)
+    return 0
+
+def main(argv):
+    '''
+    argv で指定されたディレクトリのベース波形を補正し、終了コードを返却する。\n
+    --watch の指定がある場合は中断されるまで戻らない。
+    '''
+    # 引数のエイリアスを作る
+    try:
+        JOBS, INPUT_PATHS = parse_jobs_option(argv)
+        CACHE_DIR, INTERVAL, INPUT_PATHS = parse_incremental_option(INPUT_PATHS)
+        RAM_CEILING, INPUT_PATHS = parse_ram_ceiling_option(INPUT_PATHS)
+    except RuntimeError as err:
+        print(err)
+        print_usage()
+        return 1
+    # 引数の数のチェック
+    if len(INPUT_PATHS)!=1:
+        print_usage()
+        return 1
+    # 非ディレクトリ指定は NG
+    if not os.path.isdir(INPUT_PATHS[0]):
+        print('(error) : In usage2, specified path is not directory. "%s".' % INPUT_PATHS[0])
+    # 更にエイリアス
+    INPUT_DIR = INPUT_PATHS[0]
+
+    # 補正、監視モードの場合は変更のたびに補正
+    run = partial(correct_bass_directory, INPUT_DIR, JOBS, open_result_cache(CACHE_DIR, INPUT_DIR, 'correct_bass'), RAM_CEILING)
+    if INTERVAL is None:
+        return run()
+    return watch_directory(INPUT_DIR, run, INTERVAL)
+
+if __name__ == '__main__':
+    exit(run_tool(main, sys.argv[1:]))
@@ -5,7 +5,6 @@ from fractions import Fraction
 import configparser
 
 import numpy
-from scipy import signal
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
@@ -31,6 +30,8 @@ class correct_kick_parameters:
         self.snap_offset = Fraction(0, 1)
         self.mode = 'zero-cross'
         self.is_verbose = False
+        self.resample_engine = 'fft'
+        self.resample_quality = 'medium'
 
 # ------------------------------------------------------------------------------
 # correct_kick メイン実装
@@ -77,7 +78,9 @@ def correct_kick(input, parameters):
     source_offset_in_samples = detected_points[sanpe_offset_in_samples < detected_points][0]
 
     # リサンプル実行
-    input['corrected'] = signal.resample(input['stereo'], int(len(input['monoral_sample']) * sanpe_offset_in_samples / source_offset_in_samples))
+    if parameters.is_verbose:
+        print('resample engine = %s, quality = %s' % (parameters.resample_engine, parameters.resample_quality))
+    input['corrected'] = resample_samples(input['stereo'], int(len(input['monoral_sample']) * sanpe_offset_in_samples / source_offset_in_samples), parameters.resample_engine, parameters.resample_quality)
 
     # 正常終了
     return
@@ -89,14 +92,19 @@ def correct_kick(input, parameters):
 def print_usage():
     'このプログラムの使い方を表示'
     print('Usage : python correct_bass.py <ini file path> <wav file path>')
+    print('Add "--daemon[=<socket path>]" to keep serving jobs, "--connect <socket path>" to send this job to it.')
 
-if __name__ == '__main__':
+def main(argv):
+    '''
+    argv （ ini ファイルと wav ファイルのパス）のキック波形を補正して保存し、終了コードを返却する。\n
+    run_tool() の常駐モードではジョブごとに呼ばれる。
+    '''
     # 引数のエイリアスを作る
-    INPUT_PATHS = sys.argv[1:]
+    INPUT_PATHS = argv
     # 引数の数のチェック
     if len(INPUT_PATHS)!=2:
         print_usage()
-        exit(1)
+        return 1
     # ディレクトリ指定は NG
     if os.path.isdir(INPUT_PATHS[0]):
         print('(error) : specified path is directory. "%s".' % INPUT_PATHS[0])
@@ -111,7 +119,7 @@ if __name__ == '__main__':
         INPUT_INI_FILE = INPUT_PATHS[0]        
 
     # wav ファイルをメモリ上にロード
-    INPUTS, SAMPLERATE = load_wav_files([INPUT_WAV_FILES], INTERNAL_SAMPLE_FORMAT)
+    INPUTS, SAMPLERATE = load_wav_files([INPUT_WAV_FILES], INTERNAL_SAMPLE_FORMAT, mmap=True)
     INPUT = INPUTS[0]
 
     # 補正処理の挙動を設定ファイルから読み込み
@@ -123,6 +131,16 @@ if __name__ == '__main__':
     parameters.snap_offset = Fraction(config['specific']['snap_offset'])
     parameters.mode = config['specific']['mode']
     parameters.is_verbose = bool(config['empirical']['is_verbose'])
+    if 'resample_engine' in config['empirical']:
+        parameters.resample_engine = config['empirical']['resample_engine']
+    if 'resample_quality' in config['empirical']:
+        parameters.resample_quality = config['empirical']['resample_quality']
+    if parameters.resample_engine not in ['fft', 'poly']:
+        print('Invalid resample_engine in loaded .ini file. "%s".' % parameters.resample_engine)
+        return 1
+    if parameters.resample_quality not in RESAMPLE_QUALITIES:
+        print('Invalid resample_quality in loaded .ini file. "%s".' % parameters.resample_quality)
+        return 1
 
     # 補正処理呼び出し
     correct_kick(INPUT, parameters)
@@ -134,4 +152,7 @@ if __name__ == '__main__':
     save_samples(output_path, INPUT['corrected'], SAMPLERATE, EXPORT_SAMPLE_FORMAT)
 
     # 正常終了
-    exit(0)
+    return 0
+
+if __name__ == '__main__':
+    exit(run_tool(main, sys.argv[1:]))
@@ -1,5 +1,7 @@
 import os
 import sys
+import glob
+from functools import partial
 
 import numpy
 
@@ -15,46 +17,93 @@ OUTPUT_FILE_PREFIX = 'output\\'
 # 出力ファイル名に付属する番号の桁数
 FILESTEM_NUMBER_OF_DIGIT = 3
 
+# １ファイル分のストリーミング処理の作業メモリ量が (ブロック長＋カーネル長) × チャンネル数のサンプル列何本分か
+# note ２段のゼロ位相フィルタの FFT 作業領域・スペクトル・はみ出し分と読み書きのブロックを tracemalloc で測ると約５本分
+STREAM_MEMORY_FACTOR = 8
+
+# ------------------------------------------------------------------------------
+# cutoff_extreme_band メイン実装
+# ------------------------------------------------------------------------------
+
+def compose_output_path(path):
+    '入力ファイル path に対応する出力ファイルのパス'
+    directory, stem, extension = decompose_path(path)
+    return compose_path(directory, OUTPUT_FILE_PREFIX + pad_stem_zero(stem, FILESTEM_NUMBER_OF_DIGIT), extension)
+
+def estimate_stream_memory(path, block_size):
+    '''
+    path の wav ファイルを cutoff_extreme_band_file() で処理する時の作業メモリ量（バイト）を推定する。\n
+    ファイル長には依存せず、サンプルレート（カーネル長）とチャンネル数で決まる。
+    '''
+    sample_rate, _, channels = query_wav_info(path)
+    kernel_length = 2 * design_impulse_length('butter', 'high', EXTREME_BAND_FILTER_ORDER, EXTREME_LOW_CUTOFF, sample_rate)
+    return STREAM_MEMORY_FACTOR * (block_size + kernel_length) * channels * numpy.dtype(INTERNAL_SAMPLE_FORMAT).itemsize
+
+def cutoff_extreme_band_file(block_size, path):
+    '''
+    path の wav ファイルをブロック単位で読みながら ultra-low と ultra-high を除去し、 compose_output_path() に書き出す。\n
+    ファイル全体はメモリ上にロードされない。プロセスプールのワーカーとしても使う。\n
+    出力ファイルのパスを返却する。
+    '''
+    output_path = compose_output_path(path)
+    _, _, channels = query_wav_info(path)
+    blocks, sample_rate = load_samples_blocks(path, INTERNAL_SAMPLE_FORMAT, block_size)
+    with wav_stream_writer(output_path, sample_rate, channels, EXPORT_SAMPLE_FORMAT) as writer:
+        for block in filter_blocks(create_extreme_band_filter(sample_rate), blocks):
+            writer.write(block)
+    return output_path
+
 # ------------------------------------------------------------------------------
 # main
 # ------------------------------------------------------------------------------
 
 def print_usage():
     'このプログラムの使い方を表示'
-    print('Usage1 : python cutoff_extreme_band.py <sample>.wav <sample_1>.wav ... <sample_N>.wav')
-    print('Usage2 : python correct_bass.py <direcyory path>')
+    print('Usage1 : python cutoff_extreme_band.py [--jobs N] [--memory-budget MiB] <sample>.wav <sample_1>.wav ... <sample_N>.wav')
+    print('Usage2 : python cutoff_extreme_band.py [--jobs N] [--memory-budget MiB] <direcyory path>')
+    print('--jobs N processes N files in parallel while estimated working memory of running files is within --memory-budget (default %d MiB).' % (POOL_MEMORY_BUDGET // 2 ** 20))
+    print('Add "--daemon" to serve jobs from stdin JSON lines, "--daemon=<socket path>" to serve on a UNIX socket,')
+    print('or "--connect <socket path>" to run the job in a serving process.')
 
-if __name__ == '__main__':
+def main(argv):
+    '''
+    コマンドライン引数 argv （プログラム名を除く）で処理を実行し、終了コードを返却する。\n
+    常駐モードから繰り返し呼ばれるので exit() せずに return する事。
+    '''
     # 引数のエイリアスを作る
-    INPUT_PATHS = sys.argv[1:]
+    try:
+        JOBS, INPUT_PATHS = parse_jobs_option(argv)
+        MEMORY_BUDGET, INPUT_PATHS = parse_memory_budget_option(INPUT_PATHS)
+    except RuntimeError as err:
+        print(err)
+        print_usage()
+        return 1
 
     # 引数チェック
     if len(INPUT_PATHS) < 1:
         print_usage()
-        exit(1)
+        return 1
 
     # ディレクトリ指定の場合は中身を探索して引数を作る
     if os.path.isdir(INPUT_PATHS[0]):
         INPUT_DIR = INPUT_PATHS[0]
-        INPUT_PATHS = glob.glob(os.path.join(INPUT_DIR, '*.wav'))
+        INPUT_PATHS = sorted(glob.glob(os.path.join(INPUT_DIR, '*.wav')))
 
-    # 順番に処理かけて保存する
+    # 存在チェック
     for i in INPUT_PATHS:
-        # サンプル列をファイルからロード
-        try:
-            TEMP_INPUT, TEMP_SAMPLE_RATE = load_samples(i, INTERNAL_SAMPLE_FORMAT)
-        except Exception as err:
-            print(err)
+        if not os.path.exists(i):
+            print('Specified file "%s" has not existed.' % i)
             print_usage()
-            raise
+            return 1
 
-        # ultra-low と ultra-high を除去
-        TEMP_INPUT = cutoff_extreme_band(TEMP_INPUT, TEMP_SAMPLE_RATE)
-
-        # サンプル列をファイルにセーブ
-        directory, stem, extension = decompose_path(i)
-        output_path = compose_path(directory, OUTPUT_FILE_PREFIX + pad_stem_zero(stem, FILESTEM_NUMBER_OF_DIGIT), extension)
-        save_samples(output_path, TEMP_INPUT, TEMP_SAMPLE_RATE, EXPORT_SAMPLE_FORMAT)
+    # 作業メモリ量の推定値の合計が上限を超えない範囲で並列に処理して保存する
+    COSTS = [estimate_stream_memory(i, STREAM_BLOCK_SIZE) for i in INPUT_PATHS]
+    OUTPUT_PATHS = map_in_process_pool_bounded(partial(cutoff_extreme_band_file, STREAM_BLOCK_SIZE), INPUT_PATHS, COSTS, JOBS, MEMORY_BUDGET)
+    for i, o in zip(INPUT_PATHS, OUTPUT_PATHS):
+        print('"%s" -> "%s"' % (i, o))
 
     # 正常終了
-    exit(0)
+    return 0
+
+if __name__ == '__main__':
+    exit(run_tool(main, sys.argv[1:]))
@@ -1,4 +1,10 @@
+from .band_functions import *
+from .cache_functions import *
+from .cutoff_functions import *
+from .daemon_functions import *
 from .file_functions import *
 from .filter_functions import *
 from .helper_functions import *
+from .parallel_functions import *
 from .samples_functions import *
+from .store_functions import *
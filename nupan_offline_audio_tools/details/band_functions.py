@@ -0,0 +1,224 @@
+import collections
+import functools
+
+import numpy
+
+from .filter_functions import *
+
+# ------------------------------------------------------------------------------
+# functions
+# ------------------------------------------------------------------------------
+
+def create_block_filter(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate, is_zero_phase):
+    '''
+    apply_filter() と同じ引数からブロックフィルタを生成する。\n
+    不明な filter_type の場合は RuntimeError を送出する。
+    '''
+    if is_zero_phase:
+        return zero_phase_streaming_filter(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate)
+    return streaming_filter(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate)
+
+def _take_samples(pending, length):
+    'キュー pending に積まれたブロックの先頭から length サンプルを取り出す'
+    parts = []
+    while 0 < length:
+        head = pending[0]
+        if head.shape[0] <= length:
+            parts.append(pending.popleft())
+            length -= head.shape[0]
+        else:
+            parts.append(head[:length])
+            pending[0] = head[length:]
+            length = 0
+    return parts[0] if len(parts) == 1 else numpy.concatenate(parts)
+
+def _split_serial_stage(chain, residual_blocks, emit):
+    '''
+    直列接続の１段分を処理するジェネレータ。\n
+    残差ブロック residual_blocks を chain に通した結果を emit(結果ブロック) に渡し、次段への残差ブロックを返す。\n
+    フィルタの遅延分だけ残差ブロックをキューに保持して出力と位置を揃える。
+    '''
+    pending = collections.deque()
+    def recorded_blocks():
+        for block in residual_blocks:
+            pending.append(block)
+            yield block
+    for result in filter_blocks(chain, recorded_blocks()):
+        emit(result)
+        yield _take_samples(pending, result.shape[0]) - result
+
+def _split_bands_whole(samples, band_filter_specs, sample_rate, is_serial):
+    '''
+    split_bands() の一括処理版。\n
+    バンドごとに apply_filter() を適用するが、入力のコピーは作らず残差は in-place で更新する。
+    '''
+    residual = samples
+    bands = []
+    for index, specs in enumerate(band_filter_specs):
+        # バンド抽出
+        band = residual
+        for filter_type, filter_mode, filter_order, cutoff_frequency, is_zero_phase in specs:
+            band = apply_filter(band, filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate, is_zero_phase)
+            if band is None:
+                raise RuntimeError('Unknown filter_type : ' + filter_type)
+        if band is residual:
+            band = numpy.array(residual)
+        bands.append(band)
+        # 抽出した分を残差から減算、最後のバンドの後は不要
+        if is_serial and index < len(band_filter_specs) - 1:
+            if residual is samples:
+                residual = samples - band
+            else:
+                residual -= band
+    return bands
+
+def split_bands_blocks(blocks, band_filter_specs, sample_rate, is_serial):
+    '''
+    split_bands() のストリーミング版ジェネレータ。\n
+    ブロックを返すイテラブル blocks を一度だけ読んで全バンドのフィルタに通し、\n
+    長さを揃えたバンドごとのブロックのリストを順に返す。引数は split_bands() を参照。\n
+    バンド間の遅延の違いを吸収するために保持するのはカーネル長程度なので、使用メモリ量は入力長に依存しない。
+    '''
+    chains = [filter_chain([create_block_filter(*spec[:4], sample_rate, spec[4]) for spec in specs]) for specs in band_filter_specs]
+    if len(chains) == 0:
+        return
+    pending = [collections.deque() for _ in chains]
+    available = [0] * len(chains)
+    def emit(index, result):
+        if 0 < result.shape[0]:
+            pending[index].append(result)
+            available[index] += result.shape[0]
+    def take_aligned():
+        # 全バンドで揃っている分だけ取り出す
+        length = min(available)
+        if length == 0:
+            return None
+        for index in range(len(chains)):
+            available[index] -= length
+        return [_take_samples(p, length) for p in pending]
+    if is_serial:
+        # 各段の残差ブロックを次段に流すジェネレータを繋ぎ、最後の段を駆動する
+        residual_blocks = blocks
+        for index, chain in enumerate(chains[:-1]):
+            residual_blocks = _split_serial_stage(chain, residual_blocks, functools.partial(emit, index))
+        for result in filter_blocks(chains[-1], residual_blocks):
+            emit(len(chains) - 1, result)
+            aligned = take_aligned()
+            if aligned is not None:
+                yield aligned
+    else:
+        # 入力ブロックごとに全バンドのフィルタに通す
+        for chain in chains:
+            chain.reset()
+        for block in blocks:
+            for index, chain in enumerate(chains):
+                emit(index, chain.process(block))
+            aligned = take_aligned()
+            if aligned is not None:
+                yield aligned
+        for index, chain in enumerate(chains):
+            emit(index, chain.flush())
+    aligned = take_aligned()
+    if aligned is not None:
+        yield aligned
+
+def _split_bands_blocks(samples, band_filter_specs, sample_rate, is_serial, block_size):
+    '''
+    split_bands() のブロック処理版。\n
+    split_bands_blocks() の結果をバンド配列に直接書き込む。\n
+    バンド配列以外の使用メモリ量はブロック長とフィルタのカーネル長に依存し、入力長に依存しない。
+    '''
+    bands = [numpy.empty(samples.shape, samples.dtype) for _ in band_filter_specs]
+    source_blocks = (samples[i:i+block_size] for i in range(0, samples.shape[0], block_size))
+    offset = 0
+    for band_blocks in split_bands_blocks(source_blocks, band_filter_specs, sample_rate, is_serial):
+        length = band_blocks[0].shape[0]
+        for band, block in zip(bands, band_blocks):
+            band[offset:offset+length] = block
+        offset += length
+    return bands
+
+def _split_bands_fft_length(length, band_filter_specs, sample_rate):
+    '_split_bands_fft() の変換長、回り込み防止に全フィルタのインパルス応答長の合計（ゼロ位相フィルタは前後に広がるので２倍）だけ伸ばす'
+    import scipy.fft
+    padding = 0
+    for specs in band_filter_specs:
+        for filter_type, filter_mode, filter_order, cutoff_frequency, is_zero_phase in specs:
+            impulse_length = design_impulse_length(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate)
+            padding += impulse_length * 2 if is_zero_phase else impulse_length
+    return scipy.fft.next_fast_len(length + padding, real=True)
+
+def _split_bands_fft(samples, band_filter_specs, sample_rate, is_serial):
+    '''
+    split_bands() の FFT 版。\n
+    入力を一度だけ rfft し、バンドごとに合成した周波数応答を掛けて irfft する。\n
+    ゼロ位相フィルタは |H|^2 、因果的フィルタは H を掛ける。\n
+    直列接続の残差も周波数領域で計算するので、 k 番目のバンドの応答は G_k * (1 - G_0) * ... * (1 - G_k-1) となる。\n
+    循環畳み込みの回り込みを避けるため、全フィルタのインパルス応答長の合計だけゼロを詰めて変換する。\n
+    単精度の入力は単精度の FFT で変換し、応答も単精度にして掛ける。
+    '''
+    # note scipy.fft は起動時間に影響するので使う時だけ読み込む
+    import scipy.fft
+    length = samples.shape[0]
+    fft_length = _split_bands_fft_length(length, band_filter_specs, sample_rate)
+    broadcast_shape = (-1,) + (1,) * (samples.ndim - 1)
+    spectrum = scipy.fft.rfft(samples, fft_length, axis=0)
+    # バンドごとに応答を合成して逆変換
+    residual_response = numpy.ones(spectrum.shape[0])
+    bands = []
+    for specs in band_filter_specs:
+        response = numpy.ones(spectrum.shape[0])
+        for filter_type, filter_mode, filter_order, cutoff_frequency, is_zero_phase in specs:
+            response = response * design_frequency_response(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate, is_zero_phase, fft_length)
+        band_response = response * residual_response
+        if is_serial:
+            residual_response = residual_response * (1.0 - response)
+        if samples.dtype == numpy.float32:
+            band_response = band_response.astype(numpy.complex64 if numpy.iscomplexobj(band_response) else numpy.float32)
+        bands.append(scipy.fft.irfft(spectrum * band_response.reshape(broadcast_shape), fft_length, axis=0, overwrite_x=True)[:length])
+    return bands
+
+def split_bands(samples, band_filter_specs, sample_rate, is_serial, block_size=None, engine='iir'):
+    '''
+    samples をバンド分離してバンドごとのサンプル列のリストを返却する。\n
+    - band_filter_specs : バンドごとのフィルタ指定のリスト。\n
+      各バンドは (filter_type, filter_mode, filter_order, cutoff_frequency, is_zero_phase) のリストで、順に適用される。\n
+      空のリストを指定したバンドは入力（残差）そのものとなる。
+    - is_serial : True の時、各バンドは前のバンドまでを入力から減算した残差から抽出される。
+    - block_size : 指定した場合は入力を一度だけ読むブロック処理で全バンドを計算する。\n
+      ゼロ位相フィルタは zero_phase_streaming_filter になるが、端点を含めて一括処理と一致する。
+    - engine : 'iir' の時はフィルタを時間領域で適用する。\n
+      'fft' の時は入力全体の rfft に周波数応答を掛けて計算する（ block_size は無視される）。\n
+      前後をゼロ埋めとして扱うので、区間中央は一括処理と一致するが、先頭・末尾のインパルス応答長の範囲は filtfilt の端点処理と異なる。
+    '''
+    if engine == 'fft':
+        return _split_bands_fft(samples, band_filter_specs, sample_rate, is_serial)
+    if engine != 'iir':
+        raise RuntimeError('Unknown engine : ' + engine)
+    if block_size is None:
+        return _split_bands_whole(samples, band_filter_specs, sample_rate, is_serial)
+    return _split_bands_blocks(samples, band_filter_specs, sample_rate, is_serial, block_size)
+
+def estimate_split_bands_allocation(samples, band_filter_specs, sample_rate, is_serial, block_size=None, engine='iir'):
+    '''
+    split_bands() を同じ引数で呼んだ時に確保されるメモリのピーク量（バイト数）の概算を返却する。\n
+    バンド波形に加えて、一括処理は倍精度で計算するフィルタの作業領域２本分と直列接続の残差、\n
+    ブロック処理はバンドごとのフィルタの作業領域３ブロック分（順方向の倍精度出力・スペクトル・逆変換）と揃える前のブロック、\n
+    FFT 版はスペクトルと積・逆変換の作業領域を数える（ FFT 版のバンド波形は変換長の配列のビューになる）。\n
+    フィルタ係数や内部状態など、入力長とブロック長に依存しないものは数えない。
+    '''
+    length = samples.shape[0]
+    channels = int(numpy.prod(samples.shape[1:], dtype=numpy.int64))
+    frame_bytes = samples.dtype.itemsize * channels
+    float64_frame_bytes = numpy.dtype(numpy.float64).itemsize * channels
+    band_count = len(band_filter_specs)
+    if engine == 'fft':
+        fft_length = _split_bands_fft_length(length, band_filter_specs, sample_rate)
+        spectrum_bytes = (fft_length // 2 + 1) * frame_bytes * 2
+        return band_count * fft_length * frame_bytes + 4 * spectrum_bytes
+    bands_bytes = band_count * length * frame_bytes
+    if block_size is None:
+        residual_bytes = length * frame_bytes if is_serial and 1 < band_count else 0
+        return bands_bytes + 2 * length * float64_frame_bytes + residual_bytes
+    block_length = min(block_size, length)
+    return bands_bytes + (band_count + 1) * block_length * frame_bytes + band_count * block_length * (float64_frame_bytes + 2 * frame_bytes)
@@ -0,0 +1,170 @@
+import glob
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+
+import numpy
+
+from .default_constants import *
+from .file_functions import _load_raw_samples
+
+# ------------------------------------------------------------------------------
+# constants
+# ------------------------------------------------------------------------------
+
+# キャッシュの形式を変えた時に古いエントリを無効にするための版数（キーに含まれる）
+_RESULT_CACHE_VERSION = 1
+
+# ------------------------------------------------------------------------------
+# classes
+# ------------------------------------------------------------------------------
+
+class result_cache:
+    '''
+    ファイル単位の途中結果をキーごとにディスクに保存するキャッシュ。\n
+    エントリは {名前: numpy 配列またはスカラー} で、 cache_dir/<キー>/<名前>.npy として保存される。\n
+    配列は読み取り専用のメモリマップとしてロードされるので、大きなバンド波形でもメモリを消費しない。
+    '''
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, *hashes):
+        'hash_wav_file() 、 hash_parameters() などのハッシュ値を結合したキーを返却する'
+        return hash_parameters(_RESULT_CACHE_VERSION, *hashes)
+
+    def load(self, key):
+        '''
+        キー key のエントリを返却する。存在しない場合は None を返却する。\n
+        ０次元の配列は Python のスカラーに戻される。
+        '''
+        entry_dir = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(entry_dir):
+            self.misses += 1
+            return None
+        self.hits += 1
+        entry = {}
+        for path in glob.glob(os.path.join(entry_dir, '*.npy')):
+            value = numpy.load(path, mmap_mode='r')
+            entry[os.path.splitext(os.path.basename(path))[0]] = value.item() if value.ndim == 0 else value
+        return entry
+
+    def save(self, key, entry):
+        '''
+        エントリ entry をキー key で保存する。\n
+        一時ディレクトリに書き出してから名前を変えるので、中断されても壊れたエントリは残らない。
+        '''
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temp_dir = tempfile.mkdtemp(prefix='.' + key, dir=self.cache_dir)
+        for name, value in entry.items():
+            numpy.save(os.path.join(temp_dir, name + '.npy'), numpy.asarray(value))
+        entry_dir = os.path.join(self.cache_dir, key)
+        shutil.rmtree(entry_dir, ignore_errors=True)
+        os.replace(temp_dir, entry_dir)
+
+    def prune(self, keep_keys):
+        'keep_keys 以外のエントリを削除する、今回使われなかった古い結果の掃除用'
+        if not os.path.isdir(self.cache_dir):
+            return
+        keep_keys = set(keep_keys)
+        for name in os.listdir(self.cache_dir):
+            if name not in keep_keys:
+                shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+
+# ------------------------------------------------------------------------------
+# functions
+# ------------------------------------------------------------------------------
+
+def hash_wav_file(samples_path, block_size=STREAM_BLOCK_SIZE):
+    '''
+    wav ファイルの波形データ（サンプルレート・フォーマット・形状を含む）のハッシュ値を返却する。\n
+    ヘッダの付属情報やタイムスタンプには依存しない。\n
+    ファイルはメモリマップして block_size サンプルずつ読むので、使用メモリ量はファイル長に依存しない。
+    '''
+    sample_rate, raw_samples = _load_raw_samples(samples_path)
+    hasher = hashlib.blake2b(digest_size=20)
+    hasher.update(repr((sample_rate, raw_samples.dtype.str, raw_samples.shape)).encode())
+    for offset in range(0, raw_samples.shape[0], block_size):
+        hasher.update(numpy.ascontiguousarray(raw_samples[offset:offset+block_size]).data)
+    return hasher.hexdigest()
+
+def hash_parameters(*values):
+    '値のリストの repr() のハッシュ値を返却する、結果に影響するパラメータをキーにするために使う'
+    return hashlib.blake2b(repr(values).encode(), digest_size=20).hexdigest()
+
+def parse_incremental_option(args):
+    '''
+    コマンドライン引数 args からインクリメンタル処理の指定を取り除く。\n
+    - "--incremental[=<cache dir>]" : 結果キャッシュを使い、変更されたファイルだけ処理する。
+    - "--watch[=<interval>]" : インクリメンタル処理をした後、入力ディレクトリを監視して変更があれば再処理する。
+    (キャッシュディレクトリ, 監視間隔[sec], 残りの引数リスト) を返却する。\n
+    キャッシュディレクトリは指定がなければ ''（入力ディレクトリ下の既定の場所）、インクリメンタルでない場合は None 。\n
+    監視しない場合の監視間隔は None 。指定が不正な場合は RuntimeError を送出する。
+    '''
+    cache_dir = None
+    watch_interval = None
+    remain_args = []
+    for arg in args:
+        if arg == '--incremental':
+            cache_dir = ''
+        elif arg.startswith('--incremental='):
+            cache_dir = arg[len('--incremental='):]
+        elif arg == '--watch' or arg.startswith('--watch='):
+            value = arg[len('--watch='):] if '=' in arg else str(WATCH_INTERVAL)
+            try:
+                watch_interval = float(value)
+            except ValueError:
+                watch_interval = 0
+            if not 0 < watch_interval:
+                raise RuntimeError('Invalid --watch value : %s' % value)
+        else:
+            remain_args.append(arg)
+    if watch_interval is not None and cache_dir is None:
+        cache_dir = ''
+    return cache_dir, watch_interval, remain_args
+
+def open_result_cache(cache_dir, input_dir, tool_name):
+    '''
+    parse_incremental_option() のキャッシュディレクトリ指定から tool_name 用の result_cache を生成する。\n
+    cache_dir が None の場合は None 、 '' の場合は input_dir 下の RESULT_CACHE_DIR_NAME を使う。
+    '''
+    if cache_dir is None:
+        return None
+    if cache_dir == '':
+        cache_dir = os.path.join(input_dir, RESULT_CACHE_DIR_NAME)
+    return result_cache(os.path.join(cache_dir, tool_name))
+
+def _directory_signature(dir_path):
+    'ディレクトリ中の wav 、 ini ファイルの (名前, サイズ, 更新時刻) の一覧'
+    signature = []
+    for path in sorted(glob.glob(os.path.join(dir_path, '*.wav')) + glob.glob(os.path.join(dir_path, '*.ini'))):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        signature.append((path, stat.st_size, stat.st_mtime_ns))
+    return signature
+
+def watch_directory(dir_path, function, interval=WATCH_INTERVAL):
+    '''
+    function() を実行した後、 dir_path の wav 、 ini ファイルを interval 秒ごとに確認し、変更があれば再実行する。\n
+    変更の確認は function() の実行後の状態と比較するので、 function() 自身の出力では再実行されない。\n
+    KeyboardInterrupt で終了し、最後の function() の戻り値を返却する。
+    '''
+    status = function()
+    signature = _directory_signature(dir_path)
+    try:
+        while True:
+            time.sleep(interval)
+            if _directory_signature(dir_path) == signature:
+                continue
+            print('Change is detected in "%s".' % dir_path)
+            status = function()
+            signature = _directory_signature(dir_path)
+    except KeyboardInterrupt:
+        pass
+    return status
@@ -0,0 +1,131 @@
+import csv
+import itertools
+import re
+
+import numpy
+
+from .filter_functions import *
+from .helper_functions import string2bool
+
+# ------------------------------------------------------------------------------
+# constants
+# ------------------------------------------------------------------------------
+
+# カットオフ表の列名（この順で CSV / NPZ に保存される）
+CUTOFF_TABLE_COLUMNS = ['filter_type', 'filter_mode', 'filter_order', 'target_gain', 'target_frequency', 'sample_rate', 'is_zero_phase', 'cutoff_frequency']
+
+# "-3dB@120" 形式の目標ゲイン・周波数指定
+_CUTOFF_TARGET_PATTERN = re.compile(r'^\s*([+-]?\d+(?:\.\d+)?)\s*dB\s*@\s*(\d+(?:\.\d+)?)\s*(Hz)?\s*$', re.IGNORECASE)
+
+# ------------------------------------------------------------------------------
+# functions
+# ------------------------------------------------------------------------------
+
+def solve_butter_cutoff_frequencies(filter_mode, filter_order, target_gain, target_frequency, sample_rate, is_zero_phase):
+    '''
+    solve_cutoff_frequency() の Butterworth 版を閉形式で計算する。\n
+    デジタル Butterworth の振幅特性 1 / (1 + (tan(pi f / fs) / tan(pi fc / fs))^2N) を fc について解く。\n
+    filter_mode 以外の引数は numpy 配列を渡すことができ、ブロードキャストした形状の結果を返却する。\n
+    target_gain が 0 dB 以上の要素は届かないので nan となる。
+    '''
+    target_gain = numpy.asarray(target_gain, float)
+    single_gain = numpy.where(is_zero_phase, target_gain / 2, target_gain)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        ratio = numpy.power(numpy.power(10.0, -single_gain / 10) - 1, 1.0 / (2 * numpy.asarray(filter_order)))
+        warped = numpy.tan(numpy.pi * numpy.asarray(target_frequency) / sample_rate)
+        if filter_mode == 'low':
+            warped = warped / ratio
+        elif filter_mode == 'high':
+            warped = warped * ratio
+        else:
+            raise RuntimeError('Unknown filter_mode : ' + filter_mode)
+        cutoff = sample_rate / numpy.pi * numpy.arctan(warped)
+    return numpy.where(0 < -single_gain, cutoff, numpy.nan)
+
+def compute_cutoff_table(filter_types, filter_modes, filter_orders, target_gains, target_frequencies, sample_rates, is_zero_phases):
+    '''
+    各引数のリストの全組み合わせについて solve_cutoff_frequency() の結果を計算し、カットオフ表として返却する。\n
+    カットオフ表は CUTOFF_TABLE_COLUMNS を列名とする {列名: numpy 配列} 。\n
+    Butterworth は solve_butter_cutoff_frequencies() でまとめて、それ以外は１つずつ数値的に解く。\n
+    届かない組み合わせのカットオフ周波数は nan となる。
+    '''
+    rows = list(itertools.product(filter_types, filter_modes, filter_orders, target_gains, target_frequencies, sample_rates, is_zero_phases))
+    table = {}
+    for index, name in enumerate(CUTOFF_TABLE_COLUMNS[:-1]):
+        table[name] = numpy.array([row[index] for row in rows])
+    cutoff = numpy.full(len(rows), numpy.nan)
+    # Butterworth はモードごとにまとめて閉形式で解く
+    for filter_mode in filter_modes:
+        mask = (table['filter_type'] == 'butter') & (table['filter_mode'] == filter_mode)
+        if mask.any():
+            cutoff[mask] = solve_butter_cutoff_frequencies(filter_mode, table['filter_order'][mask], table['target_gain'][mask], table['target_frequency'][mask], table['sample_rate'][mask], table['is_zero_phase'][mask])
+    # それ以外は数値的に解く
+    for index in numpy.where(table['filter_type'] != 'butter')[0]:
+        try:
+            cutoff[index] = solve_cutoff_frequency(*[table[name][index].item() for name in CUTOFF_TABLE_COLUMNS[:-1]])
+        except RuntimeError:
+            pass
+    table['cutoff_frequency'] = cutoff
+    return table
+
+def save_cutoff_table(path, table):
+    '''
+    カットオフ表を path に保存する。\n
+    拡張子が .npz の場合は numpy.savez 、 .csv の場合は CSV 形式で保存する。
+    '''
+    if path.lower().endswith('.npz'):
+        numpy.savez(path, **table)
+    elif path.lower().endswith('.csv'):
+        with open(path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(CUTOFF_TABLE_COLUMNS)
+            for row in zip(*[table[name].tolist() for name in CUTOFF_TABLE_COLUMNS]):
+                writer.writerow([repr(v) if isinstance(v, float) else v for v in row])
+    else:
+        raise RuntimeError('Unknown cutoff table format : ' + path)
+
+def load_cutoff_table(path):
+    '''
+    save_cutoff_table() で保存したカットオフ表を読み込む。
+    '''
+    if path.lower().endswith('.npz'):
+        with numpy.load(path) as npz:
+            return {name: npz[name] for name in CUTOFF_TABLE_COLUMNS}
+    elif path.lower().endswith('.csv'):
+        with open(path, newline='') as f:
+            rows = list(csv.DictReader(f))
+        table = {}
+        table['filter_type'] = numpy.array([r['filter_type'] for r in rows])
+        table['filter_mode'] = numpy.array([r['filter_mode'] for r in rows])
+        table['filter_order'] = numpy.array([int(r['filter_order']) for r in rows])
+        table['is_zero_phase'] = numpy.array([string2bool(r['is_zero_phase']) for r in rows])
+        for name in ['target_gain', 'target_frequency', 'sample_rate', 'cutoff_frequency']:
+            table[name] = numpy.array([float(r[name]) for r in rows])
+        return table
+    else:
+        raise RuntimeError('Unknown cutoff table format : ' + path)
+
+def lookup_cutoff_frequency(table, filter_type, filter_mode, filter_order, target_gain, target_frequency, sample_rate, is_zero_phase):
+    '''
+    カットオフ表から条件に一致するカットオフ周波数を返却する。\n
+    目標ゲイン・周波数・サンプルレートは numpy.isclose で比較する。\n
+    一致する行がない場合や、その組み合わせが届かない（nan）場合は RuntimeError を送出する。
+    '''
+    mask = (table['filter_type'] == filter_type) & (table['filter_mode'] == filter_mode) & (table['filter_order'] == filter_order)
+    mask &= (table['is_zero_phase'] == is_zero_phase)
+    mask &= numpy.isclose(table['target_gain'], target_gain) & numpy.isclose(table['target_frequency'], target_frequency)
+    mask &= numpy.isclose(table['sample_rate'], sample_rate)
+    found = table['cutoff_frequency'][mask]
+    if found.size == 0 or numpy.isnan(found[0]):
+        raise RuntimeError('Cutoff frequency for %f dB at %f Hz (%s %s %d, %d Hz) is not found in table' % (target_gain, target_frequency, filter_type, filter_mode, filter_order, sample_rate))
+    return float(found[0])
+
+def parse_cutoff_target(text):
+    '''
+    "-3dB@120" 形式の文字列を (目標ゲイン[dB], 目標周波数[Hz]) に変換する。\n
+    この形式でない場合は None を返却する。
+    '''
+    match = _CUTOFF_TARGET_PATTERN.match(text)
+    if match is None:
+        return None
+    return float(match.group(1)), float(match.group(2))
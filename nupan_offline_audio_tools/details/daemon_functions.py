@@ -0,0 +1,191 @@
+import contextlib
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import time
+
+from .filter_functions import query_filter_cache_info
+
+# ------------------------------------------------------------------------------
+# constants
+# ------------------------------------------------------------------------------
+
+# 常駐モードのジョブ・応答の文字コード（JSON を１行ずつやり取りする）
+DAEMON_ENCODING = 'utf-8'
+
+# ------------------------------------------------------------------------------
+# functions
+# ------------------------------------------------------------------------------
+
+def parse_daemon_option(args):
+    '''
+    コマンドライン引数 args から常駐モードの指定を取り除く。\n
+    - "--daemon" : 標準入力から JSON 行のジョブを受け付ける。
+    - "--daemon=<socket path>" : UNIX ソケットでジョブを受け付ける。
+    - "--connect <socket path>" : 常駐中のプロセスに残りの引数をジョブとして送る。
+    (モード, ソケットパス, 残りの引数リスト) を返却する。モードは 'serve' 、 'connect' 、指定なしの場合は None 。\n
+    指定が不正な場合は RuntimeError を送出する。
+    '''
+    mode = None
+    socket_path = None
+    remain_args = []
+    arg_iter = iter(args)
+    for arg in arg_iter:
+        if arg == '--daemon':
+            mode, socket_path = 'serve', None
+        elif arg.startswith('--daemon='):
+            mode, socket_path = 'serve', arg[len('--daemon='):]
+        elif arg == '--connect':
+            mode, socket_path = 'connect', next(arg_iter, None)
+        elif arg.startswith('--connect='):
+            mode, socket_path = 'connect', arg[len('--connect='):]
+        else:
+            remain_args.append(arg)
+            continue
+        if mode == 'connect' and not socket_path:
+            raise RuntimeError('Invalid --connect value : %s' % socket_path)
+    return mode, socket_path, remain_args
+
+def _filter_cache_hits():
+    'フィルタ設計キャッシュのヒット数の合計'
+    return sum([info.hits for info in query_filter_cache_info().values()])
+
+def run_job(main_function, job):
+    '''
+    ジョブ job （ dict ）の引数 job['args'] で main_function(argv) を実行し、応答の dict を返却する。\n
+    job['cwd'] が指定されていれば、その間だけカレントディレクトリを移動する。\n
+    応答は id 、終了コード status 、所要時間 elapsed [sec] 、このジョブでのフィルタ設計キャッシュのヒット数 cache_hits 、\n
+    標準出力への出力 output を持つ。\n
+    main_function 内の exit() や例外は終了コードに変換されるので、常駐プロセスは終了しない。
+    '''
+    output = io.StringIO()
+    previous_dir = os.getcwd()
+    hits = _filter_cache_hits()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(output):
+        try:
+            if job.get('cwd'):
+                os.chdir(job['cwd'])
+            status = main_function(list(job.get('args', [])))
+        except SystemExit as err:
+            status = err.code
+        except Exception as err:
+            print('(error) : %s: %s' % (type(err).__name__, err))
+            status = 1
+        finally:
+            os.chdir(previous_dir)
+    if status is None:
+        status = 0
+    elif not isinstance(status, int):
+        print(status, file=output)
+        status = 1
+    return {
+        'id': job.get('id'),
+        'status': status,
+        'elapsed': time.perf_counter() - start,
+        'cache_hits': _filter_cache_hits() - hits,
+        'output': output.getvalue(),
+    }
+
+def _serve_lines(main_function, lines, respond):
+    '''
+    JSON 行のイテラブル lines のジョブを順に run_job() で実行し、応答を respond(JSON 文字列) に渡す。\n
+    ジョブごとの所要時間は標準エラー出力に表示する。
+    '''
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            job = json.loads(line)
+        except ValueError as err:
+            respond(json.dumps({'id': None, 'status': 1, 'elapsed': 0.0, 'cache_hits': 0, 'output': 'Invalid job : %s\n' % err}))
+            continue
+        response = run_job(main_function, job)
+        print('job %s : status %d, %.3f sec, %d filter cache hits.' % (response['id'], response['status'], response['elapsed'], response['cache_hits']), file=sys.stderr)
+        respond(json.dumps(response))
+
+def serve_stdin(main_function):
+    '''
+    標準入力から１行１ジョブの JSON {"id": ..., "args": [...], "cwd": ...} を読み、応答の JSON を１行ずつ標準出力に書く。\n
+    標準入力が閉じられるまで常駐する。
+    '''
+    # note ジョブ内の exit() は sys.stdin を閉じるので、ジョブの読み込みには元の標準入力を退避して使う
+    job_input = sys.stdin
+    job_output = sys.stdout
+    def respond(text):
+        job_output.write(text + '\n')
+        job_output.flush()
+    with open(os.devnull) as null_input:
+        sys.stdin = null_input
+        try:
+            _serve_lines(main_function, job_input, respond)
+        finally:
+            sys.stdin = job_input
+
+def serve_unix_socket(main_function, socket_path):
+    '''
+    UNIX ソケット socket_path でジョブを受け付ける。\n
+    １つの接続で serve_stdin() と同じ形式の JSON 行を複数送ることができる。\n
+    ジョブは受け付けた順に１つずつ実行される。
+    '''
+    class handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            def respond(text):
+                self.wfile.write((text + '\n').encode(DAEMON_ENCODING))
+                self.wfile.flush()
+            _serve_lines(main_function, (line.decode(DAEMON_ENCODING) for line in self.rfile), respond)
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    with socketserver.UnixStreamServer(socket_path, handler) as server:
+        print('Listening on "%s".' % socket_path, file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path)
+
+def submit_job(socket_path, args):
+    '''
+    UNIX ソケット socket_path で常駐しているプロセスに引数 args のジョブを送り、応答の dict を返却する。\n
+    相対パスが解決できるように現在のカレントディレクトリも送る。
+    '''
+    job = {'id': os.getpid(), 'args': list(args), 'cwd': os.getcwd()}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall((json.dumps(job) + '\n').encode(DAEMON_ENCODING))
+        client.shutdown(socket.SHUT_WR)
+        with client.makefile('rb') as reader:
+            return json.loads(reader.readline().decode(DAEMON_ENCODING))
+
+def run_tool(main_function, args):
+    '''
+    ツールの __main__ から呼ぶ。 args の常駐モード指定に応じて main_function(argv) を実行し、終了コードを返却する。\n
+    - 指定なし : このプロセスで main_function(args) を実行する。
+    - "--daemon[=<socket path>]" : 常駐してジョブを受け付ける。
+    - "--connect <socket path>" : 常駐中のプロセスでジョブを実行し、その出力と所要時間を表示する。
+    '''
+    try:
+        mode, socket_path, remain_args = parse_daemon_option(args)
+    except RuntimeError as err:
+        print(err)
+        return 1
+    if mode is None:
+        return main_function(remain_args)
+    if mode == 'serve':
+        if socket_path is None:
+            serve_stdin(main_function)
+        else:
+            serve_unix_socket(main_function, socket_path)
+        return 0
+    try:
+        response = submit_job(socket_path, remain_args)
+    except OSError as err:
+        print('Failed to connect to "%s". %s' % (socket_path, err))
+        return 1
+    sys.stdout.write(response['output'])
+    print('job finished in %.3f sec (status %d, %d filter cache hits).' % (response['elapsed'], response['status'], response['cache_hits']))
+    return response['status']
@@ -1,8 +1,60 @@
+import os
+
 # 無音判定しきい値
 SILENT_THRESHOLD = 1.0 / (2 ** 2)
 
+# 計算に使うサンプルのフォーマットとして指定できるもの
+SUPPORTED_INTERNAL_SAMPLE_FORMATS = ['float64', 'float32']
+
 # 計算に使うサンプルのフォーマット
-INTERNAL_SAMPLE_FORMAT = 'float64'
+# note 環境変数 NUPAN_INTERNAL_SAMPLE_FORMAT に 'float32' を指定すると単精度で処理する（メモリ量と帯域が半分になる）
+INTERNAL_SAMPLE_FORMAT = os.environ.get('NUPAN_INTERNAL_SAMPLE_FORMAT', 'float64')
+if INTERNAL_SAMPLE_FORMAT not in SUPPORTED_INTERNAL_SAMPLE_FORMATS:
+    raise RuntimeError('Invalid NUPAN_INTERNAL_SAMPLE_FORMAT : ' + INTERNAL_SAMPLE_FORMAT)
 
 # 波形ファイルセーブ時のフォーマット
 EXPORT_SAMPLE_FORMAT = 'float32'
+
+# ストリーミング処理時のブロックサイズ（サンプル数）
+STREAM_BLOCK_SIZE = 2 ** 16
+
+# ゼロ位相ブロックフィルタのインパルス応答打ち切りしきい値
+ZERO_PHASE_KERNEL_TOLERANCE = 1e-14
+
+# フィルタ設計キャッシュに保持する係数の最大数
+FILTER_CACHE_SIZE = 128
+
+# 中央値スケッチのデシベルヒストグラムの分解能と範囲（dB）
+MEDIAN_SKETCH_RESOLUTION = 0.01
+MEDIAN_SKETCH_FLOOR = -200.0
+MEDIAN_SKETCH_CEILING = 40.0
+
+# チェビシェフ（第１種）フィルタの通過域の許容リップル（dB）
+CHEBY_RIPPLE = 3
+
+# インクリメンタル処理の結果キャッシュを置くディレクトリ名（入力ディレクトリ直下）
+RESULT_CACHE_DIR_NAME = '.nupan_cache'
+
+# 監視モードで入力ディレクトリの変更を確認する間隔（秒）
+WATCH_INTERVAL = 1.0
+
+# 多相リサンプルの品質ごとの (低域通過 FIR の片側のゼロクロス数, カイザー窓の beta)
+RESAMPLE_QUALITIES = {'low': (4, 5.0), 'medium': (10, 5.0), 'high': (32, 9.0)}
+
+# 多相リサンプルで変換比率を近似する分数の分母の上限
+RESAMPLE_MAX_DENOMINATOR = 2 ** 16
+
+# 多相リサンプルの FIR の設計キャッシュに保持する最大数
+# note FIR 長は分母に比例し、伸縮率が 1 に近いと１つで数 MB ～十数 MB になる一方、比率はファイルごとに異なりほぼヒットしないので小さくする
+RESAMPLE_KERNEL_CACHE_SIZE = 2
+
+# cutoff_extreme_band で除去する ultra-low / ultra-high のカットオフ周波数（Hz）とフィルタ次数
+EXTREME_LOW_CUTOFF = 20
+EXTREME_HIGH_CUTOFF = 20000
+EXTREME_BAND_FILTER_ORDER = 2
+
+# プロセスプールで同時に処理するタスクの推定メモリ量の合計の上限（バイト）
+POOL_MEMORY_BUDGET = 2 ** 30
+
+# 中間結果ストアでメモリ上に保持するサンプル列の合計の上限（バイト）、超えた分はディスクに退避される
+STORE_RAM_CEILING = 2 ** 30
@@ -2,12 +2,29 @@ import sys
 import os
 import glob
 import re
+import struct
 import scipy.io.wavfile as wf
 import numpy as np
 
 from .default_constants import *
 from .helper_functions import *
 
+# サンプルフォーマット文字列 -> numpy dtype
+SAMPLE_FORMAT_DTYPES = {
+    'float64': np.dtype(np.float64),
+    'float32': np.dtype(np.float32),
+    'int32': np.dtype(np.int32),
+    'int16': np.dtype(np.int16),
+}
+
+# 整数サンプルの dtype -> (ゼロ点, フルスケール)、浮動小数点の [-1.0, 1.0) に対応させる
+# note 8bit の wav は符号なし、 24bit の wav は scipy が上位詰めの int32 として読む
+_INTEGER_SAMPLE_SCALES = {
+    np.dtype(np.uint8): (128, 2 ** 7),
+    np.dtype(np.int16): (0, 2 ** 15),
+    np.dtype(np.int32): (0, 2 ** 31),
+}
+
 def decompose_path(path):
     'path を (directory, stem, extension) に分解'
     directory, base_name = os.path.split(path)
@@ -60,43 +77,240 @@ def pad_stem_zero(stem, number_of_digit):
     else:
         return groups[0] + groups[1].zfill(number_of_digit)
 
-def load_samples(samples_path, internal_sample_format):
+def convert_samples_format(samples, sample_format):
+    '''
+    サンプル列を指定のフォーマット（ SAMPLE_FORMAT_DTYPES のキー）に変換する。\n
+    整数フォーマットは _INTEGER_SAMPLE_SCALES のフルスケールが浮動小数点の 1.0 に対応するようにスケーリングされ、\n
+    整数への変換は丸めてから範囲内に収められる。\n
+    既に指定のフォーマットの場合はコピーせずに samples をそのまま返却するので、書き換える場合は呼び出し側でコピーする事。\n
+    不明なフォーマットの場合は RuntimeError を送出する。
+    '''
+    if sample_format not in SAMPLE_FORMAT_DTYPES:
+        raise RuntimeError('Invalid data type string : ' + sample_format)
+    dtype = SAMPLE_FORMAT_DTYPES[sample_format]
+    if samples.dtype == dtype:
+        return samples
+    source_scale = _INTEGER_SAMPLE_SCALES.get(samples.dtype)
+    target_scale = _INTEGER_SAMPLE_SCALES.get(dtype)
+    if target_scale is None:
+        converted = samples.astype(dtype)
+        if source_scale is not None:
+            # 整数から浮動小数点へは変換後のバッファ上で in-place にスケーリングする
+            zero, full_scale = source_scale
+            if zero != 0:
+                converted -= zero
+            converted *= 1.0 / full_scale
+        return converted
+    # 整数へは倍精度でフルスケールを掛けて丸め、範囲に収めてから変換する
+    if source_scale is not None:
+        samples = convert_samples_format(samples, 'float64')
+    zero, full_scale = target_scale
+    scaled = np.multiply(samples, full_scale, dtype=np.float64)
+    np.rint(scaled, out=scaled)
+    np.clip(scaled, -full_scale, full_scale - 1, out=scaled)
+    return scaled.astype(dtype)
+
+def load_samples(samples_path, internal_sample_format, mmap=False):
     '''
-    wav ファイルからサンプル列をロードする
+    wav ファイルからサンプル列をロードする。\n
+    mmap が True の時、サンプル列は wav ファイルのデータチャンクに対する読み取り専用の numpy.memmap として返却される。\n
+    この場合ファイルのフォーマットが internal_sample_format と一致する（または internal_sample_format が None の）時は\n
+    変換もコピーも行われないので、読み取りのみの解析処理に使う事。
     '''
     # 存在チェック
     if not os.path.exists(samples_path):
         raise Exception('Specified file "%s" has not existed.' % samples_path)
     # ロード
-    sample_rate, input_samples = wf.read(samples_path)
-    # フォーマットを指定のものに変換する
-    if internal_sample_format == 'float64':
-        converted_samples = input_samples.astype(np.float64)
-    elif internal_sample_format == 'float32':
-        converted_samples = input_samples.astype(np.float32)
-    elif internal_sample_format == 'int32':
-        converted_samples = input_samples.astype(np.int32)
-    elif internal_sample_format == 'int16':
-        converted_samples = input_samples.astype(np.int16)
+    if mmap:
+        sample_rate, input_samples = _load_raw_samples(samples_path)
+        input_samples.flags.writeable = False
+        # フォーマットが一致していればそのまま返却する
+        if internal_sample_format is None or input_samples.dtype == np.dtype(internal_sample_format):
+            return input_samples, sample_rate
     else:
-        raise RuntimeError('Invalid data type string : ' + internal_sample_format)
+        sample_rate, input_samples = wf.read(samples_path)
+    # フォーマットを指定のものに変換する
+    converted_samples = convert_samples_format(input_samples, internal_sample_format)
     return converted_samples, sample_rate
 
-def save_samples(samples_path, samples, samplerate, export_sample_format):
+def _load_raw_samples(samples_path):
     '''
-    wav ファイルにサンプル列をセーブする
+    wav ファイルのサンプル列をメモリマップでロードする。\n
+    メモリマップ非対応のフォーマット（24bit 等）の場合は通常のロードにフォールバックする。
     '''
-    make_directory_exist(samples_path)
-    # フォーマットを指定のものに変換する
-    if export_sample_format == 'float32':
-        converted_samples = samples.astype(np.float32)
-    elif export_sample_format == 'int32':
-        converted_samples = samples.astype(np.int32)
-    elif export_sample_format == 'int16':
-        converted_samples = samples.astype(np.int16)
-    else:
-        raise RuntimeError('Invalid data type string : ' + export_sample_format)
-    wf.write(samples_path, samplerate, converted_samples)
+    try:
+        return wf.read(samples_path, mmap=True)
+    except ValueError:
+        return wf.read(samples_path)
+
+def query_wav_info(samples_path):
+    '''
+    wav ファイルのヘッダ情報を (サンプルレート, サンプル数, チャンネル数) で得る。\n
+    波形データ本体はメモリ上にロードされない。
+    '''
+    # 存在チェック
+    if not os.path.exists(samples_path):
+        raise Exception('Specified file "%s" has not existed.' % samples_path)
+    sample_rate, raw_samples = _load_raw_samples(samples_path)
+    channels = 1 if raw_samples.ndim == 1 else raw_samples.shape[1]
+    return sample_rate, raw_samples.shape[0], channels
+
+def _iterate_samples_blocks(raw_samples, internal_sample_format, block_size):
+    '''
+    raw_samples を先頭から block_size サンプルずつ変換して返すジェネレータ
+    '''
+    for offset in range(0, raw_samples.shape[0], block_size):
+        yield convert_samples_format(raw_samples[offset:offset+block_size], internal_sample_format)
+
+def load_samples_blocks(samples_path, internal_sample_format, block_size=STREAM_BLOCK_SIZE):
+    '''
+    wav ファイルからサンプル列をブロック単位でロードする。\n
+    (ブロックを返すジェネレータ, サンプルレート) を返却する。\n
+    ブロックは x 軸（第０軸）が時間方向で、最大 block_size サンプル。\n
+    ファイルはメモリマップされるので、使用メモリ量はファイル長ではなく block_size に依存する。
+    '''
+    # 存在チェック
+    if not os.path.exists(samples_path):
+        raise Exception('Specified file "%s" has not existed.' % samples_path)
+    sample_rate, raw_samples = _load_raw_samples(samples_path)
+    return _iterate_samples_blocks(raw_samples, internal_sample_format, block_size), sample_rate
+
+def save_samples(samples_path, samples, samplerate, export_sample_format, block_size=STREAM_BLOCK_SIZE):
+    '''
+    wav ファイルにサンプル列をセーブする。\n
+    wav_stream_writer で block_size サンプルずつ変換しながら書き出すので、変換後のサンプル列全体の複製は作られない。\n
+    サンプル列が既に export_sample_format の場合は変換せずにそのまま書き出す。
+    '''
+    channels = 1 if samples.ndim == 1 else samples.shape[1]
+    with wav_stream_writer(samples_path, samplerate, channels, export_sample_format) as writer:
+        for offset in range(0, samples.shape[0], block_size):
+            writer.write(samples[offset:offset+block_size])
+
+class wav_stream_writer:
+    '''
+    wav ファイルにサンプル列をブロック単位で追記していくライタ。\n
+    ヘッダ中のサイズは close() 時に確定する。\n
+    サンプル列は convert_samples_format() で export_sample_format に変換され、既にそのフォーマットなら変換せずに書き出される。\n
+    データが 4GB を超えた場合は RF64 形式で書き出される。\n
+    with 文で使用可能。
+    '''
+
+    # export_sample_format -> (リトルエンディアンの numpy dtype, wav フォーマットタグ)
+    _FORMATS = {
+        'float64': ('<f8', 3),
+        'float32': ('<f4', 3),
+        'int32': ('<i4', 1),
+        'int16': ('<i2', 1),
+    }
+
+    def __init__(self, samples_path, samplerate, channels, export_sample_format):
+        if export_sample_format not in self._FORMATS:
+            raise RuntimeError('Invalid data type string : ' + export_sample_format)
+        self.export_sample_format = export_sample_format
+        self.samplerate = samplerate
+        self.channels = channels
+        self.length = 0
+        self._dtype, self._format_tag = self._FORMATS[export_sample_format]
+        make_directory_exist(samples_path)
+        self._fid = open(samples_path, 'wb')
+        self._write_header()
+
+    def _write_header(self):
+        'サイズ未確定のヘッダを書き出す'
+        bytes_per_sample = np.dtype(self._dtype).itemsize
+        block_align = self.channels * bytes_per_sample
+        fmt_chunk_data = struct.pack('<HHIIHH', self._format_tag, self.channels, self.samplerate,
+                                     self.samplerate * block_align, block_align, bytes_per_sample * 8)
+        if self._format_tag != 1:
+            # 非 PCM フォーマットには cbSize を付加
+            fmt_chunk_data += b'\x00\x00'
+        header_data = b'RIFF' + struct.pack('<I', 0) + b'WAVE'
+        # RF64 化する場合に ds64 チャンクで上書きする領域
+        header_data += b'JUNK' + struct.pack('<I', 28) + bytes(28)
+        header_data += b'fmt ' + struct.pack('<I', len(fmt_chunk_data)) + fmt_chunk_data
+        self._fact_position = None
+        if self._format_tag != 1:
+            header_data += b'fact' + struct.pack('<I', 4)
+            self._fact_position = len(header_data)
+            header_data += struct.pack('<I', 0)
+        header_data += b'data'
+        self._data_size_position = len(header_data)
+        header_data += struct.pack('<I', 0)
+        self._fid.write(header_data)
+        self._data_position = len(header_data)
+
+    def write(self, samples):
+        '''
+        サンプル列を末尾に追記する。\n
+        サンプル列は x 軸（第０軸）が時間方向であると仮定する。
+        '''
+        samples_channels = 1 if samples.ndim == 1 else samples.shape[1]
+        if samples_channels != self.channels:
+            raise RuntimeError('Invalid number of channels : %d (expected %d)' % (samples_channels, self.channels))
+        converted_samples = convert_samples_format(samples, self.export_sample_format)
+        np.ascontiguousarray(converted_samples, self._dtype).tofile(self._fid)
+        self.length += samples.shape[0]
+
+    def close(self):
+        'ヘッダのサイズを確定してファイルを閉じる'
+        if self._fid.closed:
+            return
+        data_size = self._fid.tell() - self._data_position
+        # データチャンクはワード境界に揃える
+        if data_size % 2 == 1:
+            self._fid.write(b'\x00')
+        file_size = self._fid.tell()
+        if file_size - 8 <= 0xFFFFFFFF:
+            self._fid.seek(4)
+            self._fid.write(struct.pack('<I', file_size - 8))
+            self._fid.seek(self._data_size_position)
+            self._fid.write(struct.pack('<I', data_size))
+        else:
+            self._fid.seek(0)
+            self._fid.write(b'RF64' + b'\xFF\xFF\xFF\xFF' + b'WAVE')
+            self._fid.write(b'ds64' + struct.pack('<I', 28))
+            self._fid.write(struct.pack('<QQQI', file_size - 8, data_size, self.length, 0))
+            self._fid.seek(self._data_size_position)
+            self._fid.write(b'\xFF\xFF\xFF\xFF')
+        if self._fact_position is not None:
+            self._fid.seek(self._fact_position)
+            self._fid.write(struct.pack('<I', min(self.length, 0xFFFFFFFF)))
+        self._fid.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def compose_wav_files(wav_files_path, output_path, internal_sample_format, export_sample_format, block_size=STREAM_BLOCK_SIZE):
+    '''
+    wav_files_path の wav ファイルを順に１つに結合して output_path に書き出す。\n
+    最初に全ファイルのヘッダだけを読んでサンプルレートとチャンネル数をチェックし、\n
+    その後 block_size サンプル単位で wav_stream_writer に直接書き込むので、使用メモリ量はファイル数にも長さにも依存しない。\n
+    結合結果のサンプル数を返却する。
+    '''
+    # ヘッダをチェック
+    samplerate = 0
+    channels = 0
+    length = 0
+    for p in wav_files_path:
+        temp_samplerate, temp_length, temp_channels = query_wav_info(p)
+        if samplerate == 0:
+            samplerate = temp_samplerate
+            channels = temp_channels
+        elif samplerate != temp_samplerate:
+            raise RuntimeError('Wrong sample rate is detected in input files. File = %s, expected = %d, actual = %d' % (p, samplerate, temp_samplerate))
+        elif channels != temp_channels:
+            raise RuntimeError('Wrong number of channels is detected in input files. File = %s, expected = %d, actual = %d' % (p, channels, temp_channels))
+        length += temp_length
+    # ブロック単位で結合
+    with wav_stream_writer(output_path, samplerate, channels, export_sample_format) as writer:
+        for p in wav_files_path:
+            blocks, _ = load_samples_blocks(p, internal_sample_format, block_size)
+            for block in blocks:
+                writer.write(block)
+    return length
 
 def find_wav_files(dir_path):
     '''
@@ -127,16 +341,17 @@ def find_ini_file(dir_path):
     # 正常終了
     return ini_files[0]
 
-def load_wav_files(wav_files_path, internal_sample_format):
+def load_wav_files(wav_files_path, internal_sample_format, mmap=False):
     '''
-    指定ファイル全てをメモリ上にロード
+    指定ファイル全てを internal_sample_format でメモリ上にロード。\n
+    mmap については load_samples() を参照。
     '''
     samplerate = 0
     samples_list = []
     for p in wav_files_path:
         # ロード
         try:
-            temp_input, temp_sampletate = load_samples(p, INTERNAL_SAMPLE_FORMAT)
+            temp_input, temp_sampletate = load_samples(p, internal_sample_format, mmap)
         except Exception as err:
             print(err)
             raise
@@ -146,8 +361,8 @@ def load_wav_files(wav_files_path, internal_sample_format):
         elif samplerate != temp_sampletate:
             print('Wrong sample rate is detected in input files.')
             print('File = ' + p)
-            print('Expected sample rate = ' + samplerate)
-            print('Actual sample rate = ' + temp_sampletate)
+            print('Expected sample rate = %d' % samplerate)
+            print('Actual sample rate = %d' % temp_sampletate)
             exit(1)
         # 無音サンプルはスキップ
         if is_slient_samples(temp_input):
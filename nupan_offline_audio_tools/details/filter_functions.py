@@ -1,5 +1,7 @@
+import functools
+from fractions import Fraction
+
 import numpy
-from scipy import signal
 
 from .helper_functions import *
 
@@ -11,7 +13,433 @@ FILTER_ORDER = 2
 
 # TODO 関数の切り分け方が果てしなく微妙
 
-def apply_filter(samples, filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate, is_zero_phase):
+# note scipy.signal と scipy.fft は読み込みに時間がかかり起動時間の大半を占めるので、使う関数の中で読み込む
+
+def _freeze(array):
+    'キャッシュした配列が書き換えられないように読み取り専用にする'
+    array.flags.writeable = False
+    return array
+
+def _design_filter(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate, output):
+    '''
+    フィルタを設計して output で指定した形式（'ba', 'sos'）の係数を返却する。\n
+    引数は apply_filter() を参照。
+    '''
+    from scipy import signal
+    normalized_frequency = normalize_frequency(cutoff_frequency, sample_rate)
+    if filter_type=='butter':
+        return signal.butter(filter_order, normalized_frequency, filter_mode, output=output)
+    elif filter_type=='cheby1st':
+        return signal.butter(filter_order, normalized_frequency, filter_mode, output=output)
+    elif filter_type=='cheby':
+        return signal.cheby1(filter_order, CHEBY_RIPPLE, normalized_frequency, filter_mode, output=output)
+    else:
+        raise RuntimeError('Unknown filter_type : ' + filter_type)
+
+@functools.lru_cache(maxsize=FILTER_CACHE_SIZE)
+def design_filter_ba(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate):
+    '''
+    フィルタを設計して伝達関数（b, a）形式の係数を返却する。\n
+    結果はキャッシュされるので、返却された配列は読み取り専用。\n
+    引数は apply_filter() を参照。
+    '''
+    b, a = _design_filter(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate, 'ba')
+    return _freeze(b), _freeze(a)
+
+@functools.lru_cache(maxsize=FILTER_CACHE_SIZE)
+def design_filter_sos(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate):
+    '''
+    フィルタを設計して二次セクション（sos）形式の係数を返却する。\n
+    結果はキャッシュされるので、返却された配列は読み取り専用。\n
+    引数は apply_filter() を参照。
+    '''
+    return _freeze(_design_filter(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate, 'sos'))
+
+class streaming_filter:
+    '''
+    因果的（非ゼロ位相）なフィルタをブロック単位で適用する。\n
+    係数は生成時に一度だけ二次セクション形式で設計され、ブロック間でフィルタの内部状態 zi を引き継ぐ。\n
+    サンプル列を分割して順に process() に渡した結果は、一括で apply_filter() した結果と一致する。\n
+    出力は入力と同じ dtype 。係数と内部状態は常に倍精度で、単精度の入力も倍精度で計算して単精度に戻す。\n
+    引数は apply_filter() を参照。
+    '''
+
+    def __init__(self, filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate):
+        # sosfilt は書き込み可能な係数を要求するのでキャッシュからコピーする
+        self.sos = design_filter_sos(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate).copy()
+        self.reset()
+
+    def reset(self):
+        '内部状態を初期化する。別のサンプル列を処理する前に呼ぶ事。'
+        self._zi = None
+        self._dtype = None
+
+    def process(self, samples):
+        '''
+        ブロック samples にフィルタを適用した結果を返却する。\n
+        ブロックは x 軸（第０軸）が時間方向であると仮定する。
+        '''
+        from scipy import signal
+        if self._zi is None:
+            self._dtype = samples.dtype
+            self._zi = numpy.zeros((self.sos.shape[0], 2) + samples.shape[1:])
+        result, self._zi = signal.sosfilt(self.sos, samples, 0, self._zi)
+        return result.astype(samples.dtype, copy=False)
+
+    def flush(self):
+        '''
+        入力終端後に残っている出力を返却する。\n
+        因果的フィルタには遅延がないので常に空。
+        '''
+        if self._zi is None:
+            # note 一度も入力がなければ形状も dtype も分からないので空の配列を返す
+            return numpy.empty((0,))
+        return numpy.empty((0,) + self._zi.shape[2:], self._dtype)
+
+@functools.lru_cache(maxsize=FILTER_CACHE_SIZE)
+def design_pole_radius(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate):
+    '''
+    IIR フィルタの極の半径の最大値を返却する。１に近いほどインパルス応答が長く、係数の丸めに弱い。\n
+    結果はキャッシュされる。\n
+    引数は apply_filter() を参照。
+    '''
+    from scipy import signal
+    sos = design_filter_sos(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate)
+    _, poles, _ = signal.sos2zpk(sos)
+    return float(numpy.max(numpy.abs(poles)))
+
+@functools.lru_cache(maxsize=FILTER_CACHE_SIZE)
+def design_impulse_length(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate):
+    '''
+    IIR フィルタのインパルス応答が ZERO_PHASE_KERNEL_TOLERANCE まで減衰するサンプル数を返却する。\n
+    極の半径の最大値から求めるので、実際の応答はこの長さより前に減衰しきる場合がある。\n
+    引数は apply_filter() を参照。
+    '''
+    pole_radius = design_pole_radius(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate)
+    return int(numpy.ceil(numpy.log(ZERO_PHASE_KERNEL_TOLERANCE) / numpy.log(pole_radius))) + 1
+
+@functools.lru_cache(maxsize=FILTER_CACHE_SIZE)
+def design_impulse_response(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate):
+    '''
+    IIR フィルタのインパルス応答を ZERO_PHASE_KERNEL_TOLERANCE まで減衰する長さで打ち切って返却する。\n
+    ゼロ位相フィルタリングの逆方向の適用を FIR として計算するために使う。\n
+    結果はキャッシュされるので、返却された配列は読み取り専用。\n
+    引数は apply_filter() を参照。
+    '''
+    sos = design_filter_sos(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate)
+    length = design_impulse_length(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate)
+    from scipy import signal
+    impulse = numpy.zeros(length)
+    impulse[0] = 1.0
+    return _freeze(signal.sosfilt(sos.copy(), impulse))
+
+@functools.lru_cache(maxsize=1)
+def _rfft_z_inverse(fft_length):
+    '''
+    fft_length 点の rfft の各ビンに対応する単位円上の z^-1 を返却する。\n
+    同じ fft_length で全バンドの応答を計算するので直近の１つだけキャッシュする。
+    '''
+    return _freeze(numpy.exp(-2j * numpy.pi * numpy.arange(fft_length // 2 + 1) / fft_length))
+
+def design_frequency_response(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate, is_zero_phase, fft_length):
+    '''
+    fft_length 点の rfft の各ビンにおけるフィルタの周波数応答を返却する。\n
+    ゼロ位相の場合は順方向＋逆方向適用に相当する |H|^2 （実数）、そうでなければ H （複素数）。\n
+    配列長は入力長に比例するのでキャッシュしない。\n
+    引数は apply_filter() を参照。
+    '''
+    sos = design_filter_sos(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate)
+    # 各ビンの z^-1 で二次セクションの分子・分母多項式を直接評価する
+    z_inverse = _rfft_z_inverse(fft_length)
+    response = None
+    for b0, b1, b2, a0, a1, a2 in sos:
+        section_response = (b0 + z_inverse * (b1 + z_inverse * b2)) / (a0 + z_inverse * (a1 + z_inverse * a2))
+        response = section_response if response is None else response * section_response
+    if is_zero_phase:
+        return numpy.abs(response) ** 2
+    return response
+
+def query_filter_gain(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate, is_zero_phase, query_frequency):
+    '''
+    query_frequency [Hz] におけるフィルタのゲイン（dB）を sosfreqz で厳密に計算する。\n
+    ゼロ位相の場合は同一フィルタが二回適用されるので２倍のゲインとなる。\n
+    カットオフ周波数の探索で大量に呼ばれるので設計キャッシュは使わない。\n
+    引数は apply_filter() を参照。
+    '''
+    from scipy import signal
+    sos = _design_filter(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate, 'sos')
+    _, response = signal.sosfreqz(sos, [query_frequency], fs=sample_rate)
+    gain = to_decibel(numpy.abs(response[0]))
+    return 2 * gain if is_zero_phase else gain
+
+# solve_cutoff_frequency() で根の候補区間を探す対数グリッドの点数
+_CUTOFF_SEARCH_GRID_SIZE = 32
+
+@functools.lru_cache(maxsize=FILTER_CACHE_SIZE)
+def solve_cutoff_frequency(filter_type, filter_mode, filter_order, target_gain, target_frequency, sample_rate, is_zero_phase):
+    '''
+    target_frequency [Hz] におけるゲインが target_gain [dB] になるカットオフ周波数を求める。\n
+    カットオフ周波数の対数を変数として query_filter_gain() の根を Brent 法で探索する。\n
+    探索範囲は target_frequency / 1000 からナイキスト周波数の直前まで。\n
+    リップルのあるフィルタでは根が複数ある場合があるので、対数グリッドで符号が変わる区間のうち\n
+    target_frequency に最も近いものを選ぶ。\n
+    範囲内で target_gain に届かない場合は RuntimeError を送出する。\n
+    結果はキャッシュされる。\n
+    引数は apply_filter() を参照。
+    '''
+    # note 起動時間に影響するので使う時だけ読み込む
+    from scipy import optimize
+    def gain_error(log_cutoff):
+        return query_filter_gain(filter_type, filter_mode, filter_order, numpy.exp(log_cutoff), sample_rate, is_zero_phase, target_frequency) - target_gain
+    # 符号が変わる区間を探す
+    grid = numpy.linspace(numpy.log(target_frequency / 1000), numpy.log(sample_rate / 2 * (1 - 1e-6)), _CUTOFF_SEARCH_GRID_SIZE)
+    errors = numpy.array([gain_error(g) for g in grid])
+    brackets = numpy.where(numpy.sign(errors[:-1]) != numpy.sign(errors[1:]))[0]
+    if brackets.size == 0:
+        raise RuntimeError('Target gain %f dB at %f Hz is not reachable by filter %s %s %d' % (target_gain, target_frequency, filter_type, filter_mode, filter_order))
+    nearest = brackets[numpy.argmin(numpy.abs(grid[brackets] - numpy.log(target_frequency)))]
+    return float(numpy.exp(optimize.brentq(gain_error, grid[nearest], grid[nearest+1], xtol=1e-12)))
+
+@functools.lru_cache(maxsize=RESAMPLE_KERNEL_CACHE_SIZE)
+def design_resample_kernel(up, down, zero_crossings, kaiser_beta):
+    '''
+    up / down 倍の多相リサンプル用の低域通過 FIR を設計する。\n
+    カットオフは変換前後の低い方のナイキスト周波数で、片側 zero_crossings 個のゼロクロスまでをカイザー窓で打ち切る。\n
+    FIR 長は 2 * zero_crossings * max(up, down) + 1 で大きくなりうるので、\n
+    結果は他の設計関数と別に RESAMPLE_KERNEL_CACHE_SIZE 個だけキャッシュされる。返却された配列は読み取り専用。
+    '''
+    from scipy import signal
+    max_rate = max(up, down)
+    return _freeze(signal.firwin(2 * zero_crossings * max_rate + 1, 1.0 / max_rate, window=('kaiser', kaiser_beta)))
+
+# 係数をキャッシュしている設計関数
+_CACHED_DESIGN_FUNCTIONS = [design_filter_ba, design_filter_sos, design_pole_radius, design_impulse_length, design_impulse_response, solve_cutoff_frequency, design_resample_kernel]
+
+def query_filter_cache_info():
+    '''
+    フィルタ設計キャッシュの状態を {設計関数名: functools の CacheInfo} で返却する。\n
+    CacheInfo はヒット数 hits 、ミス数 misses 、最大数 maxsize 、現在数 currsize を持つ。
+    '''
+    return {f.__name__: f.cache_info() for f in _CACHED_DESIGN_FUNCTIONS}
+
+def print_filter_cache_info():
+    'フィルタ設計キャッシュのヒット数とミス数を表示'
+    for name, info in query_filter_cache_info().items():
+        print('filter cache %s : hits=%d, misses=%d, size=%d/%d' % (name, info.hits, info.misses, info.currsize, info.maxsize))
+
+def clear_filter_cache():
+    'フィルタ設計キャッシュを空にしてカウンタを初期化する'
+    for f in _CACHED_DESIGN_FUNCTIONS:
+        f.cache_clear()
+
+class zero_phase_streaming_filter:
+    '''
+    ゼロ位相フィルタをブロック単位で適用する。\n
+    apply_filter() の filtfilt と同じく、前後を padlen サンプルの奇対称で延長し、順方向の IIR を定常状態の初期値から適用する。\n
+    逆方向の適用は design_impulse_response() のインパルス応答との相関を FFT の overlap-save で計算し、\n
+    末尾のインパルス応答長の範囲だけは flush() で filtfilt と同じく定常状態の初期値から逆方向の IIR を適用する。\n
+    使用メモリ量は入力長ではなくブロック長とインパルス応答長に依存する。\n
+    インパルス応答長だけ出力が遅延するので、全ブロックを process() に渡した後に flush() で残りを受け取る事。\n
+    出力の合計サンプル数は入力と一致し、端点を含めて apply_filter() のゼロ位相フィルタリングと一致する（誤差は打ち切りの許容誤差程度）。\n
+    ただし入力が padlen サンプル以下の場合、 filtfilt はエラーになるが、ここでは延長を入力長 - 1 に縮めて処理する。\n
+    出力は入力と同じ dtype で、単精度の入力は単精度の FFT で相関を計算する。\n
+    引数は apply_filter() を参照。
+    '''
+
+    def __init__(self, filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate):
+        from scipy import signal
+        # sosfilt は書き込み可能な係数を要求するのでキャッシュからコピーする
+        self.sos = design_filter_sos(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate).copy()
+        self.impulse = design_impulse_response(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate)
+        # note filtfilt の既定の延長長は伝達関数形式の係数長の３倍
+        b, a = design_filter_ba(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate)
+        self.padlen = 3 * max(len(a), len(b))
+        self._step_zi = signal.sosfilt_zi(self.sos)
+        self._fft_length = 0
+        self._impulse_fft = None
+        self.reset()
+
+    def reset(self):
+        '内部状態を初期化する。別のサンプル列を処理する前に呼ぶ事。'
+        # 先頭の延長を作れるだけの入力が揃うまで貯めておくブロック
+        self._head = []
+        self._head_length = 0
+        self._padlen = self.padlen
+        self._dtype = None
+        # 順方向の IIR の内部状態、 None の時は未開始
+        self._zi = None
+        # 末尾の延長用に保持する直近の入力
+        self._last = None
+        # 逆方向の相関が未計算の順方向の出力
+        self._tail = None
+        # 先頭の延長分として捨てる残りの出力数
+        self._discard = 0
+
+    def _initial_zi(self, value, ndim):
+        '定常状態で value が続いていた時の IIR の内部状態'
+        return self._step_zi.reshape(self._step_zi.shape + (1,) * (ndim - 1)) * value
+
+    def _remember_last(self, samples):
+        '末尾の延長用に直近の入力を padlen + 1 サンプル保持する'
+        if self._last is None or self._padlen + 1 <= samples.shape[0]:
+            self._last = samples[samples.shape[0] - self._padlen - 1:].copy()
+        else:
+            self._last = numpy.concatenate([self._last, samples])[-(self._padlen + 1):]
+
+    def _forward(self, samples):
+        '順方向の IIR を適用する。係数が倍精度なので倍精度で計算して入力の dtype に戻す'
+        from scipy import signal
+        result, self._zi = signal.sosfilt(self.sos, samples, 0, self._zi)
+        return result.astype(self._dtype, copy=False)
+
+    def _start(self, samples, padlen):
+        '先頭を padlen サンプルの奇対称で延長して順方向の適用を開始する'
+        self._padlen = padlen
+        self._dtype = samples.dtype
+        self._discard = padlen
+        extended = numpy.concatenate([2 * samples[:1] - samples[padlen:0:-1], samples])
+        self._zi = self._initial_zi(extended[0], samples.ndim)
+        self._remember_last(samples)
+        return self._backward(self._forward(extended))
+
+    def _backward(self, forward_samples):
+        '''
+        順方向の出力 forward_samples を追加し、インパルス応答長の先まで揃った分の逆方向の相関を計算して返却する。\n
+        先頭の延長分の出力は捨てる。
+        '''
+        import scipy.fft
+        buffer = forward_samples if self._tail is None else numpy.concatenate([self._tail, forward_samples])
+        impulse_length = self.impulse.shape[0]
+        valid_length = buffer.shape[0] - impulse_length + 1
+        if valid_length <= 0:
+            self._tail = buffer
+            return buffer[:0]
+        # 反転したインパルス応答との循環畳み込みのうち、回り込みのない後半が相関になる
+        fft_length = scipy.fft.next_fast_len(buffer.shape[0], real=True)
+        spectrum_dtype = numpy.result_type(buffer.dtype, numpy.complex64)
+        if fft_length != self._fft_length or self._impulse_fft.dtype != spectrum_dtype:
+            self._fft_length = fft_length
+            self._impulse_fft = scipy.fft.rfft(self.impulse[::-1], fft_length).astype(spectrum_dtype, copy=False)
+        spectrum = scipy.fft.rfft(buffer, fft_length, axis=0)
+        spectrum *= self._impulse_fft.reshape((-1,) + (1,) * (buffer.ndim - 1))
+        result = scipy.fft.irfft(spectrum, fft_length, axis=0, overwrite_x=True)[impulse_length - 1:buffer.shape[0]]
+        self._tail = buffer[valid_length:].copy()
+        discard_length = min(self._discard, valid_length)
+        self._discard -= discard_length
+        return result[discard_length:]
+
+    def process(self, samples):
+        '''
+        ブロック samples を入力し、確定した分の出力を返却する。\n
+        ブロックは x 軸（第０軸）が時間方向であると仮定する。
+        '''
+        if self._zi is None:
+            self._head.append(samples)
+            self._head_length += samples.shape[0]
+            if self._head_length <= self.padlen:
+                return samples[:0]
+            head = numpy.concatenate(self._head) if 1 < len(self._head) else self._head[0]
+            self._head = []
+            return self._start(head, self.padlen)
+        self._remember_last(samples)
+        return self._backward(self._forward(samples))
+
+    def flush(self):
+        '''
+        入力終端後に残っている出力を返却する。\n
+        末尾を奇対称で延長して順方向の適用を終え、未計算の範囲に末尾から逆方向の IIR を適用する。
+        '''
+        from scipy import signal
+        result = None
+        if self._zi is None:
+            if self._head_length == 0:
+                # note 一度も入力がなければ形状も dtype も分からないので空の配列を返す
+                return numpy.empty((0,))
+            head = numpy.concatenate(self._head) if 1 < len(self._head) else self._head[0]
+            self._head = []
+            result = self._start(head, head.shape[0] - 1)
+        padlen = self._padlen
+        buffer = self._tail
+        if 0 < padlen:
+            last = self._last
+            buffer = numpy.concatenate([buffer, self._forward(2 * last[-1:] - last[-2:-(padlen + 2):-1])])
+        # note filtfilt と同じく順方向の出力の末尾の値が続いていた状態から逆方向に適用する
+        zi = self._initial_zi(buffer[-1], buffer.ndim)
+        backward, _ = signal.sosfilt(self.sos, buffer[::-1], 0, zi)
+        backward = backward[::-1][:buffer.shape[0] - padlen].astype(self._dtype, copy=False)
+        discard_length = min(self._discard, backward.shape[0])
+        self._discard -= discard_length
+        backward = backward[discard_length:]
+        self._tail = buffer[:0]
+        if result is not None:
+            return numpy.concatenate([result, backward])
+        return backward
+
+class filter_chain:
+    '''
+    複数のブロックフィルタを直列に接続して１つのブロックフィルタとして扱う。\n
+    streaming_filter 、 zero_phase_streaming_filter と同じく reset() / process() / flush() を持つ。\n
+    filters が空の場合は入力をそのまま返却する。
+    '''
+
+    def __init__(self, filters):
+        self.filters = list(filters)
+        self._trailing_shape = ()
+        self._dtype = None
+
+    def reset(self):
+        '内部状態を初期化する。別のサンプル列を処理する前に呼ぶ事。'
+        self._trailing_shape = ()
+        self._dtype = None
+        for block_filter in self.filters:
+            block_filter.reset()
+
+    def process(self, samples):
+        'ブロック samples を全フィルタに順に通し、確定した分の出力を返却する'
+        self._trailing_shape = samples.shape[1:]
+        self._dtype = samples.dtype
+        for block_filter in self.filters:
+            samples = block_filter.process(samples)
+        return samples
+
+    def flush(self):
+        '入力終端後に残っている出力を返却する。前段のフィルタの残りは後段に通してから後段の残りと結合する。'
+        result = numpy.empty((0,) + self._trailing_shape, self._dtype)
+        for block_filter in self.filters:
+            # note sosfilt は空の入力を受け付けないので残りがある時だけ通す
+            if 0 < result.shape[0]:
+                result = numpy.concatenate([block_filter.process(result), block_filter.flush()])
+            else:
+                result = block_filter.flush()
+        return result
+
+def filter_blocks(block_filter, blocks):
+    '''
+    ブロックを返すイテラブル blocks に streaming_filter または zero_phase_streaming_filter を適用するジェネレータ。\n
+    出力ブロックの長さは入力と一致しない場合があるが、合計サンプル数は入力と一致する。
+    '''
+    block_filter.reset()
+    for block in blocks:
+        result = block_filter.process(block)
+        if 0 < result.shape[0]:
+            yield result
+    result = block_filter.flush()
+    if 0 < result.shape[0]:
+        yield result
+
+def apply_block_filter(block_filter, samples, block_size):
+    '''
+    samples を block_size サンプルずつ block_filter に通した結果を１つのサンプル列として返却する。
+    '''
+    result = numpy.empty(samples.shape, samples.dtype)
+    offset = 0
+    blocks = (samples[i:i+block_size] for i in range(0, samples.shape[0], block_size))
+    for block in filter_blocks(block_filter, blocks):
+        result[offset:offset+block.shape[0]] = block
+        offset += block.shape[0]
+    return result
+
+def apply_filter(samples, filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate, is_zero_phase, block_size=None):
     '''
     入力サンプル列にフィルタを適用する。\n
     入力サンプル列は x 軸（第０軸）が時間方向であると仮定する。\n
@@ -22,23 +450,87 @@ def apply_filter(samples, filter_type, filter_mode, filter_order, cutoff_frequen
     - cutoff_freqency : カットオフ周波数
     - sample_rate : サンプルレート
     - is_zer_phase : True の時ゼロ位相フィルタリング。\n同一のフィルタが二回適用されるので注意。
+    - block_size : 指定した場合 block_size サンプル単位で処理する。\nゼロ位相フィルタリングの場合は zero_phase_streaming_filter を使う。
+    結果は入力と同じ dtype で返却される。
     '''
-    normalized_frequency = normalize_frequency(cutoff_frequency, sample_rate)
-    if filter_type=='butter':
-        b, a = signal.butter(filter_order, normalized_frequency, filter_mode)
-    elif filter_type=='cheby1st':
-        b, a = signal.butter(filter_order, normalized_frequency, filter_mode)
-    else:
+    if block_size is not None:
+        try:
+            if is_zero_phase:
+                block_filter = zero_phase_streaming_filter(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate)
+            else:
+                block_filter = streaming_filter(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate)
+        except RuntimeError:
+            print('In apply_filter(). Unknown filter_type=%s' %(filter_type,))
+            return None
+        return apply_block_filter(block_filter, samples, block_size)
+    if not is_zero_phase:
+        try:
+            causal_filter = streaming_filter(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate)
+        except RuntimeError:
+            print('In apply_filter(). Unknown filter_type=%s' %(filter_type,))
+            return None
+        return causal_filter.process(samples)
+    try:
+        b, a = design_filter_ba(filter_type, filter_mode, filter_order, cutoff_frequency, sample_rate)
+    except RuntimeError:
         print('In apply_filter(). Unknown filter_type=%s' %(filter_type,))
         return None
-    if is_zero_phase:
-        return signal.filtfilt(b, a, samples, 0)
-    else:
-        return signal.lfilter(b, a, samples, 0)
+    from scipy import signal
+    # note filtfilt は倍精度で計算するので入力の dtype に戻す
+    return signal.filtfilt(b, a, samples, 0).astype(samples.dtype, copy=False)
 
-def apply_zplr(samples, filter_mode, cutoff_frequency, sample_rate):
+def apply_zplr(samples, filter_mode, cutoff_frequency, sample_rate, block_size=None):
     '''
     入力サンプル列にゼロ位相の linkwitz-riley フィルタを適用する。\n
     詳細は apply_filter() を参照。\n
     '''
-    return apply_filter(samples, 'butter', filter_mode, 2, cutoff_frequency, sample_rate, True)
+    return apply_filter(samples, 'butter', filter_mode, 2, cutoff_frequency, sample_rate, True, block_size)
+
+def resample_samples(samples, output_length, engine='fft', quality='medium'):
+    '''
+    サンプル列を output_length サンプルにリサンプル（伸縮）する。\n
+    サンプル列は x 軸（第０軸）が時間方向であると仮定する。\n
+    - engine : 'fft' の時は signal.resample で全体を FFT する。周期的な回り込みを仮定し、計算量は長さの素因数に依存する。\n
+      'poly' の時は変換比率を分母 RESAMPLE_MAX_DENOMINATOR 以下の分数 up / down で近似して signal.resample_poly で多相フィルタリングする。\n
+      前後はゼロとして扱い、計算量は長さにほぼ比例する。
+    - quality : 'poly' の時の RESAMPLE_QUALITIES のキー。高いほど FIR が長く、阻止域の減衰が大きい。
+    結果は入力と同じ dtype で返却される。不明な engine 、 quality の場合は RuntimeError を送出する。
+    '''
+    from scipy import signal
+    if engine == 'fft':
+        return signal.resample(samples, output_length).astype(samples.dtype, copy=False)
+    if engine != 'poly':
+        raise RuntimeError('Unknown resample engine : ' + engine)
+    if quality not in RESAMPLE_QUALITIES:
+        raise RuntimeError('Unknown resample quality : ' + quality)
+    ratio = Fraction(output_length, samples.shape[0]).limit_denominator(RESAMPLE_MAX_DENOMINATOR)
+    if ratio == 1:
+        # 近似した比率が等倍ならフィルタは不要
+        result = numpy.array(samples)
+    else:
+        zero_crossings, kaiser_beta = RESAMPLE_QUALITIES[quality]
+        kernel = design_resample_kernel(ratio.numerator, ratio.denominator, zero_crossings, kaiser_beta)
+        result = signal.resample_poly(samples, ratio.numerator, ratio.denominator, axis=0, window=kernel).astype(samples.dtype, copy=False)
+    # 比率の近似で生じる長さの差を切り詰めまたはゼロ埋めで合わせる
+    if output_length <= result.shape[0]:
+        return result[:output_length]
+    return numpy.concatenate([result, numpy.zeros((output_length - result.shape[0],) + result.shape[1:], result.dtype)])
+
+def create_extreme_band_filter(sample_rate):
+    '''
+    EXTREME_LOW_CUTOFF 未満の ultra-low と EXTREME_HIGH_CUTOFF を超える ultra-high を除去するブロックフィルタを生成する。\n
+    どちらも EXTREME_BAND_FILTER_ORDER 次の butter-worth のゼロ位相フィルタで、係数とカーネルは設計キャッシュから得る。\n
+    EXTREME_HIGH_CUTOFF がナイキスト周波数以上の場合、ローパスは省略される。
+    '''
+    filters = [zero_phase_streaming_filter('butter', 'high', EXTREME_BAND_FILTER_ORDER, EXTREME_LOW_CUTOFF, sample_rate)]
+    if EXTREME_HIGH_CUTOFF < sample_rate / 2:
+        filters.append(zero_phase_streaming_filter('butter', 'low', EXTREME_BAND_FILTER_ORDER, EXTREME_HIGH_CUTOFF, sample_rate))
+    return filter_chain(filters)
+
+def cutoff_extreme_band(samples, sample_rate, block_size=STREAM_BLOCK_SIZE):
+    '''
+    samples から ultra-low と ultra-high を除去したサンプル列を返却する。\n
+    create_extreme_band_filter() を block_size サンプル単位で適用するので、作業メモリ量はブロック長とカーネル長に依存する。\n
+    ファイルからファイルへ処理する場合は load_samples_blocks() と filter_blocks() を組み合わせれば全体をメモリに載せずに済む。
+    '''
+    return apply_block_filter(create_extreme_band_filter(sample_rate), samples, block_size)
@@ -1,5 +1,4 @@
 import numpy
-from scipy import signal
 
 # ------------------------------------------------------------------------------
 # constants
@@ -44,10 +43,12 @@ def estimate_amplitude_envelope(samples):
     与えられたサンプル列の振幅包絡線を得る。\n
     包絡線は入力と同要素数のサンプル列として返却される\n
     '''
+    from scipy import signal
     return numpy.abs(signal.hilbert(samples))
 
 def argextrema(samples):
     '与えられたサンプル列の極値を得る'
+    from scipy import signal
     return numpy.sort(numpy.c_[signal.argrelmax(samples), signal.argrelmin(samples)]).flatten()
 
 def shift_forward_and_padding(samples, offset):
@@ -74,6 +75,23 @@ def compose_samples(samples_1, samples_2):
     '''
     return numpy.r_[samples_1, samples_2]
 
+def compose_samples_list(samples_list, sample_format=INTERNAL_SAMPLE_FORMAT):
+    '''
+    サンプル列のリストを先頭から順に１つのサンプル列に結合する。\n
+    最初に全体のサイズを確定して１つのバッファを確保し、そこに各サンプル列を書き込むので\n
+    compose_samples() を繰り返すのと違いコピーは１回で済む。\n
+    リストが空の場合はステレオの空サンプル列を返却する。
+    '''
+    if len(samples_list) == 0:
+        return numpy.empty((0, 2), sample_format)
+    length = sum([s.shape[0] for s in samples_list])
+    result = numpy.empty((length,) + samples_list[0].shape[1:], sample_format)
+    offset = 0
+    for s in samples_list:
+        result[offset:offset+s.shape[0]] = s
+        offset += s.shape[0]
+    return result
+
 def where_nearest(array, query):
     '''
     array 中の query に最も近い要素のインデックスを得る
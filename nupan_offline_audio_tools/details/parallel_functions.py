@@ -0,0 +1,106 @@
+import concurrent.futures
+
+from .default_constants import *
+
+# ------------------------------------------------------------------------------
+# functions
+# ------------------------------------------------------------------------------
+
+def parse_jobs_option(args):
+    '''
+    コマンドライン引数 args から並列数の指定 "--jobs N" を取り除く。\n
+    (並列数, 残りの引数リスト) を返却する。指定がない場合の並列数は 1 。\n
+    並列数が不正な場合は RuntimeError を送出する。
+    '''
+    jobs = 1
+    remain_args = []
+    arg_iter = iter(args)
+    for arg in arg_iter:
+        if arg == '--jobs':
+            value = next(arg_iter, None)
+        elif arg.startswith('--jobs='):
+            value = arg[len('--jobs='):]
+        else:
+            remain_args.append(arg)
+            continue
+        if value is None or not value.isdigit() or int(value) < 1:
+            raise RuntimeError('Invalid --jobs value : %s' % value)
+        jobs = int(value)
+    return jobs, remain_args
+
+def map_in_process_pool(function, iterable, jobs):
+    '''
+    iterable の各要素に function を適用した結果を、入力と同じ順序のリストで返却する。\n
+    jobs が 2 以上の場合はプロセスプールで並列に実行する。\n
+    function と引数はプロセス間で受け渡されるので、モジュールのトップレベルで定義されている事。
+    '''
+    if jobs <= 1:
+        return [function(i) for i in iterable]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(function, iterable))
+
+def imap_unordered_in_process_pool(function, iterable, jobs):
+    '''
+    map_in_process_pool() と同じだが、結果をリストにまとめずに (iterable 中の位置, 結果) を完了した順に yield する。\n
+    受け取った結果を呼び出し側で順に片付ければ、全ての結果を同時にメモリ上に保持しない。
+    '''
+    if jobs <= 1:
+        for index, item in enumerate(iterable):
+            yield index, function(item)
+        return
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        pending = {executor.submit(function, item): index for index, item in enumerate(iterable)}
+        for future in concurrent.futures.as_completed(pending):
+            yield pending.pop(future), future.result()
+
+def map_in_process_pool_bounded(function, iterable, costs, jobs, budget):
+    '''
+    map_in_process_pool() と同じだが、実行中のタスクの推定メモリ量 costs （ iterable と同順）の合計が budget を超えないように、\n
+    先に投入したタスクの完了を待ってから次のタスクを投入する。\n
+    単独で budget を超えるタスクは、実行中のタスクが全て終わってから１つだけで実行される。
+    '''
+    items = list(iterable)
+    costs = list(costs)
+    if jobs <= 1:
+        return [function(i) for i in items]
+    results = [None] * len(items)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        running = {}
+        in_flight = 0
+        def wait_one():
+            nonlocal in_flight
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                index, cost = running.pop(future)
+                results[index] = future.result()
+                in_flight -= cost
+        for index, (item, cost) in enumerate(zip(items, costs)):
+            while 0 < len(running) and budget < in_flight + cost:
+                wait_one()
+            running[executor.submit(function, item)] = (index, cost)
+            in_flight += cost
+        while 0 < len(running):
+            wait_one()
+    return results
+
+def parse_memory_budget_option(args):
+    '''
+    コマンドライン引数 args から推定メモリ量の上限の指定 "--memory-budget MiB" を取り除く。\n
+    (上限[byte], 残りの引数リスト) を返却する。指定がない場合は POOL_MEMORY_BUDGET 。\n
+    指定が不正な場合は RuntimeError を送出する。
+    '''
+    budget = POOL_MEMORY_BUDGET
+    remain_args = []
+    arg_iter = iter(args)
+    for arg in arg_iter:
+        if arg == '--memory-budget':
+            value = next(arg_iter, None)
+        elif arg.startswith('--memory-budget='):
+            value = arg[len('--memory-budget='):]
+        else:
+            remain_args.append(arg)
+            continue
+        if value is None or not value.isdigit() or int(value) < 1:
+            raise RuntimeError('Invalid --memory-budget value : %s' % value)
+        budget = int(value) * 2 ** 20
+    return budget, remain_args
@@ -2,9 +2,9 @@ import numpy
 
 from .helper_functions import argextrema
 from .helper_functions import compose_samples
+from .helper_functions import to_ratio
 from .filter_functions import apply_zplr
 
-import matplotlib.pyplot as plt
 from statistics import mean
 
 # ------------------------------------------------------------------------------
@@ -129,35 +129,34 @@ def _complete_zerocross_period(source_zerocross_offset, candidate_zerocross_offs
     '''
     周期情報を元にゼロクロス点を補完する。
     _filter_extrema_period() によってアウトライアが除去された状態の極値が与えられる事を仮定する。
+    欠損区間ごとの補完は互いに独立なので、全ての欠損区間を配列としてまとめて１周期ずつ埋めていく。
     '''
-    result_offset = source_zerocross_offset
-    # 欠損箇所がなくなるまで繰り返す(頭が悪い) 
-    while True:
-        # 欠損箇所を検出
-        tolerance_max_distance = period * (1.0 + torelence_period_error_rate)
-        extrema_distance = numpy.diff(result_offset)    
-        corrupt_zerocross_arg = numpy.where( tolerance_max_distance < extrema_distance)
-        corrupt_zerocross_offset = result_offset[corrupt_zerocross_arg]
-        # 欠損がなければ終了
-        if corrupt_zerocross_offset.shape[0] == 0:
-            break
-        # 付加するべきオフセット値を列挙
-        augumented_offset = numpy.empty(corrupt_zerocross_offset.shape[0], int)
-        for i in range(0, corrupt_zerocross_offset.shape[0]):
-            expected_offset = corrupt_zerocross_offset[i] + period
-            torelance_error = period * torelence_period_error_rate
-            expected_offset_lower = expected_offset - torelance_error
-            expected_offset_upper = expected_offset + torelance_error
-            query_result = candidate_zerocross_offset[candidate_zerocross_offset <= expected_offset_upper]
-            query_result = query_result[expected_offset_lower <= query_result]
-            if query_result.size == 0:
-                augumented_offset[i] = expected_offset
-            else:
-                augumented_offset[i] = query_result[int(query_result.size/2)]
-        # 返却値を更新
-        result_offset = numpy.unique(numpy.sort(numpy.append(result_offset, augumented_offset)))
+    tolerance_max_distance = period * (1.0 + torelence_period_error_rate)
+    torelance_error = period * torelence_period_error_rate
+    # 欠損箇所を検出
+    corrupt_arg = numpy.where(tolerance_max_distance < numpy.diff(source_zerocross_offset))[0]
+    # 欠損がなければ終了
+    if corrupt_arg.size == 0:
+        return source_zerocross_offset
+    # 欠損区間の始点を終点に届くまで１周期ずつ進める
+    current_offset = source_zerocross_offset[corrupt_arg]
+    end_offset = source_zerocross_offset[corrupt_arg + 1]
+    augumented_offsets = [source_zerocross_offset]
+    while current_offset.size != 0:
+        # 期待位置の許容範囲内にある候補のうち中央のものを選択、候補がなければ期待位置そのものを使う
+        expected_offset = current_offset + period
+        lower_arg = numpy.searchsorted(candidate_zerocross_offset, expected_offset - torelance_error, 'left')
+        upper_arg = numpy.searchsorted(candidate_zerocross_offset, expected_offset + torelance_error, 'right')
+        query_count = upper_arg - lower_arg
+        query_arg = numpy.minimum(lower_arg + query_count // 2, candidate_zerocross_offset.size - 1)
+        augumented_offset = numpy.where(query_count == 0, expected_offset, candidate_zerocross_offset[query_arg]).astype(int)
+        augumented_offsets.append(augumented_offset)
+        # まだ欠損している区間だけを残す
+        is_corrupt = tolerance_max_distance < end_offset - augumented_offset
+        current_offset = augumented_offset[is_corrupt]
+        end_offset = end_offset[is_corrupt]
     # 正常終了
-    return  result_offset
+    return numpy.unique(numpy.concatenate(augumented_offsets))
 
 def detect_click(samples, peak_amplitude_threshold, torelence_period_error_rate):
     '''
@@ -208,9 +207,8 @@ def detect_click(samples, peak_amplitude_threshold, torelence_period_error_rate)
     #plt.plot(extrema_offset, extrema_amplitude, "co")
 
     # ゼロクロスピークの開始オフセットを元にゼロクロス位置を検出、ピーク位置とする
-    click_zerocross_offset = numpy.empty(extrema_offset.shape[0], int)
-    for arg in range(0, extrema_offset.size): # この処理どう考えても重い
-        click_zerocross_offset[arg] = samples_zerocross_offset[extrema_offset[arg] < samples_zerocross_offset][0]
+    # note 各極値より後ろにある最初のゼロクロス位置を二分探索でまとめて求める
+    click_zerocross_offset = samples_zerocross_offset[numpy.searchsorted(samples_zerocross_offset, extrema_offset, 'right')]
     # ゼロクロスピークの間隔の中央値を波形の周期とみなす
     estimated_period = numpy.median(click_zerocross_offset[1:]-click_zerocross_offset[0:-1])
 
@@ -247,6 +245,21 @@ def detect_positive_zero_cross(samples):
     # 正常終了
     return samples_zerocross_offset
 
+def detect_negative_to_positive_zero_cross(samples):
+    '''
+    samples 中の負から正へのゼロクロスポイントを全て検出する。\n
+    ゼロクロスポイントは samples 先頭からのサンプル数で返却される。\n
+    detect_positive_zero_cross() と違い、次のサンプルが正の値を取り、\n
+    そのサンプルが負か、ゼロの場合はその前の最後のゼロでないサンプルが負であるものだけを返却する。\n
+    正→ゼロ→正のようにゼロに触れるだけのものはゼロクロスとしない。\n
+    '''
+    # ゼロのサンプルはその前の最後のゼロでないサンプルの符号で置き換える
+    signs = numpy.sign(samples)
+    last_nonzero = numpy.where(signs != 0, numpy.arange(samples.shape[0]), 0)
+    numpy.maximum.accumulate(last_nonzero, out=last_nonzero)
+    signs = signs[last_nonzero]
+    return numpy.where((signs[:-1] < 0) & (0 < samples[1:]))[0]
+
 def detect_positive_extrema(samples):
     '''
     samples 中の「極値」を検出する。\n
@@ -262,44 +275,164 @@ def detect_positive_extrema(samples):
     extremas = argextrema(samples)
 
     # 負の方向の極値→正の方向の極値になるものを探索
-    '''
-    @note:
-        いい手が思いつかなかったのでナイーブに for で実装。            
-    '''
-    selected_extremas = numpy.empty((0,), numpy.int64)
-    for i in range(1, extremas.shape[0]):
-        if samples[extremas[i-1]] < 0 and 0 < samples[extremas[i]]:
-            selected_extremas = numpy.append(selected_extremas, extremas[i])
+    extrema_amplitude = samples[extremas]
+    selected_extremas = extremas[1:][(extrema_amplitude[:-1] < 0) & (0 < extrema_amplitude[1:])]
 
     # 正常終了
     return selected_extremas
 
+def _moving_mean(samples, window_size):
+    '''
+    samples の第０軸方向の移動平均を累積和で計算する。\n
+    結果は numpy.convolve(..., 'valid') と同じく samples.shape[0] - window_size + 1 サンプルとなる。\n
+    累積和は単精度の入力でも倍精度で計算するので、結果は倍精度となる。\n
+    '''
+    # note 単精度の累積和は長い入力で桁落ちして窓の差が意味をなさなくなる
+    cumsum = numpy.cumsum(samples, 0, dtype=numpy.float64)
+    # note 中間配列を増やさないように累積和の配列上で in-place に計算する
+    window_sum = cumsum[window_size-1:]
+    window_sum[1:] -= cumsum[:-window_size]
+    window_sum /= window_size
+    # note 桁落ちで負にならないようにする
+    return numpy.maximum(window_sum, 0.0, out=window_sum)
+
 def convert_to_median_rms(samples, window_size):
     '''
     引数 samples を RMS に変換する。
     あるサンプル位置における RMS をその位置の前後 +- window_size / 2 サンプルの範囲で計算し
     その結果として得られた RMS 配列の中央値を samples の RMS とみなす。
     '''
-    per_ch_rms = []
-    window = numpy.ones(window_size) / window_size
-    for i in range(0, samples.shape[1]):
-        samples_ch = samples[:,i]
-        samples_s = samples_ch * samples_ch
-        samples_ms = numpy.convolve(samples_s, window, 'valid')
-        samples_ms.sort()
-        median_rms = numpy.sqrt(samples_ms[int(len(samples_ms)/2)])
-        per_ch_rms.append(median_rms)
-    return mean(per_ch_rms)
+    samples_s = samples * samples
+    # note window_size より短い場合は convolve と同じ結果になるようにゼロを詰める
+    if samples_s.shape[0] < window_size:
+        samples_s = numpy.pad(samples_s, ((0, window_size - samples_s.shape[0]), (0, 0)), 'constant')
+    samples_ms = _moving_mean(samples_s, window_size)
+    median_arg = int(samples_ms.shape[0]/2)
+    samples_ms.partition(median_arg, 0)
+    return mean(numpy.sqrt(samples_ms[median_arg]).tolist())
+
+class decibel_median_sketch:
+    '''
+    振幅の中央値をデシベルのヒストグラムで近似的に求める。\n
+    メモリ使用量は追加したサンプル数に依存せず、誤差は resolution / 2 dB 以内。\n
+    floor 未満と ceiling 以上の振幅はそれぞれ両端のビンに数えられる。\n
+    '''
+    def __init__(self, resolution=MEDIAN_SKETCH_RESOLUTION, floor=MEDIAN_SKETCH_FLOOR, ceiling=MEDIAN_SKETCH_CEILING):
+        self.resolution = resolution
+        self.floor = floor
+        self.histogram = numpy.zeros(int(numpy.ceil((ceiling - floor) / resolution)), numpy.int64)
+
+    def add(self, amplitudes):
+        '振幅（0 以上の比率）の配列を追加'
+        with numpy.errstate(divide='ignore'):
+            decibels = 20 * numpy.log10(numpy.ravel(amplitudes))
+        bins = numpy.clip(numpy.floor((decibels - self.floor) / self.resolution), 0, self.histogram.size - 1)
+        self.histogram += numpy.bincount(bins.astype(int), minlength=self.histogram.size)
+
+    def count(self):
+        '追加されたサンプル数'
+        return int(self.histogram.sum())
+
+    def median(self):
+        'sort() した配列の int(len/2) 番目の要素に相当する振幅を返却'
+        cumsum = numpy.cumsum(self.histogram)
+        if cumsum[-1] == 0:
+            raise RuntimeError('No samples added to decibel_median_sketch')
+        median_bin = numpy.searchsorted(cumsum, int(cumsum[-1]/2), 'right')
+        return to_ratio(self.floor + (median_bin + 0.5) * self.resolution)
+
+class _median_window_estimator:
+    '''
+    窓ごとの値の中央値（チャンネル平均）をブロック単位で近似的に計算する。\n
+    ブロックをまたぐ窓は直前の window_size - 1 サンプルを保持して計算する。\n
+    メモリ使用量はファイル長に依存しない。\n
+    派生クラスは _prepare() と _convert() を実装する。\n
+    '''
+    def __init__(self, window_size, channels):
+        self.window_size = window_size
+        self.channels = channels
+        self.reset()
+
+    def reset(self):
+        '内部状態を初期化'
+        self.sketches = [decibel_median_sketch() for _ in range(self.channels)]
+        self._tail = numpy.empty((0, self.channels))
+        self._length = 0
+
+    def process(self, samples):
+        'ブロックを１つ追加'
+        buffer = numpy.concatenate([self._tail, self._prepare(samples)])
+        self._length += samples.shape[0]
+        if self.window_size <= buffer.shape[0]:
+            converted = self._convert(buffer)
+            for ch in range(self.channels):
+                self.sketches[ch].add(converted[:,ch])
+        self._tail = buffer[max(0, buffer.shape[0]-(self.window_size-1)):].copy()
+
+    def result(self):
+        'これまでに追加されたブロック全体の中央値（チャンネル平均）を返却'
+        # note 全体が window_size より短い場合はゼロを詰めた窓１つとみなす
+        if self._length < self.window_size:
+            padded = numpy.pad(self._tail, ((0, self.window_size - self._tail.shape[0]), (0, 0)), 'constant')
+            return mean(self._convert(padded)[0].tolist())
+        return mean([sketch.median() for sketch in self.sketches])
+
+class median_rms_estimator(_median_window_estimator):
+    '''
+    convert_to_median_rms() をブロック単位で近似的に計算する。\n
+    使い方は _median_window_estimator を参照。\n
+    '''
+    def _prepare(self, samples):
+        return samples * samples
+
+    def _convert(self, samples_s):
+        return numpy.sqrt(_moving_mean(samples_s, self.window_size))
+
+class median_peak_estimator(_median_window_estimator):
+    '''
+    convert_to_median_peak() をブロック単位で近似的に計算する。\n
+    使い方は _median_window_estimator を参照。\n
+    '''
+    def _prepare(self, samples):
+        return numpy.abs(samples)
+
+    def _convert(self, samples_abs):
+        return _moving_max(samples_abs, self.window_size)
+
+def _moving_max(samples, window_size):
+    '''
+    samples の第０軸方向の移動最大値を計算する。\n
+    結果は samples.shape[0] - window_size + 1 サンプルとなる。\n
+    van Herk / Gil-Werman 法で window_size ごとのブロック内の前方・後方累積最大値を求め、
+    各窓はその２つの最大値として O(n) で計算する。チャンネルはまとめて処理される。\n
+    '''
+    length = samples.shape[0]
+    block_count = -(-length // window_size)
+    padded = numpy.full((block_count * window_size,) + samples.shape[1:], -numpy.inf, samples.dtype)
+    padded[:length] = samples
+    blocks = padded.reshape((block_count, window_size) + samples.shape[1:])
+    # ブロック末尾からの累積最大値とブロック先頭からの累積最大値
+    # note 中間配列を増やさないように out で書き込む
+    backward_max = numpy.empty_like(padded)
+    numpy.maximum.accumulate(blocks[:,::-1], 1, out=backward_max.reshape(blocks.shape)[:,::-1])
+    forward_max = numpy.maximum.accumulate(blocks, 1, out=blocks).reshape(padded.shape)
+    result = backward_max[:length-window_size+1]
+    return numpy.maximum(result, forward_max[window_size-1:length], out=result)
 
 def convert_to_median_peak(samples, window_size):
     '''
     引数 samples をピークの配列に変換する。
-    あるサンプル位置におけるピークをその位置の前後 +- window_size / 2 サンプルの範囲で計算されし
-    その結果として得られたピーク配列の中央値を samples の RMS とみなす。
+    あるサンプル位置におけるピーク（絶対値の最大値）をその位置の前後 +- window_size / 2 サンプルの範囲で計算し
+    その結果として得られたピーク配列の中央値（チャンネル平均）を samples のピークとみなす。
     '''
-    samples_peak = scipy.ndimage.filters.maximum_filter1d(samples, window_size)
-    samples_peak.sort()
-    return samples_peak[int(len(samples_peak)/2)]
+    samples_abs = numpy.abs(samples)
+    # note window_size より短い場合はゼロを詰める
+    if samples_abs.shape[0] < window_size:
+        samples_abs = numpy.pad(samples_abs, ((0, window_size - samples_abs.shape[0]), (0, 0)), 'constant')
+    samples_peak = _moving_max(samples_abs, window_size)
+    median_arg = int(samples_peak.shape[0]/2)
+    samples_peak.partition(median_arg, 0)
+    return mean(samples_peak[median_arg].tolist())
 
 def detect_zerocross_points(samples):
     '''
@@ -0,0 +1,144 @@
+import collections
+import os
+import shutil
+import tempfile
+
+import numpy
+
+from .default_constants import *
+
+# ------------------------------------------------------------------------------
+# classes
+# ------------------------------------------------------------------------------
+
+class band_store:
+    '''
+    バンド波形などの中間結果のサンプル列をキーごとに保持するストア。\n
+    メモリ上に保持するサンプル列の合計が ram_ceiling バイトを超えると、最も長く使われていないものから\n
+    scratch_dir 下の .npy ファイルに退避し、以降は読み取り専用のメモリマップとして返却する。\n
+    numpy.memmap は既にディスク上にあるので、メモリ上の合計には数えない。\n
+    scratch_dir を省略した場合は最初に退避する時に一時ディレクトリを作る。 close() で退避したファイルは削除される。\n
+    get() で返却したメモリマップが生きている間は退避ファイルを削除できない環境（ Windows ）があるので、\n
+    削除に失敗したファイルは close() まで削除を遅らせる。
+    '''
+
+    def __init__(self, ram_ceiling=STORE_RAM_CEILING, scratch_dir=None):
+        self.ram_ceiling = ram_ceiling
+        self.scratch_dir = scratch_dir
+        self.resident_bytes = 0
+        self.spill_count = 0
+        self._is_own_scratch_dir = False
+        # note 先頭が最も長く使われていないもの
+        self._resident = collections.OrderedDict()
+        self._spilled = {}
+        # note 削除を遅らせている退避ファイル
+        self._deferred_paths = []
+
+    def put(self, key, samples):
+        'キー key でサンプル列 samples を保持する。同じキーの古いサンプル列は破棄される。'
+        self.delete(key)
+        self._resident[key] = samples
+        self.resident_bytes += _resident_nbytes(samples)
+        self._spill_over_ceiling()
+
+    def get(self, key):
+        '''
+        キー key のサンプル列を返却する。\n
+        退避されたものは読み取り専用のメモリマップなので、書き換える場合は put() しなおす事。
+        '''
+        if key in self._resident:
+            self._resident.move_to_end(key)
+            return self._resident[key]
+        return numpy.load(self._spilled[key], mmap_mode='r')
+
+    def delete(self, key):
+        'キー key のサンプル列を破棄する、存在しない場合は何もしない'
+        if key in self._resident:
+            self.resident_bytes -= _resident_nbytes(self._resident.pop(key))
+        elif key in self._spilled:
+            self._remove_spilled_file(self._spilled.pop(key))
+
+    def _remove_spilled_file(self, path):
+        '退避ファイル path を削除する、メモリマップが使用中で削除できない場合は close() まで遅らせる'
+        try:
+            os.remove(path)
+        except OSError:
+            self._deferred_paths.append(path)
+
+    def __contains__(self, key):
+        return key in self._resident or key in self._spilled
+
+    def _spill_over_ceiling(self):
+        'メモリ上の合計が ram_ceiling 以下になるまで最も長く使われていないものから退避する'
+        for key in list(self._resident.keys()):
+            if self.resident_bytes <= self.ram_ceiling:
+                break
+            samples = self._resident[key]
+            if _resident_nbytes(samples) == 0:
+                continue
+            if self.scratch_dir is None:
+                self.scratch_dir = tempfile.mkdtemp(prefix='nupan_store_')
+                self._is_own_scratch_dir = True
+            os.makedirs(self.scratch_dir, exist_ok=True)
+            path = os.path.join(self.scratch_dir, '%d.npy' % self.spill_count)
+            numpy.save(path, samples)
+            del self._resident[key]
+            self.resident_bytes -= samples.nbytes
+            self._spilled[key] = path
+            self.spill_count += 1
+
+    def close(self):
+        '全てのサンプル列を破棄し、退避したファイルを削除する'
+        for key in list(self._spilled.keys()):
+            self.delete(key)
+        self._resident.clear()
+        self.resident_bytes = 0
+        # note 呼び出し側がまだメモリマップを保持している場合は削除できないので、残ったファイルは諦める
+        deferred_paths, self._deferred_paths = self._deferred_paths, []
+        for path in deferred_paths:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        if self._is_own_scratch_dir:
+            shutil.rmtree(self.scratch_dir, ignore_errors=True)
+            self.scratch_dir = None
+            self._is_own_scratch_dir = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# ------------------------------------------------------------------------------
+# functions
+# ------------------------------------------------------------------------------
+
+def _resident_nbytes(samples):
+    'samples がメモリ上に占めるバイト数、メモリマップは 0'
+    if isinstance(samples, numpy.memmap):
+        return 0
+    return samples.nbytes
+
+def parse_ram_ceiling_option(args):
+    '''
+    コマンドライン引数 args から中間結果ストアのメモリ上限の指定 "--ram-ceiling MiB" を取り除く。\n
+    (上限[byte], 残りの引数リスト) を返却する。指定がない場合は STORE_RAM_CEILING 。\n
+    指定が不正な場合は RuntimeError を送出する。
+    '''
+    ceiling = STORE_RAM_CEILING
+    remain_args = []
+    arg_iter = iter(args)
+    for arg in arg_iter:
+        if arg == '--ram-ceiling':
+            value = next(arg_iter, None)
+        elif arg.startswith('--ram-ceiling='):
+            value = arg[len('--ram-ceiling='):]
+        else:
+            remain_args.append(arg)
+            continue
+        if value is None or not value.isdigit():
+            raise RuntimeError('Invalid --ram-ceiling value : %s' % value)
+        ceiling = int(value) * 2 ** 20
+    return ceiling, remain_args
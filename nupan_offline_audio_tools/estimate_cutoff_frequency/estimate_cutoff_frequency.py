@@ -8,11 +8,10 @@ from functools import partial
 
 import numpy
 import scipy.fftpack 
+from scipy import signal
 
 from details import *
 
-import matplotlib.pyplot as plt
-
 # ------------------------------------------------------------------------------
 # constants
 # ------------------------------------------------------------------------------
@@ -30,7 +29,7 @@ SAMPLE_RATE = 48000
 FILTER_TYPE = 'high'
 
 # 許容リップルゲイン
-ALLOW_RIPPLE = 3
+ALLOW_RIPPLE = CHEBY_RIPPLE
 
 # ------------------------------------------------------------------------------
 # implementation
@@ -98,20 +97,6 @@ def calculate_frequency_response(filter_function, frequency, order):
     # 正常終了
     return FREQUENCY_LIST, FFT_AMPLITUDE_DIFF, FFT_PHASE_DIFF
 
-def query_frequency_from_apmlitude_response(frequency_list, response_amplitude, query_gain):
-    ARG = numpy.argmin(numpy.abs(response_amplitude - query_gain))
-    return frequency_list[ARG], response_amplitude[ARG]
-
-def query_amplitude_response_from_frequency(frequency_list, response_amplitude, query_frequency):
-    ARG = numpy.argmin(numpy.abs(frequency_list - query_frequency))
-    return frequency_list[ARG], response_amplitude[ARG]
-
-def estimate_optimal_cutoff_freqency(filter_function, base_frequency, order, target_gain, target_frequency):
-    FREQUENCY_LIST, RESPONSE_AMPLITUDE, RESPONSE_PHASE = calculate_frequency_response(filter_function, base_frequency, order)
-    found_frequency, _ = query_frequency_from_apmlitude_response(FREQUENCY_LIST, RESPONSE_AMPLITUDE, target_gain)
-    return base_frequency * (target_frequency / found_frequency)
-
-
 # ------------------------------------------------------------------------------
 # main
 # ------------------------------------------------------------------------------
@@ -126,18 +111,38 @@ if __name__ == '__main__':
     # ファイルから設定をロード
     config = configparser.ConfigParser()
     config.read(sys.argv[1])
-    if config['behavior']['FILTER_TYPE'] == 'butter':
+
+    # [table] セクションがあればカットオフ表をまとめて計算して保存（プロットしない）
+    if 'table' in config:
+        try:
+            TABLE = compute_cutoff_table(
+                [v.strip() for v in config['table']['FILTER_TYPE'].split(',')],
+                [v.strip() for v in config['table']['FILTER_MODE'].split(',')],
+                [int(v) for v in config['table']['FILTER_ORDER'].split(',')],
+                [float(v) for v in config['table']['TARGET_GAIN'].split(',')],
+                [float(v) for v in config['table']['TARGET_FREQ'].split(',')],
+                [int(v) for v in config['table']['SAMPLE_RATE'].split(',')],
+                [string2bool(v.strip()) for v in config['table']['IS_ZERO_PHASE'].split(',')])
+            OUTPUT_PATH = os.path.join(os.path.dirname(os.path.abspath(sys.argv[1])), config['table']['OUTPUT'])
+            save_cutoff_table(OUTPUT_PATH, TABLE)
+        except RuntimeError as err:
+            print(err)
+            exit(1)
+        print('%d cutoff frequencies (%d unreachable) are saved to "%s".' % (TABLE['cutoff_frequency'].size, numpy.isnan(TABLE['cutoff_frequency']).sum(), OUTPUT_PATH))
+        exit(0)
+    FILTER_NAME = config['behavior']['FILTER_TYPE']
+    if FILTER_NAME == 'butter':
         FILTER_FUNCTION = apply_butter_worth
-    elif config['behavior']['FILTER_TYPE'] == 'cheby':
+    elif FILTER_NAME == 'cheby':
         FILTER_FUNCTION = apply_chebyshev_1st
     else:
         print('invalid FILTER_TYPE.')
         exit(1)
-    FILTER_FUNCTION = partial(FILTER_FUNCTION, is_zero_phase=bool( config['behavior']['IS_ZERO_PHASE'] ) )
+    IS_ZERO_PHASE = string2bool(config['behavior']['IS_ZERO_PHASE'])
+    FILTER_FUNCTION = partial(FILTER_FUNCTION, is_zero_phase=IS_ZERO_PHASE)
     FILTER_ORDER = int(config['behavior']['FILTER_ORDER'])
     TARGET_GAIN = int(config['behavior']['TARGET_GAIN'])
     TARGET_FREQ = int(config['behavior']['TARGET_FREQ'])
-    ITERATION_COUNT = int(config['behavior']['ITERATION_COUNT'])
     QUERY_FREQ = [int(s) for s in config['display']['QUERY_FREQ'].split(',')]
     PLOT_MIN_FREQ = int(config['display']['PLOT_MIN_FREQ'])
     PLOT_MAX_FREQ = int(config['display']['PLOT_MAX_FREQ'])
@@ -146,26 +151,26 @@ if __name__ == '__main__':
     PLOT_MIN_PHASE = int(config['display']['PLOT_MIN_PHASE'])
     PLOT_MAX_PHASE = int(config['display']['PLOT_MAX_PHASE'])
 
-    # 最適なカットオフ周波数を推定
-    WORKING_CUTOFF_FREQUENCY = TARGET_FREQ
-    OPTIMAL_CUTOFF_FREQUENCY = TARGET_FREQ
-    OPTIMAL_ERROR = float('inf')
-    for i in range(1, 1000):
-        WORKING_CUTOFF_FREQUENCY = estimate_optimal_cutoff_freqency(FILTER_FUNCTION, WORKING_CUTOFF_FREQUENCY, FILTER_ORDER, TARGET_GAIN, TARGET_FREQ)
-        FREQUENCY_LIST, RESPONSE_AMPLITUDE, RESPONSE_PHASE = calculate_frequency_response(FILTER_FUNCTION, WORKING_CUTOFF_FREQUENCY, FILTER_ORDER)
-        WORKING_ERROR = numpy.abs(query_amplitude_response_from_frequency(FREQUENCY_LIST, RESPONSE_AMPLITUDE, TARGET_FREQ)[1] - TARGET_GAIN)
-        if WORKING_ERROR < OPTIMAL_ERROR:
-            OPTIMAL_CUTOFF_FREQUENCY = WORKING_CUTOFF_FREQUENCY
-            OPTIMAL_ERROR = WORKING_ERROR
-
-    # イテレーション中で見つけた最適なカットオフ周波数で再計算
-    FREQUENCY_LIST, RESPONSE_AMPLITUDE, RESPONSE_PHASE = calculate_frequency_response(FILTER_FUNCTION, OPTIMAL_CUTOFF_FREQUENCY, FILTER_ORDER)
+    # 最適なカットオフ周波数を周波数応答の根として直接求める
+    try:
+        OPTIMAL_CUTOFF_FREQUENCY = solve_cutoff_frequency(FILTER_NAME, FILTER_TYPE, FILTER_ORDER, TARGET_GAIN, TARGET_FREQ, SAMPLE_RATE, IS_ZERO_PHASE)
+    except RuntimeError as err:
+        print(err)
+        exit(1)
     print('cutoff=%f' % (OPTIMAL_CUTOFF_FREQUENCY,))
     for f in QUERY_FREQ:
-        RESULT_FREQ, RESULT_AMPLITUDE = query_amplitude_response_from_frequency(FREQUENCY_LIST, RESPONSE_AMPLITUDE, f)
-        print('amplitude@%.2fHz=%.2f' % (RESULT_FREQ, RESULT_AMPLITUDE, ) )
+        print('amplitude@%.2fHz=%.2f' % (f, query_filter_gain(FILTER_NAME, FILTER_TYPE, FILTER_ORDER, OPTIMAL_CUTOFF_FREQUENCY, SAMPLE_RATE, IS_ZERO_PHASE, f)))
+
+    # プロット用にインパルス応答から周波数特性を計算
+    FREQUENCY_LIST, RESPONSE_AMPLITUDE, RESPONSE_PHASE = calculate_frequency_response(FILTER_FUNCTION, OPTIMAL_CUTOFF_FREQUENCY, FILTER_ORDER)
 
     # 結果をプロット
+    # note matplotlib は読み込みに時間がかかり、 [table] の一括計算では不要なのでプロットする時だけ読み込む
+    try:
+        import matplotlib.pyplot as plt
+    except ImportError:
+        print('matplotlib is required to plot the frequency response.')
+        exit(1)
     plt.subplot(2, 1, 1)
     plt.xscale('log')
     plt.grid(which='major',color='black',linestyle='-')
@@ -1,7 +1,11 @@
 import os
 import sys
 import glob
+import contextlib
+import shutil
+import tempfile
 from fractions import Fraction   
+from functools import partial
 import configparser
 
 import numpy
@@ -27,11 +31,13 @@ class band_param:
         self.lower_mode = 'high'
         self.lower_order = 2
         self.lower_freq = 20
+        self.lower_target = None
         self.lower_is_zero_phase = True
         self.upper_type = 'butter'
         self.upper_mode = 'low'
         self.upper_order = 2
         self.upper_freq = 20000
+        self.upper_target = None
         self.upper_is_zero_phase = True
         self.normalization_mode = 'none'
         self.normalization_target_override = False
@@ -40,44 +46,46 @@ class band_param:
         self.is_file_out = False
         self.postfix = ''
 
+class multiband_parameters:
+    def __init__(self):
+        self.samplerate = 0
+        self.output_file_prefix = OUTPUT_FILE_PREFIX
+        self.output_file_sufix = ''
+        self.is_serial_connection = True
+        self.zero_phase_block_size = None
+        self.engine = 'iir'
+        self.cutoff_table_path = None
+        self.band_params = []
+
 # ------------------------------------------------------------------------------
-# main
+# multiband_tool メイン実装
 # ------------------------------------------------------------------------------
 
-if __name__ == '__main__':
-    # 引数チェック
-    if len(sys.argv)!=2:
-        print('Invalid number of arguments.')
-        exit(1)
+def load_frequency(section, key):
+    '設定ファイルのセクション section の key を周波数[Hz]として読み込む、数値でない場合は RuntimeError を送出する'
+    try:
+        return float(section[key])
+    except ValueError:
+        raise RuntimeError('Invalid %s in [%s] of loaded .ini file. "%s".' % (key, section.name, section[key]))
 
-    # エイリアス
-    INPUT_DIR = sys.argv[1]
-
-    # ディレクトリ以外の指定は NG
-    if not os.path.isdir(INPUT_DIR):
-        print('Specified path is not directory. "%s".' % INPUT_DIR)
-        exit(1)
-
-    # 指定ディレクトリ中の wav ファイルを列挙
-    WAV_FILES = find_wav_files(INPUT_DIR)
-    if WAV_FILES is None:
-        exit(1)
-
-    # 指定ファイル全てメモリ上にロード
-    INPUTS, SAMPLERATE = load_wav_files(WAV_FILES, INTERNAL_SAMPLE_FORMAT)
-
-    # 指定ディレクトリ中の ini ファイルを列挙
-    INI_FILE = find_ini_file(INPUT_DIR)
-    if INI_FILE is None:
-        exit(1)
-
-    # 補正処理の挙動を設定ファイルから読み込み
-    config = configparser.ConfigParser()
-    config.read(INI_FILE)
-    output_file_prefix = config['global']['output_file_prefix']
-    output_file_sufix = config['global']['output_file_sufix']
-    is_serial_connection = config['global']['connection_mode'] == 'serial'
-    band_params = []
+def load_parameters(config):
+    '''
+    設定ファイルの内容 config から multiband_parameters を生成する。\n
+    samplerate は設定されないので呼び出し側で設定する事。\n
+    "-3dB@120" 形式で指定されたカットオフ周波数は lower_target / upper_target に格納されるので、\n
+    samplerate を設定した後に resolve_cutoff_frequencies() で変換する事。\n
+    カットオフ周波数がどちらの形式でもない場合は RuntimeError を送出する。
+    '''
+    parameters = multiband_parameters()
+    parameters.output_file_prefix = config['global']['output_file_prefix']
+    parameters.output_file_sufix = config['global']['output_file_sufix']
+    parameters.is_serial_connection = config['global']['connection_mode'] == 'serial'
+    if 'zero_phase_block_size' in config['global']:
+        parameters.zero_phase_block_size = int(config['global']['zero_phase_block_size'])
+    if 'engine' in config['global']:
+        parameters.engine = config['global']['engine']
+    if 'cutoff_table' in config['global']:
+        parameters.cutoff_table_path = config['global']['cutoff_table']
     for section in config.sections():
         if section in ['global', 'DEFAULT'] :
             continue
@@ -85,12 +93,16 @@ if __name__ == '__main__':
         temp.lower_type = config[section]['lower_type']
         temp.lower_mode = config[section]['lower_mode']
         temp.lower_order = int(config[section]['lower_order'])
-        temp.lower_freq = float(config[section]['lower_freq'])
+        temp.lower_target = parse_cutoff_target(config[section]['lower_freq'])
+        if temp.lower_target is None:
+            temp.lower_freq = load_frequency(config[section], 'lower_freq')
         temp.lower_is_zero_phase = string2bool(config[section]['lower_is_zero_phase'])
         temp.upper_type = config[section]['upper_type']
         temp.upper_mode = config[section]['upper_mode']
         temp.upper_order = int(config[section]['upper_order'])
-        temp.upper_freq = float(config[section]['upper_freq'])
+        temp.upper_target = parse_cutoff_target(config[section]['upper_freq'])
+        if temp.upper_target is None:
+            temp.upper_freq = load_frequency(config[section], 'upper_freq')
         temp.upper_is_zero_phase = string2bool(config[section]['upper_is_zero_phase'])
         temp.normalization_mode = config[section]['normalization_mode']
         temp.normalization_target_override = string2bool(config[section]['normalization_target_override'])
@@ -98,91 +110,526 @@ if __name__ == '__main__':
         temp.gain = float(config[section]['gain'])
         temp.is_file_out = string2bool(config[section]['is_file_out'])
         temp.sufix = config[section]['sufix']
-        band_params.append(temp)
-
-    # 全ての wav ファイルに対してマルチバンド分離
-    for i in INPUTS:
-        temp_samples = i['stereo']
-        for param in band_params:
-            # バンド抽出
-            band = create_same_empty(temp_samples)
-            band[:] = temp_samples
-            if not param.lower_type == 'bypass':
-                band = apply_filter(band, param.lower_type, param.lower_mode, param.lower_order, param.lower_freq, SAMPLERATE, param.lower_is_zero_phase)
-            if not param.upper_type == 'bypass':
-                band = apply_filter(band, param.upper_type, param.upper_mode, param.upper_order, param.upper_freq, SAMPLERATE, param.upper_is_zero_phase)
-            # 抽出した分をオリジナルから減算
-            if is_serial_connection:
-                temp_samples = temp_samples - band
-            # バンド波形の基準量（ピークとかRMSとか）を計算
-            if param.normalization_mode=='none':
-                i['band_criteria_' + param.sufix] = 1.0
-            elif param.normalization_mode=='peak':
-                i['band_criteria_' + param.sufix] = convert_to_median_prak(band, time2sample(0.3, SAMPLERATE))
-            elif param.normalization_mode=='rms':
-                i['band_criteria_' + param.sufix] = convert_to_median_rms(band, time2sample(0.3, SAMPLERATE))
+        parameters.band_params.append(temp)
+    return parameters
+
+def resolve_cutoff_frequencies(parameters, base_dir):
+    '''
+    "-3dB@120" 形式で指定されたカットオフ周波数を parameters.samplerate における実際のカットオフ周波数に変換する。\n
+    parameters.cutoff_table_path （ base_dir からの相対パス）が指定されていればカットオフ表から引き、\n
+    なければ solve_cutoff_frequency() で求める。\n
+    変換できない場合は RuntimeError を送出する。
+    '''
+    table = None
+    if parameters.cutoff_table_path is not None:
+        table = load_cutoff_table(os.path.join(base_dir, parameters.cutoff_table_path))
+    def resolve(filter_type, filter_mode, filter_order, target, is_zero_phase):
+        args = (filter_type, filter_mode, filter_order, target[0], target[1], parameters.samplerate, is_zero_phase)
+        if table is None:
+            cutoff_frequency = solve_cutoff_frequency(*args)
+        else:
+            cutoff_frequency = lookup_cutoff_frequency(table, *args)
+        print('%s %s cutoff for %gdB@%gHz = %f Hz.' % (filter_type, filter_mode, target[0], target[1], cutoff_frequency))
+        return cutoff_frequency
+    for param in parameters.band_params:
+        if param.lower_target is not None and not param.lower_type == 'bypass':
+            param.lower_freq = resolve(param.lower_type, param.lower_mode, param.lower_order, param.lower_target, param.lower_is_zero_phase)
+        if param.upper_target is not None and not param.upper_type == 'bypass':
+            param.upper_freq = resolve(param.upper_type, param.upper_mode, param.upper_order, param.upper_target, param.upper_is_zero_phase)
+
+def band_filter_specs(param):
+    'band_param から split_bands() に渡すフィルタ指定のリストを生成する、 bypass のフィルタは除外される'
+    specs = []
+    if not param.lower_type == 'bypass':
+        specs.append((param.lower_type, param.lower_mode, param.lower_order, param.lower_freq, param.lower_is_zero_phase))
+    if not param.upper_type == 'bypass':
+        specs.append((param.upper_type, param.upper_mode, param.upper_order, param.upper_freq, param.upper_is_zero_phase))
+    return specs
+
+def band_split_parameter_hash(parameters):
+    'バンド分離と基準量の計算結果に影響するパラメータのハッシュ値、ノーマライズの目標値やゲインは含まない'
+    return hash_parameters(parameters.samplerate, parameters.is_serial_connection, parameters.zero_phase_block_size, parameters.engine, [(band_filter_specs(p), p.normalization_mode, p.sufix) for p in parameters.band_params], INTERNAL_SAMPLE_FORMAT)
+
+def compose_output_path(parameters, path, sufix):
+    '入力ファイル path に対応する、サフィックス sufix の出力ファイルのパス'
+    dir_path, stem, ext = decompose_path(path)
+    return dir_path + '\\' + parameters.output_file_prefix + stem + sufix + ext
+
+def extract_bands(input, parameters):
+    '''
+    input['stereo'] をバンド分離する。\n
+    結果はバンドごとに input['band_sample_<sufix>'] に、基準量（ピークとかRMSとか）は input['band_criteria_<sufix>'] に格納される。\n
+    バンド分離で確保されるメモリ量の概算（バイト数）は input['band_split_allocated'] に格納される。
+    '''
+    # 全バンドをまとめて分離
+    specs = [band_filter_specs(p) for p in parameters.band_params]
+    input['band_split_allocated'] = estimate_split_bands_allocation(input['stereo'], specs, parameters.samplerate, parameters.is_serial_connection, parameters.zero_phase_block_size, parameters.engine)
+    bands = split_bands(input['stereo'], specs, parameters.samplerate, parameters.is_serial_connection, parameters.zero_phase_block_size, parameters.engine)
+    for param, band in zip(parameters.band_params, bands):
+        # バンド波形の基準量（ピークとかRMSとか）を計算
+        if param.normalization_mode=='none':
+            input['band_criteria_' + param.sufix] = 1.0
+        elif param.normalization_mode=='peak':
+            input['band_criteria_' + param.sufix] = convert_to_median_peak(band, time2sample(0.3, parameters.samplerate))
+        elif param.normalization_mode=='rms':
+            input['band_criteria_' + param.sufix] = convert_to_median_rms(band, time2sample(0.3, parameters.samplerate))
+        else:
+            print('Invalid normalization_mode in loaded .ini file. Pass through normalization and continue.')            
+        # バンド波形を保存
+        input['band_sample_' + param.sufix] = band
+
+def extract_bands_to_scratch(parameters, scratch_dir, path):
+    '''
+    プロセスプールのワーカー用。\n
+    path の wav ファイルをロードしてバンド分離し、バンド波形を scratch_dir 下の .npy ファイルに書き出す。\n
+    バンド波形そのものは返却せず、基準量 band_criteria_<sufix> と .npy ファイルのパス band_file_<sufix> を持つ dict を返却する。\n
+    無音ファイルの場合は None を返却する。
+    '''
+    samples, samplerate = load_samples(path, INTERNAL_SAMPLE_FORMAT, mmap=True)
+    if is_slient_samples(samples):
+        return None
+    input = {'stereo': samples, 'path': path, 'samplerate': samplerate}
+    extract_bands(input, parameters)
+    result = {'path': path, 'samplerate': samplerate}
+    _, stem, _ = decompose_path(path)
+    for param in parameters.band_params:
+        band_file = os.path.join(scratch_dir, stem + param.sufix + '.npy')
+        numpy.save(band_file, input['band_sample_' + param.sufix])
+        result['band_file_' + param.sufix] = band_file
+        result['band_criteria_' + param.sufix] = input['band_criteria_' + param.sufix]
+    result['band_split_allocated'] = input['band_split_allocated']
+    return result
+
+def extract_bands_in_pool(wav_files, parameters, scratch_dir, jobs):
+    '''
+    wav_files のバンド分離を jobs 並列のプロセスプールで実行する。\n
+    バンド波形は scratch_dir 下の .npy をメモリマップして input['band_sample_<sufix>'] に格納される。\n
+    戻り値の形式は load_wav_files() でロードして extract_bands() を適用したものと同じ。\n
+    サンプルレートが parameters.samplerate と異なるファイルがある場合は RuntimeError を送出する。
+    '''
+    results = map_in_process_pool(partial(extract_bands_to_scratch, parameters, scratch_dir), wav_files, jobs)
+    inputs = []
+    for result in results:
+        # 無音サンプルはスキップ
+        if result is None:
+            continue
+        # サンプルレートをチェック
+        if result['samplerate'] != parameters.samplerate:
+            raise RuntimeError('Wrong sample rate is detected in input files. File = %s, expected sample rate = %d, actual sample rate = %d' % (result['path'], parameters.samplerate, result['samplerate']))
+        for param in parameters.band_params:
+            result['band_sample_' + param.sufix] = numpy.load(result['band_file_' + param.sufix], mmap_mode='r')
+        inputs.append(result)
+    return inputs
+
+def extract_bands_incremental(wav_files, parameters, cache, jobs):
+    '''
+    wav_files のうち波形データかバンド分離のパラメータが変わったファイルだけバンド分離する。\n
+    バンド波形と基準量は cache （ result_cache ）に保存され、変わっていないファイルはそこからメモリマップで読み込まれる。\n
+    ノーマライズの目標値やゲインはキーに含まれないので、それらを変えても再計算されない。\n
+    戻り値の形式は extract_bands_in_pool() と同じ。
+    '''
+    keys = [cache.key(hash_wav_file(p), band_split_parameter_hash(parameters)) for p in wav_files]
+    entries = [cache.load(k) for k in keys]
+
+    # キャッシュにないファイルだけバンド分離
+    missed_files = [p for p, entry in zip(wav_files, entries) if entry is None]
+    if 0 < len(missed_files):
+        # note 例外で中断された場合もプロセスプールの一時ディレクトリを削除する
+        scratch_dir = None
+        try:
+            if jobs == 1:
+                missed_inputs, _ = load_wav_files(missed_files, INTERNAL_SAMPLE_FORMAT, mmap=True)
+                for i in missed_inputs:
+                    extract_bands(i, parameters)
             else:
-                print('Invalid normalization_mode in loaded .ini file. Pass through normalization and continue.')            
-            # バンド波形を保存
-            i['band_sample_' + param.sufix] = band
+                scratch_dir = tempfile.mkdtemp(prefix='multiband_tool_')
+                missed_inputs = extract_bands_in_pool(missed_files, parameters, scratch_dir, jobs)
+            names = ['band_split_allocated'] + [prefix + p.sufix for p in parameters.band_params for prefix in ['band_sample_', 'band_criteria_']]
+            extracted = {i['path']: {name: i[name] for name in names} for i in missed_inputs}
+            del missed_inputs
+            for index, p in enumerate(wav_files):
+                if entries[index] is None:
+                    # 無音ファイルは空のエントリとして記録
+                    cache.save(keys[index], extracted.get(p, {}))
+                    entries[index] = cache.load(keys[index])
+            del extracted
+        finally:
+            if scratch_dir is not None:
+                shutil.rmtree(scratch_dir, ignore_errors=True)
+    cache.prune(keys)
+    print('%d of %d files are reused from cache.' % (len(wav_files) - len(missed_files), len(wav_files)))
+
+    inputs = []
+    for p, entry in zip(wav_files, entries):
+        if 0 < len(entry):
+            inputs.append(dict(entry, path=p))
+    return inputs
+
+def iterate_band_blocks(parameters, path, observe_source=None):
+    '''
+    path の wav ファイルをバンド分離し、長さを揃えたバンドごとのブロックのリストを順に返すジェネレータ。\n
+    engine が 'iir' の場合はファイルをブロック単位で読む split_bands_blocks() で処理するので、使用メモリ量はファイル長に依存しない。\n
+    ブロック長は zero_phase_block_size 、指定がなければ STREAM_BLOCK_SIZE 。\n
+    ゼロ位相フィルタの先頭・末尾は filtfilt と同じく奇対称に延長して処理されるので、zero_phase_block_size の指定がない\n
+    １パス処理（ filtfilt による一括処理）の結果と端点を含めて一致する。\n
+    engine が 'fft' の場合は入力全体の変換が必要なので、１ファイル分のバンド波形を１ブロックとして返す。\n
+    observe_source を指定した場合は、バンド分離する前の入力のブロックごとに observe_source(ブロック) を呼ぶ。
+    '''
+    specs = [band_filter_specs(p) for p in parameters.band_params]
+    if parameters.engine == 'fft':
+        samples, _ = load_samples(path, INTERNAL_SAMPLE_FORMAT, mmap=True)
+        if observe_source is not None:
+            observe_source(samples)
+        yield split_bands(samples, specs, parameters.samplerate, parameters.is_serial_connection, engine='fft')
+        return
+    block_size = parameters.zero_phase_block_size or STREAM_BLOCK_SIZE
+    blocks, _ = load_samples_blocks(path, INTERNAL_SAMPLE_FORMAT, block_size)
+    if observe_source is not None:
+        blocks = _observe_blocks(blocks, observe_source)
+    yield from split_bands_blocks(blocks, specs, parameters.samplerate, parameters.is_serial_connection)
+
+def _observe_blocks(blocks, observe):
+    'ブロックごとに observe(ブロック) を呼んでからそのまま返すジェネレータ'
+    for block in blocks:
+        observe(block)
+        yield block
+
+def measure_band_criteria(parameters, path):
+    '''
+    ２パス処理の１パス目。プロセスプールのワーカーとしても使う。\n
+    path の wav ファイルをバンド分離しながら、バンドごとの基準量を median_rms_estimator / median_peak_estimator で計算する。\n
+    バンド波形は保持しない。基準量 band_criteria_<sufix> とサンプルレート samplerate を持つ dict を返却する。\n
+    無音ファイル（空のファイルを含む）の場合は空の dict を返却する。\n
+    無音の判定に使う入力の最大値はバンド分離と同じパスで求めるので、ファイルは一度しか読まない。
+    '''
+    samplerate, _, channels = query_wav_info(path)
+    window_size = time2sample(0.3, parameters.samplerate)
+    estimators = []
+    for param in parameters.band_params:
+        if param.normalization_mode == 'rms':
+            estimators.append(median_rms_estimator(window_size, channels))
+        elif param.normalization_mode == 'peak':
+            estimators.append(median_peak_estimator(window_size, channels))
+        else:
+            if param.normalization_mode != 'none':
+                print('Invalid normalization_mode in loaded .ini file. Pass through normalization and continue.')
+            estimators.append(None)
+    source_max = -numpy.inf
+    def observe_source(block):
+        nonlocal source_max
+        if 0 < block.shape[0]:
+            source_max = max(source_max, float(numpy.max(block)))
+    for band_blocks in iterate_band_blocks(parameters, path, observe_source):
+        for estimator, block in zip(estimators, band_blocks):
+            if estimator is not None:
+                estimator.process(block)
+    # 無音ファイルは基準量を使わない
+    if source_max < SILENT_THRESHOLD:
+        return {}
+    result = {'samplerate': samplerate}
+    for param, estimator in zip(parameters.band_params, estimators):
+        result['band_criteria_' + param.sufix] = 1.0 if estimator is None else estimator.result()
+    return result
+
+def write_band_outputs(parameters, input):
+    '''
+    ２パス処理の２パス目。プロセスプールのワーカーとしても使う。\n
+    input['path'] の wav ファイルをバンド分離しなおし、ノーマライズの倍率 input['normalize_ratio_<sufix>'] とゲインを掛けて、\n
+    is_file_out のバンドと全バンドの加算結果を wav_stream_writer で直接ファイルに書き出す。
+    '''
+    path = input['path']
+    _, _, channels = query_wav_info(path)
+    with contextlib.ExitStack() as stack:
+        band_writers = {}
+        for param in parameters.band_params:
+            if param.is_file_out:
+                band_writers[param.sufix] = stack.enter_context(wav_stream_writer(compose_output_path(parameters, path, param.sufix), parameters.samplerate, channels, EXPORT_SAMPLE_FORMAT))
+        full_writer = stack.enter_context(wav_stream_writer(compose_output_path(parameters, path, parameters.output_file_sufix), parameters.samplerate, channels, EXPORT_SAMPLE_FORMAT))
+        for band_blocks in iterate_band_blocks(parameters, path):
+            result_samples = create_same_zeros(band_blocks[0])
+            for param, block in zip(parameters.band_params, band_blocks):
+                block = block * input['normalize_ratio_' + param.sufix] * to_ratio(param.gain)
+                if param.is_file_out:
+                    band_writers[param.sufix].write(block)
+                result_samples = result_samples + block
+            full_writer.write(result_samples)
+
+# ------------------------------------------------------------------------------
+# main
+# ------------------------------------------------------------------------------
 
-    # バンドごとにノーマライズを実行
+def print_usage():
+    'このプログラムの使い方を表示'
+    print('Usage : python multiband_tool.py [--jobs N] [--two-pass] [--ram-ceiling MiB] [--incremental[=<cache dir>]] [--watch[=<interval>]] <directory path>')
+    print('<directory path> must be directory that contain ".wav" file and config ".ini" file.')
+    print('--jobs N extracts bands of N files in parallel.')
+    print('--two-pass measures criteria of all files first and then splits bands again to write outputs, so memory does not grow with the number of files.')
+    print('--ram-ceiling MiB spills band samples exceeding MiB in memory to scratch files (default %d MiB).' % (STORE_RAM_CEILING // 2 ** 20))
+    print('--incremental[=<cache dir>] reuses cached bands of unchanged files (default cache is "%s" in the directory).' % RESULT_CACHE_DIR_NAME)
+    print('--watch[=<interval>] processes incrementally and then reprocesses whenever the directory is changed.')
+    print('--daemon serves jobs {"args": [...], "cwd": ...} from stdin JSON lines, --daemon=<socket path> serves on a UNIX socket.')
+    print('--connect <socket path> runs this job in a serving process.')
+
+def load_directory_parameters(input_dir):
+    '''
+    input_dir の wav ファイルと ini ファイルを探し、設定を読み込む。\n
+    カットオフ周波数は先頭ファイルのサンプルレートで変換される。\n
+    (wav ファイルのリスト, multiband_parameters) を返却する。異常時はメッセージを表示して None を返却する。
+    '''
+    # 指定ディレクトリ中の wav ファイルを列挙
+    wav_files = find_wav_files(input_dir)
+    if wav_files is None:
+        return None
+
+    # 指定ディレクトリ中の ini ファイルを列挙
+    ini_file = find_ini_file(input_dir)
+    if ini_file is None:
+        return None
+
+    # 補正処理の挙動を設定ファイルから読み込み
+    config = configparser.ConfigParser()
+    config.read(ini_file)
+    try:
+        parameters = load_parameters(config)
+    except RuntimeError as err:
+        print(err)
+        return None
+    if parameters.engine not in ['iir', 'fft']:
+        print('Invalid engine in loaded .ini file. "%s".' % parameters.engine)
+        return None
+
+    # "-3dB@120" 形式のカットオフ周波数を先頭ファイルのサンプルレートで変換
+    parameters.samplerate, _, _ = query_wav_info(wav_files[0])
+    try:
+        resolve_cutoff_frequencies(parameters, input_dir)
+    except RuntimeError as err:
+        print(err)
+        return None
+    return wav_files, parameters
+
+def store_bands(input, parameters, store):
+    'input の band_sample_<sufix> を (path, sufix) をキーとして store （ band_store ）に移す'
+    for param in parameters.band_params:
+        store.put((input['path'], param.sufix), input.pop('band_sample_' + param.sufix))
+
+def multiband_directory(input_dir, jobs, cache, ram_ceiling=STORE_RAM_CEILING):
+    '''
+    input_dir の wav ファイルをマルチバンド処理して保存し、終了コードを返却する。\n
+    cache （ result_cache ）を指定した場合は変更されたファイルだけバンド分離する。\n
+    バンド波形は band_store に保持され、メモリ上の合計が ram_ceiling バイトを超えた分はディスクに退避される。
+    '''
+    # 設定を読み込み
+    loaded = load_directory_parameters(input_dir)
+    if loaded is None:
+        return 1
+    WAV_FILES, parameters = loaded
+    output_file_prefix = parameters.output_file_prefix
+    output_file_sufix = parameters.output_file_sufix
+    band_params = parameters.band_params
+
+    # note 例外で中断された場合も、 band_store の退避ファイルとプロセスプールの一時ディレクトリを削除する
+    SCRATCH_DIR = None
+    try:
+        with band_store(ram_ceiling) as STORE:
+            # 全ての wav ファイルに対してマルチバンド分離
+            try:
+                if cache is not None:
+                    # 変更されたファイルだけバンド分離、残りはキャッシュから読み込む
+                    parameters.samplerate, _, _ = query_wav_info(WAV_FILES[0])
+                    SAMPLERATE = parameters.samplerate
+                    INPUTS = extract_bands_incremental(WAV_FILES, parameters, cache, jobs)
+                elif jobs == 1:
+                    # 指定ファイル全てメモリ上にロードして順番に処理
+                    INPUTS, SAMPLERATE = load_wav_files(WAV_FILES, INTERNAL_SAMPLE_FORMAT, mmap=True)
+                    parameters.samplerate = SAMPLERATE
+                    for i in INPUTS:
+                        extract_bands(i, parameters)
+                        store_bands(i, parameters, STORE)
+                else:
+                    # ファイル単位でプロセスプールに分配、バンド波形は一時ディレクトリ経由で受け取る
+                    SAMPLERATE, _, _ = query_wav_info(WAV_FILES[0])
+                    parameters.samplerate = SAMPLERATE
+                    SCRATCH_DIR = tempfile.mkdtemp(prefix='multiband_tool_')
+                    INPUTS = extract_bands_in_pool(WAV_FILES, parameters, SCRATCH_DIR, jobs)
+            except RuntimeError as err:
+                print(err)
+                return 1
+            if len(INPUTS) == 0:
+                print('All wav files in directory "%s" are silent.' % input_dir)
+                return 1
+            for i in INPUTS:
+                if 'band_sample_' + band_params[0].sufix in i:
+                    store_bands(i, parameters, STORE)
+            print_filter_cache_info()
+            for i in INPUTS:
+                print('%s, band split allocates about %d bytes.' % (decompose_path(i['path'])[1], i['band_split_allocated']))
+
+            # バンドごとにノーマライズを実行
+            for param in band_params:
+                # ノーマライズの基準量を決定
+                if param.normalization_target_override:
+                    # オーバーライドの指定がある場合はその値を目標基準量にする
+                    target_criteria = to_ratio(param.normalization_target)
+                else:
+                    # オーバーライドが指定されていなければ基準量の中央値を目標基準量とする
+                    criteria_array = []
+                    for i in INPUTS:
+                        criteria_array.append(i['band_criteria_' + param.sufix])
+                    criteria_array.sort()
+                    target_criteria = criteria_array[int(len(criteria_array)/2)]
+                # 基準量が揃うように振幅を調整＋ゲインを適用
+                for i in INPUTS:
+                    print('%s, criteria = %f.' % (decompose_path(i['path'])[1], to_decibel(i['band_criteria_' + param.sufix])))
+                    STORE.put((i['path'], param.sufix), STORE.get((i['path'], param.sufix)) * (target_criteria / i['band_criteria_' + param.sufix]) * to_ratio(param.gain))
+
+            # ファイル出力（個別＆バンド単位・全バンドの全結合）
+            # note 全結合はファイルごとの結果を順に wav_stream_writer に追記するので、全結合のサンプル列は作らない
+            dir_path, _, ext = decompose_path(INPUTS[-1]['path'])
+            channels = STORE.get((INPUTS[0]['path'], band_params[0].sufix)).shape[1]
+            def open_packed_writer(sufix):
+                outpath = dir_path + '\\' + output_file_prefix + "packed" + sufix + ext
+                return wav_stream_writer(outpath, SAMPLERATE, channels, EXPORT_SAMPLE_FORMAT)
+            with contextlib.ExitStack() as stack:
+                packed_writers = {}
+                for param in band_params:
+                    if param.is_file_out:
+                        packed_writers[param.sufix] = stack.enter_context(open_packed_writer(param.sufix))
+                packed_full_writer = stack.enter_context(open_packed_writer(output_file_sufix))
+                for i in INPUTS:
+                    result_samples = create_same_zeros(STORE.get((i['path'], band_params[0].sufix)))
+                    for param in band_params:
+                        band = STORE.get((i['path'], param.sufix))
+                        # 必要なバンド単位の結果をファイルアウト
+                        if param.is_file_out:
+                            save_samples(compose_output_path(parameters, i['path'], param.sufix), band, SAMPLERATE, EXPORT_SAMPLE_FORMAT)
+                            packed_writers[param.sufix].write(band)
+                        # 結果用変数に加算
+                        result_samples = result_samples + band
+                    # 全バンドの加算結果をファイル出力
+                    save_samples(compose_output_path(parameters, i['path'], output_file_sufix), result_samples, SAMPLERATE, EXPORT_SAMPLE_FORMAT)
+                    packed_full_writer.write(result_samples)
+
+            if 0 < STORE.spill_count:
+                print('%d band samples are spilled to "%s".' % (STORE.spill_count, STORE.scratch_dir))
+    finally:
+        if SCRATCH_DIR is not None:
+            shutil.rmtree(SCRATCH_DIR, ignore_errors=True)
+
+    # 正常終了
+    return 0
+
+def multiband_two_pass_directory(input_dir, jobs, cache):
+    '''
+    multiband_directory() の２パス版。バンド波形を保持しないので、使用メモリ量は入力ファイル数に依存しない。\n
+    １パス目で各ファイルのバンドごとの基準量だけを measure_band_criteria() で求めて目標基準量を決め、\n
+    ２パス目で各ファイルをバンド分離しなおして write_band_outputs() で直接書き出す。\n
+    packed のファイルは２パス目の出力をブロック単位で結合して作る。\n
+    cache （ result_cache ）を指定した場合は変更されていないファイルの基準量を再利用する。\n
+    エントリの形式が multiband_directory() と異なり、 prune() で互いのエントリを消さないように別のディレクトリのキャッシュを渡す事。\n
+    基準量は中央値スケッチによる近似なので、 multiband_directory() の結果とはノーマライズの倍率が MEDIAN_SKETCH_RESOLUTION 程度異なる。\n
+    バンド波形そのものは端点を含めて一致するので、差はファイル全体に一様な倍率の違いとなる。
+    '''
+    # 設定を読み込み
+    loaded = load_directory_parameters(input_dir)
+    if loaded is None:
+        return 1
+    WAV_FILES, parameters = loaded
+    band_params = parameters.band_params
+
+    # １パス目、全ての wav ファイルの基準量を計算
+    measure = partial(measure_band_criteria, parameters)
+    if cache is None:
+        MEASURED = map_in_process_pool(measure, WAV_FILES, jobs)
+    else:
+        # 変更されたファイルだけ計算、残りはキャッシュから読み込む
+        keys = [cache.key(hash_wav_file(p), band_split_parameter_hash(parameters)) for p in WAV_FILES]
+        MEASURED = [cache.load(k) for k in keys]
+        missed_indices = [index for index, entry in enumerate(MEASURED) if entry is None]
+        for index, entry in zip(missed_indices, map_in_process_pool(measure, [WAV_FILES[i] for i in missed_indices], jobs)):
+            cache.save(keys[index], entry)
+            MEASURED[index] = entry
+        cache.prune(keys)
+        print('%d of %d files are reused from cache.' % (len(WAV_FILES) - len(missed_indices), len(WAV_FILES)))
+    INPUTS = []
+    for path, measured in zip(WAV_FILES, MEASURED):
+        # 無音サンプルはスキップ
+        if len(measured) == 0:
+            continue
+        # サンプルレートをチェック
+        if measured['samplerate'] != parameters.samplerate:
+            print('Wrong sample rate is detected in input files.')
+            print('File = ' + path)
+            print('Expected sample rate = %d' % parameters.samplerate)
+            print('Actual sample rate = %d' % measured['samplerate'])
+            return 1
+        INPUTS.append(dict(measured, path=path))
+    if len(INPUTS) == 0:
+        print('All wav files in directory "%s" are silent.' % input_dir)
+        return 1
+    print_filter_cache_info()
+
+    # バンドごとにノーマライズの倍率を決定
     for param in band_params:
-        # ノーマライズの基準量を決定
         if param.normalization_target_override:
-            # オーバーライドの指定がある場合はその値を目標基準量にする
             target_criteria = to_ratio(param.normalization_target)
         else:
-            # オーバーライドが指定されていなければ基準量の中央値を目標基準量とする
-            criteria_array = []
-            for i in INPUTS:
-                criteria_array.append(i['band_criteria_' + param.sufix])
-            criteria_array.sort()
+            criteria_array = sorted([i['band_criteria_' + param.sufix] for i in INPUTS])
             target_criteria = criteria_array[int(len(criteria_array)/2)]
-        # 基準量が揃うように振幅を調整＋ゲインを適用
         for i in INPUTS:
             print('%s, criteria = %f.' % (decompose_path(i['path'])[1], to_decibel(i['band_criteria_' + param.sufix])))
-            i['band_sample_' + param.sufix] = i['band_sample_' + param.sufix] * (target_criteria / i['band_criteria_' + param.sufix]) * to_ratio(param.gain)
-
-    # ファイル出力（個別）
-    for i in INPUTS:
-        result_samples = create_same_zeros(i['stereo'])
-        for param in band_params:
-            band = i['band_sample_' + param.sufix]
-            # 必要なバンド単位の結果をファイルアウト
-            if param.is_file_out:
-                dir_path, stem, ext = decompose_path(i['path'])
-                outpath = dir_path + '\\' + output_file_prefix + stem + param.sufix + ext
-                save_samples(outpath, band, SAMPLERATE, 'float')
-            # 結果用変数に加算
-            result_samples = result_samples + band
-        # 全バンドの加算結果をファイル出力
-        dir_path, stem, ext = decompose_path(i['path'])
-        outpath = dir_path + '\\' + output_file_prefix + stem + output_file_sufix + ext
-        save_samples(outpath, result_samples, SAMPLERATE, 'float')
-
-    # ファイル出力（バンド単位＆全バンド全結合）
-    result_full_packed = None
-    for param in band_params:
-        # バンド単位の全結合サンプル列を生成
-        result_samples = numpy.empty((0, 2), INTERNAL_SAMPLE_FORMAT)
-        for i in INPUTS:
-            band = i['band_sample_' + param.sufix]
-            result_samples = compose_samples(result_samples, band)
-        # 全バンド前結合に加算
-        if result_full_packed is None:
-            result_full_packed = result_samples
-        else:
-            result_full_packed += result_samples
-        # 必要ならバンド単位の結果をファイルアウト
-        if param.is_file_out:
-            dir_path, stem, ext = decompose_path(i['path'])
-            outpath = dir_path + '\\' + output_file_prefix + "packed" + param.sufix + ext
-            save_samples(outpath, result_samples, SAMPLERATE, 'float')
-    # 全バンド全結合のファイルアウト
-    dir_path, stem, ext = decompose_path(i['path'])
-    outpath = dir_path + '\\' + output_file_prefix + "packed" + output_file_sufix + ext
-    save_samples(outpath, result_full_packed, SAMPLERATE, 'float')
+            i['normalize_ratio_' + param.sufix] = target_criteria / i['band_criteria_' + param.sufix]
+
+    # ２パス目、ファイルごとにバンド分離しなおして出力
+    map_in_process_pool(partial(write_band_outputs, parameters), INPUTS, jobs)
+
+    # ファイル出力（バンド単位＆全バンド全結合）、ファイルごとの出力をブロック単位で結合する
+    dir_path, _, ext = decompose_path(INPUTS[-1]['path'])
+    for sufix in [p.sufix for p in band_params if p.is_file_out] + [parameters.output_file_sufix]:
+        outpath = dir_path + '\\' + parameters.output_file_prefix + 'packed' + sufix + ext
+        compose_wav_files([compose_output_path(parameters, i['path'], sufix) for i in INPUTS], outpath, INTERNAL_SAMPLE_FORMAT, EXPORT_SAMPLE_FORMAT)
 
     # 正常終了
-    exit(0)
+    return 0
+
+def main(argv):
+    '''
+    argv で指定されたディレクトリの wav ファイルをマルチバンド処理し、終了コードを返却する。\n
+    常駐モードで同一プロセスから何度も呼ばれるので、異常時も exit() せずに終了コードを return する。\n
+    --watch の指定がある場合は中断されるまで戻らない。
+    '''
+    # 引数チェック
+    try:
+        JOBS, INPUT_PATHS = parse_jobs_option(argv)
+        CACHE_DIR, INTERVAL, INPUT_PATHS = parse_incremental_option(INPUT_PATHS)
+        RAM_CEILING, INPUT_PATHS = parse_ram_ceiling_option(INPUT_PATHS)
+    except RuntimeError as err:
+        print(err)
+        print_usage()
+        return 1
+    TWO_PASS = '--two-pass' in INPUT_PATHS
+    INPUT_PATHS = [a for a in INPUT_PATHS if a != '--two-pass']
+    if len(INPUT_PATHS)!=1:
+        print('Invalid number of arguments.')
+        print_usage()
+        return 1
+
+    # エイリアス
+    INPUT_DIR = INPUT_PATHS[0]
+
+    # ディレクトリ以外の指定は NG
+    if not os.path.isdir(INPUT_DIR):
+        print('Specified path is not directory. "%s".' % INPUT_DIR)
+        return 1
+
+    # 処理、監視モードの場合は変更のたびに処理
+    # note １パス処理と２パス処理のキャッシュは別のディレクトリにする、同じディレクトリだと prune() で交互に消し合う
+    if TWO_PASS:
+        run = partial(multiband_two_pass_directory, INPUT_DIR, JOBS, open_result_cache(CACHE_DIR, INPUT_DIR, 'multiband_tool_two_pass'))
+    else:
+        run = partial(multiband_directory, INPUT_DIR, JOBS, open_result_cache(CACHE_DIR, INPUT_DIR, 'multiband_tool'), RAM_CEILING)
+    if INTERVAL is None:
+        return run()
+    return watch_directory(INPUT_DIR, run, INTERVAL)
+
+if __name__ == '__main__':
+    exit(run_tool(main, sys.argv[1:]))